@@ -15,6 +15,99 @@ COGNITO_USER_POOL_ID = os.getenv("COGNITO_USER_POOL_ID") if os.getenv(
 COGNITO_USER_POOL_CLIENT_ID = os.getenv("COGNITO_USER_POOL_CLIENT_ID") if os.getenv(
     "COGNITO_USER_POOL_CLIENT_ID") else os.getenv("COGNITO_USER_POOL_CLIENT_ID_DEV")
 
+# Lifetime of the JWKS of Cognito User Pool cached in the warm Lambda container (seconds).
+# The JWKS is refetched earlier only when a token carries an unknown kid (ex: the signing keys are rotated).
+JWKS_CACHE_TTL_SECONDS = int(os.getenv("JWKS_CACHE_TTL_SECONDS", "3600"))
+# Max number of verified claims of access tokens cached in the warm Lambda container.
+CLAIMS_CACHE_MAX_SIZE = int(os.getenv("CLAIMS_CACHE_MAX_SIZE", "1024"))
+# Stats of the cache above are logged every this number of misses to size it. 0 disables the log (get_claims_cache_stats() still returns them).
+CLAIMS_CACHE_STATS_LOG_INTERVAL = int(os.getenv("CLAIMS_CACHE_STATS_LOG_INTERVAL", "100"))
+# Secret key to sign the session cookie with HMAC after the access token is verified with JWKS.
+# The session cookie is disabled (i.e., every access token is verified with JWKS) unless it is set.
+SESSION_COOKIE_SECRET = os.getenv("SESSION_COOKIE_SECRET") or None
+# Lifetime of the session cookie (seconds). It never outlives the access token.
+SESSION_COOKIE_TTL_SECONDS = int(os.getenv("SESSION_COOKIE_TTL_SECONDS", "900"))
+# Access token which expires within this period (seconds) is refreshed by TokenRefreshMiddleware before the request is handled.
+TOKEN_REFRESH_BEFORE_SECONDS = int(os.getenv("TOKEN_REFRESH_BEFORE_SECONDS", "300"))
+# Backend to verify the signature of access tokens. "jose" (default) or "cryptography" (RS256 only). See tools/benchmark_auth.py to compare them.
+JWT_VERIFIER_BACKEND = os.getenv("JWT_VERIFIER_BACKEND", "jose")
+# "sync" (default) or "async". "async" authenticates users on the event loop instead of the threadpool of FastAPI (ex: uvicorn outside Lambda).
+AUTHENTICATION_MODE = os.getenv("AUTHENTICATION_MODE", "sync")
+
+# Token buckets of admission control in front of Cognito (/signin, /signup, /forgot-password and /refresh-token) per Lambda container.
+# Identity is the email, or the digest of the refresh token for /refresh-token.
+ADMISSION_IDENTITY_BURST = int(os.getenv("ADMISSION_IDENTITY_BURST", "5"))
+ADMISSION_IDENTITY_REFILL_PER_SECOND = float(os.getenv("ADMISSION_IDENTITY_REFILL_PER_SECOND", "0.1"))
+ADMISSION_IP_BURST = int(os.getenv("ADMISSION_IP_BURST", "30"))
+ADMISSION_IP_REFILL_PER_SECOND = float(os.getenv("ADMISSION_IP_REFILL_PER_SECOND", "1"))
+# Shared tier counts the requests across Lambda containers in terakoya-{STAGE}-rate-limit table of DynamoDB.
+# It's disabled by default because it costs a write to DynamoDB per request.
+ADMISSION_SHARED_TIER_ENABLED = os.getenv("ADMISSION_SHARED_TIER_ENABLED", "false").lower() == "true"
+ADMISSION_SHARED_WINDOW_SECONDS = int(os.getenv("ADMISSION_SHARED_WINDOW_SECONDS", "60"))
+ADMISSION_SHARED_IDENTITY_LIMIT = int(os.getenv("ADMISSION_SHARED_IDENTITY_LIMIT", "20"))
+ADMISSION_SHARED_IP_LIMIT = int(os.getenv("ADMISSION_SHARED_IP_LIMIT", "120"))
+
+# Number of partition keys of timeline-post-all GSI which posts are spread over ("pk_for_all_post_gsi#0", "pk_for_all_post_gsi#1", ...).
+# A partition key of GSI accepts writes up to 1,000 WCU per second. Only increase it, because the posts in the shards over the count are not read.
+# https://docs.aws.amazon.com/ja_jp/amazondynamodb/latest/developerguide/bp-partition-key-sharding.html
+TIMELINE_POST_GSI_SHARD_COUNT = int(os.getenv("TIMELINE_POST_GSI_SHARD_COUNT", "4"))
+
+# Number of items per page of the listing of posts and comments when the client doesn't give "limit", and the maximum of "limit".
+# A Query reads up to 1 MB, so too large "limit" only makes the page end earlier with the cursor.
+# https://docs.aws.amazon.com/ja_jp/amazondynamodb/latest/developerguide/Query.Pagination.html
+TIMELINE_LIST_DEFAULT_LIMIT = int(os.getenv("TIMELINE_LIST_DEFAULT_LIMIT", "20"))
+TIMELINE_LIST_MAX_LIMIT = int(os.getenv("TIMELINE_LIST_MAX_LIMIT", "100"))
+
+# Maximum of "preview_comments" of GET /timeline/list, i.e., the number of the newest comments embedded per post.
+TIMELINE_PREVIEW_COMMENTS_MAX = int(os.getenv("TIMELINE_PREVIEW_COMMENTS_MAX", "5"))
+# Number of the queries of the comments run at the same time for a page, which bounds the burst of reads on the comment table.
+TIMELINE_PREVIEW_COMMENTS_MAX_WORKERS = int(os.getenv("TIMELINE_PREVIEW_COMMENTS_MAX_WORKERS", "8"))
+
+# Maximum of the IDs of GET /timeline/batch. It's independent of the page size, and BatchGetItem reads 100 keys at most per request,
+# so the IDs over 100 are read with multiple requests.
+# https://docs.aws.amazon.com/ja_jp/amazondynamodb/latest/APIReference/API_BatchGetItem.html
+TIMELINE_BATCH_MAX_IDS = int(os.getenv("TIMELINE_BATCH_MAX_IDS", "200"))
+
+# True after like_count and bad_count have been backfilled to all items (python tools/timeline_migration.py counters).
+# Until then "counts_only" still fetches reaction_by_user to count the reactions of the items which have no counters.
+TIMELINE_REACTION_COUNTERS_BACKFILLED = os.getenv("TIMELINE_REACTION_COUNTERS_BACKFILLED", "false").lower() == "true"
+
+# Read cache of the first pages of GET /timeline/list and of GET /timeline/{post_id} (domain/timeline.py).
+# "memory" (default) caches them in the Lambda container, and "none" disables the cache.
+# Writes in the container invalidate the entries at once, but the other containers may return stale ones until TTL expires.
+TIMELINE_CACHE_BACKEND = os.getenv("TIMELINE_CACHE_BACKEND", "memory")
+TIMELINE_CACHE_TTL_SECONDS = float(os.getenv("TIMELINE_CACHE_TTL_SECONDS", "10"))
+TIMELINE_CACHE_MAX_SIZE = int(os.getenv("TIMELINE_CACHE_MAX_SIZE", "512"))
+# Number of pages of GET /timeline/list from the newest which are cached. The pages after them are always read from DynamoDB.
+TIMELINE_CACHE_LIST_PAGES = int(os.getenv("TIMELINE_CACHE_LIST_PAGES", "3"))
+
+# Idempotency-Key of POST /timeline, POST /timeline/{post_id}/comment and POST /book (domain/idempotency.py).
+# The result of the first request is replayed for the retries with the same key within IDEMPOTENCY_TTL_SECONDS.
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", str(60 * 60 * 24)))
+# The retry can run the operation again after this period if the first request has not completed (ex: timeout of Lambda).
+IDEMPOTENCY_LOCK_SECONDS = int(os.getenv("IDEMPOTENCY_LOCK_SECONDS", "60"))
+
+# Storage codec of texts of posts and comments (domain/timeline.py).
+# Texts larger than this (bytes in UTF-8) are stored compressed with zlib, and the item keeps a preview as texts for the listing.
+TIMELINE_TEXTS_COMPRESSION_THRESHOLD_BYTES = int(os.getenv("TIMELINE_TEXTS_COMPRESSION_THRESHOLD_BYTES", "4096"))
+# Texts still larger than this (bytes after compression) are stored in S3_TERAKOYA_BUCKET_NAME and the item keeps only its key.
+# The whole item is read by every listing query because the GSIs project ALL attributes, and an item is up to 400 KB.
+# https://docs.aws.amazon.com/ja_jp/amazondynamodb/latest/developerguide/bp-use-s3-too.html
+TIMELINE_TEXTS_OFFLOAD_THRESHOLD_BYTES = int(os.getenv("TIMELINE_TEXTS_OFFLOAD_THRESHOLD_BYTES", str(16 * 1024)))
+# Number of characters of the preview returned by the listing instead of the compressed or offloaded texts.
+TIMELINE_TEXTS_PREVIEW_LENGTH = int(os.getenv("TIMELINE_TEXTS_PREVIEW_LENGTH", "280"))
+
+# Counter reconciliation job (handlers/timeline/reconcile_counters.py) which recomputes comment_count and the reaction counters.
+# Each run checks the posts created or whose counters have been updated since the watermark saved by the last run.
+# The first run starts from this period (seconds) ago unless "since" is given in the event. "full" in the event checks all posts.
+COUNTER_RECONCILIATION_LOOKBACK_SECONDS = int(os.getenv("COUNTER_RECONCILIATION_LOOKBACK_SECONDS", str(60 * 60 * 24 * 7)))
+# True after timeline-post-counters-updated GSI is deployed (custom.timelineCountersUpdatedIndex of serverless.yml).
+# Otherwise the incremental run reads all posts of timeline-post-all GSI and filters the ones created or updated since the watermark.
+COUNTER_RECONCILIATION_COUNTERS_INDEX_ENABLED = os.getenv("COUNTER_RECONCILIATION_COUNTERS_INDEX_ENABLED", "false").lower() == "true"
+COUNTER_RECONCILIATION_MAX_WORKERS = int(os.getenv("COUNTER_RECONCILIATION_MAX_WORKERS", "8"))
+# Requests to DynamoDB per second shared by all the workers, so that the job doesn't consume the capacity the hub needs.
+COUNTER_RECONCILIATION_REQUESTS_PER_SECOND = float(os.getenv("COUNTER_RECONCILIATION_REQUESTS_PER_SECOND", "25"))
+
 S3_TERAKOYA_BUCKET_NAME = os.getenv("S3_TERAKOYA_BUCKET_NAME")
 S3_TERAKOYA_PUBLIC_BUCKET_NAME = os.getenv("S3_TERAKOYA_PUBLIC_BUCKET_NAME")
 
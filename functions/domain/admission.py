@@ -0,0 +1,161 @@
+import os
+import sys
+import time
+import math
+import threading
+from typing import Dict, Optional
+from botocore.exceptions import ClientError
+from fastapi import Request, HTTPException, status
+
+ROOT_DIR_PATH = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR_PATH)
+
+from conf.env import STAGE, ADMISSION_IDENTITY_BURST, ADMISSION_IDENTITY_REFILL_PER_SECOND, ADMISSION_IP_BURST, ADMISSION_IP_REFILL_PER_SECOND, ADMISSION_SHARED_TIER_ENABLED, ADMISSION_SHARED_WINDOW_SECONDS, ADMISSION_SHARED_IDENTITY_LIMIT, ADMISSION_SHARED_IP_LIMIT
+from utils.aws import dynamodb_resource
+from utils.cache import LRUCache
+from utils.rate_limit import TokenBucket
+
+# Admission control in front of the calls to Cognito.
+# A retry storm from the client can exceed the rate limits of Cognito per AWS account, and then sign-in of every user fails.
+# https://docs.aws.amazon.com/cognito/latest/developerguide/limits.html#category_operations
+# So excess requests per email (identity) and per IP are rejected with 429 before Cognito is called.
+# 1. In-memory tier: token buckets in this Lambda container. No I/O.
+# 2. Shared tier (optional): fixed window counters in DynamoDB shared by all Lambda containers.
+
+__table = dynamodb_resource.Table(f"terakoya-{STAGE}-rate-limit")
+
+# Buckets are kept only while they are not full, so the number of identities kept in memory is bounded.
+__buckets = LRUCache(max_size=4096)
+__buckets_lock = threading.Lock()
+
+__stats_lock = threading.Lock()
+__stats: Dict[str, int] = {
+    "admitted": 0,
+    "throttled": 0,
+    "throttled_by_ip": 0,
+    "throttled_by_identity": 0,
+    "throttled_by_shared_tier": 0,
+}
+
+
+def get_client_ip(request: Request) -> str:
+    # Mangum sets requestContext.http.sourceIp of API Gateway to request.client, which can't be spoofed by the client.
+    # https://docs.aws.amazon.com/apigateway/latest/developerguide/http-api-develop-integrations-lambda.html
+    if request.client is not None and request.client.host:
+        return request.client.host
+    # The last entry of X-Forwarded-For is the one appended by the nearest proxy (ex: uvicorn behind a load balancer).
+    # https://developer.mozilla.org/ja/docs/Web/HTTP/Headers/X-Forwarded-For
+    forwarded_for = request.headers.get("x-forwarded-for")
+    if forwarded_for:
+        return forwarded_for.split(",")[-1].strip()
+    return "unknown"
+
+
+def __acquire_bucket(key: str, capacity: float, refill_per_second: float) -> Optional[float]:
+    """Returns None if admitted, otherwise seconds to wait until a token is available."""
+    with __buckets_lock:
+        bucket: Optional[TokenBucket] = __buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(capacity, refill_per_second)
+        admitted = bucket.try_acquire()
+        # The bucket which becomes full again is identical to a new one, so it expires then.
+        __buckets.set(key, bucket, expires_at=time.time() + bucket.seconds_until_full() + 1)
+    return None if admitted else bucket.seconds_until_available()
+
+
+def __acquire_shared(key: str, limit: int) -> Optional[float]:
+    """Count the request in the current window in DynamoDB. Returns None if admitted, otherwise seconds until the next window."""
+    now = int(time.time())
+    window_start = now - now % ADMISSION_SHARED_WINDOW_SECONDS
+    window_end = window_start + ADMISSION_SHARED_WINDOW_SECONDS
+    try:
+        # ADD increments the counter atomically and ConditionExpression rejects the request over the limit in the same write.
+        # https://docs.aws.amazon.com/ja_jp/amazondynamodb/latest/developerguide/Expressions.ConditionExpressions.html
+        __table.update_item(
+            Key={"key": f"{key}#{window_start}"},
+            UpdateExpression="ADD #count :one SET #expires_at = :expires_at",
+            ConditionExpression="attribute_not_exists(#count) OR #count < :limit",
+            ExpressionAttributeNames={
+                "#count": "count",
+                "#expires_at": "expires_at",
+            },
+            ExpressionAttributeValues={
+                ":one": 1,
+                ":limit": limit,
+                # Expired counters are deleted by TTL of DynamoDB.
+                # https://docs.aws.amazon.com/ja_jp/amazondynamodb/latest/developerguide/TTL.html
+                ":expires_at": window_end + ADMISSION_SHARED_WINDOW_SECONDS,
+            }
+        )
+        return None
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            return float(window_end - now)
+        # Fail open not to block sign-in of every user because of the failure of the rate limiter itself.
+        print(f"Failed to count the request in the shared tier. Error message: {str(e)}")
+        return None
+
+
+def __count(*keys: str):
+    with __stats_lock:
+        for key in keys:
+            __stats[key] += 1
+
+
+def try_admit(request: Request, scope: str, identity: Optional[str] = None) -> Optional[float]:
+    """
+    Returns None if the request to Cognito is admitted, otherwise seconds to wait before retrying.
+    scope is the name of the operation (ex: "signin") to keep the buckets of operations separately.
+    """
+    ip_key = f"{scope}#ip#{get_client_ip(request)}"
+    identity_key = f"{scope}#identity#{identity.strip().lower()}" if identity else None
+
+    retry_after = __acquire_bucket(ip_key, ADMISSION_IP_BURST, ADMISSION_IP_REFILL_PER_SECOND)
+    if retry_after is not None:
+        __count("throttled", "throttled_by_ip")
+        return retry_after
+    if identity_key is not None:
+        retry_after = __acquire_bucket(identity_key, ADMISSION_IDENTITY_BURST, ADMISSION_IDENTITY_REFILL_PER_SECOND)
+        if retry_after is not None:
+            __count("throttled", "throttled_by_identity")
+            return retry_after
+
+    if ADMISSION_SHARED_TIER_ENABLED:
+        retry_after = __acquire_shared(ip_key, ADMISSION_SHARED_IP_LIMIT)
+        if retry_after is None and identity_key is not None:
+            retry_after = __acquire_shared(identity_key, ADMISSION_SHARED_IDENTITY_LIMIT)
+        if retry_after is not None:
+            __count("throttled", "throttled_by_shared_tier")
+            return retry_after
+
+    __count("admitted")
+    return None
+
+
+def admit(request: Request, scope: str, identity: Optional[str] = None):
+    """Raise HTTPException with 429 Too Many Requests unless the request to Cognito is admitted."""
+    retry_after = try_admit(request, scope, identity)
+    if retry_after is None:
+        return
+    print(f"Request is throttled. scope: {scope}, retry_after: {retry_after}")
+    raise HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail="リクエストが多すぎます。しばらく時間をおいてから再度お試し下さい。",
+        # Retry-After tells the client how long to wait before retrying.
+        # https://developer.mozilla.org/ja/docs/Web/HTTP/Headers/Retry-After
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+    )
+
+
+def get_admission_stats() -> Dict[str, int]:
+    """Returns the numbers of admitted and throttled requests in this Lambda container."""
+    with __stats_lock:
+        return dict(__stats)
+
+
+def clear_admission_state():
+    """Only for testing"""
+    __buckets.clear()
+    with __stats_lock:
+        for key in __stats:
+            __stats[key] = 0
@@ -1,16 +1,28 @@
 import os
 import sys
-from typing import Any, Dict, Optional
+import time
+import asyncio
+import json
+import hmac
+import base64
+import hashlib
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Optional, Tuple
 from dataclasses import dataclass
-from jose import jwt, jwk, JWTError
+from jose import jwt, JWTError
 import requests
-from fastapi import Request, Response, HTTPException, status
+import httpx
+from fastapi import Request, Response, HTTPException, Depends, status
 
 ROOT_DIR_PATH = os.path.dirname(os.path.dirname(__file__))
 sys.path.append(ROOT_DIR_PATH)
 
-from conf.env import AWS_DEFAULT_REGION, COGNITO_USER_POOL_ID, COGNITO_USER_POOL_CLIENT_ID
+from conf.env import AWS_DEFAULT_REGION, COGNITO_USER_POOL_ID, COGNITO_USER_POOL_CLIENT_ID, JWKS_CACHE_TTL_SECONDS, CLAIMS_CACHE_MAX_SIZE, CLAIMS_CACHE_STATS_LOG_INTERVAL, SESSION_COOKIE_SECRET, SESSION_COOKIE_TTL_SECONDS, AUTHENTICATION_MODE, JWT_VERIFIER_BACKEND
 from utils.aws import cognito_client
+from models.user import CLAIM_IS_ADMIN, CLAIM_NAME, CLAIM_USER_PROFILE_IMG_URL
+from utils.cache import LRUCache
+from utils.jwt_verifier import IJwtVerifier, InvalidTokenError, create_jwt_verifier
 
 if COGNITO_USER_POOL_CLIENT_ID == None or COGNITO_USER_POOL_ID == None:
     print("COGNITO_USER_POOL_CLIENT_ID or COGNITO_USER_POOL_ID is None")
@@ -20,8 +32,8 @@ if COGNITO_USER_POOL_CLIENT_ID == None or COGNITO_USER_POOL_ID == None:
     )
 
 
-def set_cookie_secured(fastApiResponse: Response, key: str, value: str):
-    """Set access_token and refresh_token to cookie on Server-side"""
+def set_cookie_secured(fastApiResponse: Response, key: str, value: str, max_age: Optional[int] = None):
+    """Set access_token, refresh_token and session to cookie on Server-side"""
     # Include tokens in the response header as a cookie.
     # https://fastapi.tiangolo.com/advanced/response-cookies/
     # Set-Cookie is a HTTP response header to send a cookie from the server to the user agent.
@@ -47,6 +59,9 @@ def set_cookie_secured(fastApiResponse: Response, key: str, value: str):
         # If SameSite is set to "lax" or "strict", client-side can't receive the cookie from the server-side.
         # Exclaimation mark is displayed at the header of set-cookie in a Network tab of the dev tool of your browser with the mesasge "This attempt to set a cookie via a Set-Cookie header was blocked because it had the "SameSite=Lax" ("SameSite=Strict") attribute but came from a cross-site response which was not the response to a top-level navigation."
         samesite="none",
+        # max_age is the number of seconds until the cookie expires. The cookie is a session cookie (deleted when the browser is closed) if it's None.
+        # https://developer.mozilla.org/ja/docs/Web/HTTP/Headers/Set-Cookie#max-agenumber
+        max_age=max_age,
         # domain is to specify the domain that can receive the cookie from the server.
         # https://zenn.dev/ymmt1089/articles/20220506_cookie_domain
         # https://developer.mozilla.org/ja/docs/Web/HTTP/Headers/Set-Cookie#%E5%B1%9E%E6%80%A7
@@ -60,17 +75,8 @@ def set_cookie_secured(fastApiResponse: Response, key: str, value: str):
 
 def issue_new_access_token(refresh_token: str, fastApiResponse: Response):
     try:
-        # Get new access token by using refresh token.
-        response = cognito_client.initiate_auth(
-            ClientId=COGNITO_USER_POOL_CLIENT_ID,
-            AuthFlow="REFRESH_TOKEN_AUTH",
-            AuthParameters={
-                'REFRESH_TOKEN': refresh_token
-            }
-        )
-        auth_result = response['AuthenticationResult']
-        set_cookie_secured(fastApiResponse, 'access_token', auth_result['AccessToken'])
-        set_cookie_secured(fastApiResponse, 'refresh_token', auth_result['RefreshToken'])
+        tokens = refresh_tokens(refresh_token)
+        accept_issued_tokens(fastApiResponse, tokens.access_token, tokens.refresh_token, tokens.claims)
     except cognito_client.exceptions.NotAuthorizedException:
         # Delete credentials from cookie if refresh token is expired.
         print("Invalid refresh token")
@@ -81,6 +87,14 @@ def issue_new_access_token(refresh_token: str, fastApiResponse: Response):
         )
 
 
+# Get public keys from Cognito User Pool.
+# https://docs.aws.amazon.com/ja_jp/cognito/latest/developerguide/amazon-cognito-user-pools-using-tokens-verifying-a-jwt.html#amazon-cognito-user-pools-using-tokens-manually-inspect
+JWKS_URL = f"https://cognito-idp.{AWS_DEFAULT_REGION}.amazonaws.com/{COGNITO_USER_POOL_ID}/.well-known/jwks.json"
+JWKS_FETCH_TIMEOUT_SECONDS = 5
+# Minimum interval between refetches of JWKS to prevent tokens with a forged kid from sending a request to Cognito on every request.
+JWKS_MIN_REFRESH_INTERVAL_SECONDS = 60
+
+
 def get_cognito_jwks() -> Dict[str, Any]:
     """
     Returns:
@@ -111,16 +125,259 @@ def get_cognito_jwks() -> Dict[str, Any]:
     # Signature of JWT is used to verify the validity of JWT by using the public key of JWK with the algorithm specified by "alg" in the header.
     # https://zenn.dev/mikakane/articles/tutorial_for_jwt#%E7%BD%B2%E5%90%8D
 
-    # Get public keys from Cognito User Pool.
-    # https://docs.aws.amazon.com/ja_jp/cognito/latest/developerguide/amazon-cognito-user-pools-using-tokens-verifying-a-jwt.html#amazon-cognito-user-pools-using-tokens-manually-inspect
-    url = f"https://cognito-idp.{AWS_DEFAULT_REGION}.amazonaws.com/{COGNITO_USER_POOL_ID}/.well-known/jwks.json"
-    response = requests.get(url)
+    response = requests.get(JWKS_URL, timeout=JWKS_FETCH_TIMEOUT_SECONDS)
+    response.raise_for_status()
     # jwk.json(sample): { "keys": [ { "kid": "xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx", "alg": "RS256", "kty": "RSA", "e": "AQAB", "n": "1234567890", "use": "sig" } ] }
     jwk_list = response.json()['keys']
     # kid is uid of the public key (and JWK).
     return {jwk['kid']: jwk for jwk in jwk_list}
 
 
+async def get_cognito_jwks_async() -> Dict[str, Any]:
+    """Same as get_cognito_jwks() but uses the async HTTP client not to block the event loop."""
+    # httpx is an HTTP client which supports async/await unlike requests.
+    # https://www.python-httpx.org/async/
+    async with httpx.AsyncClient(timeout=JWKS_FETCH_TIMEOUT_SECONDS) as client:
+        response = await client.get(JWKS_URL)
+        response.raise_for_status()
+        jwk_list = response.json()['keys']
+        return {jwk['kid']: jwk for jwk in jwk_list}
+
+
+class CognitoJwksCache:
+    """
+    In-process cache of the JWKS of the Cognito User Pool.
+
+    The module-level instance lives as long as the warm Lambda container, so jwks.json is refetched only when
+    the cache is older than ttl_seconds or a token carries a kid which is not in the cached JWKS.
+    If the refetch fails, the last good JWKS keeps being served.
+
+    Public key objects of the verifier constructed from the JWKS are also cached per (kid, alg) and cleared when the JWKS is rotated,
+    so that the RSA key is not parsed from JWK on every request.
+    """
+
+    def __init__(self, ttl_seconds: int, min_refresh_interval_seconds: int = JWKS_MIN_REFRESH_INTERVAL_SECONDS, verifier: Optional[IJwtVerifier] = None) -> None:
+        self.verifier = verifier if verifier is not None else create_jwt_verifier(JWT_VERIFIER_BACKEND)
+        self.__ttl_seconds = ttl_seconds
+        self.__min_refresh_interval_seconds = min_refresh_interval_seconds
+        self.__jwks: Dict[str, Dict[str, Any]] = {}
+        # The type of the key object depends on the verifier.
+        self.__public_keys: Dict[Tuple[str, str], Any] = {}
+        self.__fetched_at = 0.0
+        self.__attempted_at = 0.0
+        # Lock to send only one request to Cognito even if several threads of the threadpool of FastAPI miss the cache at the same time.
+        self.__lock = threading.Lock()
+        # In-flight fetch of JWKS shared by concurrent requests of authenticate_user_async()
+        self.__inflight: Optional[asyncio.Task] = None
+
+    def get_jwk(self, kid: str) -> Optional[Dict[str, Any]]:
+        if self.__needs_refresh(kid):
+            with self.__lock:
+                # Another thread may have already refreshed the JWKS while waiting for the lock.
+                if self.__needs_refresh(kid):
+                    self.__refresh()
+        return self.__jwks.get(kid)
+
+    def get_public_key(self, kid: str, alg: str) -> Optional[Any]:
+        """Returns the public key object ready to verify the signature, or None if kid is unknown."""
+        self.get_jwk(kid)
+        return self.__get_public_key_from_jwks(kid, alg)
+
+    async def get_public_key_async(self, kid: str, alg: str) -> Optional[Any]:
+        """Same as get_public_key() but fetches JWKS without blocking the event loop."""
+        if self.__needs_refresh(kid):
+            await self.__refresh_async()
+        return self.__get_public_key_from_jwks(kid, alg)
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__jwks = {}
+            self.__public_keys = {}
+            self.__fetched_at = 0.0
+            self.__attempted_at = 0.0
+
+    def __get_public_key_from_jwks(self, kid: str, alg: str) -> Optional[Any]:
+        public_key = self.__public_keys.get((kid, alg))
+        if public_key is not None:
+            return public_key
+        target_jwk = self.__jwks.get(kid)
+        if target_jwk is None:
+            return None
+        # Reject the token whose alg in the header is different from the one of the JWK (ex: "none" or "HS256").
+        if target_jwk.get("alg", alg) != alg:
+            print(f"alg of the token ({alg}) doesn't match alg of the JWK ({target_jwk.get('alg')}).")
+            return None
+        # Convert JWK to public key object of the verifier.
+        public_key = self.verifier.construct_key(target_jwk, alg)
+        self.__public_keys[(kid, alg)] = public_key
+        return public_key
+
+    def __needs_refresh(self, kid: str) -> bool:
+        if not self.__jwks:
+            return True
+        now = time.monotonic()
+        is_expired = now - self.__fetched_at >= self.__ttl_seconds
+        is_unknown_kid = kid not in self.__jwks
+        can_refresh = now - self.__attempted_at >= self.__min_refresh_interval_seconds
+        return (is_expired or is_unknown_kid) and can_refresh
+
+    def __refresh(self) -> None:
+        self.__attempted_at = time.monotonic()
+        try:
+            jwks = get_cognito_jwks()
+        except (requests.RequestException, ValueError, KeyError) as e:
+            self.__on_refresh_error(e)
+            return
+        self.__apply(jwks)
+
+    async def __refresh_async(self) -> None:
+        # Concurrent requests on the same event loop share one in-flight request to Cognito.
+        loop = asyncio.get_running_loop()
+        inflight = self.__inflight
+        if inflight is None or inflight.get_loop() is not loop:
+            inflight = loop.create_task(self.__fetch_async())
+            self.__inflight = inflight
+        try:
+            # shield() prevents the shared fetch from being cancelled when one of the waiting requests is cancelled.
+            await asyncio.shield(inflight)
+        finally:
+            if inflight.done() and self.__inflight is inflight:
+                self.__inflight = None
+
+    async def __fetch_async(self) -> None:
+        self.__attempted_at = time.monotonic()
+        try:
+            jwks = await get_cognito_jwks_async()
+        except (httpx.HTTPError, ValueError, KeyError) as e:
+            self.__on_refresh_error(e)
+            return
+        self.__apply(jwks)
+
+    def __on_refresh_error(self, e: Exception) -> None:
+        if not self.__jwks:
+            raise e
+        print(f"Failed to refresh JWKS. So keep serving the last good JWKS. Error message: {str(e)}")
+
+    def __apply(self, jwks: Dict[str, Dict[str, Any]]) -> None:
+        if jwks != self.__jwks:
+            # Signing keys are rotated, so the public keys constructed from the previous JWKS are discarded.
+            self.__public_keys = {}
+        self.__jwks = jwks
+        self.__fetched_at = self.__attempted_at
+        print(f"Refreshed JWKS. kids: {list(jwks.keys())}")
+
+
+__jwks_cache = CognitoJwksCache(ttl_seconds=JWKS_CACHE_TTL_SECONDS)
+# Verified claims of access tokens keyed by the digest of the token.
+# SPA sends a burst of requests with the same access token, so the signature is verified only once per token.
+# Each entry expires at "exp" claim of the token, so an expired token is never accepted from the cache.
+__claims_cache = LRUCache(max_size=CLAIMS_CACHE_MAX_SIZE)
+
+
+def get_token_digest(token: str) -> str:
+    # The token itself is not used as the key so that the credential is not kept in memory as it is.
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def get_claims_cache_stats() -> Dict[str, int]:
+    """Returns hits, misses, evictions and so on of the cache of verified claims to size it."""
+    return __claims_cache.stats()
+
+
+SESSION_COOKIE_KEY = "session"
+SESSION_COOKIE_PROFILE_CLAIMS = (CLAIM_IS_ADMIN, CLAIM_NAME, CLAIM_USER_PROFILE_IMG_URL)
+
+
+def __b64encode(data: bytes) -> str:
+    # Padding "=" is removed to be used as a cookie value (base64url).
+    # https://datatracker.ietf.org/doc/html/rfc7515#appendix-C
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def __b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def __sign_session(payload_b64: str) -> bytes:
+    return hmac.new(str(SESSION_COOKIE_SECRET).encode("utf-8"), payload_b64.encode("ascii"), hashlib.sha256).digest()
+
+
+def mint_session_cookie(fastApiResponse: Response, claims: Dict[str, Any], token_digest: str):
+    """
+    Set the session cookie signed with HMAC which carries "sub" and "exp" after the access token is verified with JWKS.
+    Following requests are authenticated by verifying the HMAC of the session cookie instead of RSA signature of the access token.
+    """
+    if SESSION_COOKIE_SECRET is None:
+        return
+    now = int(time.time())
+    exp = min(now + SESSION_COOKIE_TTL_SECONDS, int(claims["exp"]))
+    if exp <= now:
+        return
+    payload = {
+        "sub": claims["sub"],
+        "exp": exp,
+        # Digest of the access token binds the session cookie to the access token,
+        # so the session cookie is not accepted after the access token is replaced (ex: signin with another user).
+        "ath": token_digest,
+        # Custom claims embedded by PreTokenGeneration trigger are carried as well to build Principal.
+        **{k: claims[k] for k in SESSION_COOKIE_PROFILE_CLAIMS if k in claims},
+    }
+    payload_b64 = __b64encode(json.dumps(payload, separators=(",", ":")).encode("utf-8"))
+    session = f"{payload_b64}.{__b64encode(__sign_session(payload_b64))}"
+    set_cookie_secured(fastApiResponse, SESSION_COOKIE_KEY, session, max_age=exp - now)
+
+
+def verify_session_cookie(session: Optional[str], token_digest: str) -> Optional[Dict[str, Any]]:
+    """Returns the claims ("sub", "exp" and the custom claims) of the session cookie, or None if it's missing, forged or expired."""
+    if SESSION_COOKIE_SECRET is None or not session:
+        return None
+    try:
+        payload_b64, signature_b64 = session.split(".")
+        # compare_digest() takes constant time regardless of where the values differ to prevent timing attacks.
+        # https://docs.python.org/ja/3/library/hmac.html#hmac.compare_digest
+        if not hmac.compare_digest(__sign_session(payload_b64), __b64decode(signature_b64)):
+            print("Invalid signature of the session cookie.")
+            return None
+        payload = json.loads(__b64decode(payload_b64))
+    except (ValueError, TypeError):
+        print("Malformed session cookie.")
+        return None
+    if payload.get("exp", 0) <= time.time() or not hmac.compare_digest(str(payload.get("ath", "")), token_digest):
+        return None
+    return {
+        "sub": payload["sub"],
+        "exp": payload["exp"],
+        **{k: payload[k] for k in SESSION_COOKIE_PROFILE_CLAIMS if k in payload},
+    }
+
+
+def accept_issued_tokens(fastApiResponse: Response, access_token: str, refresh_token: Optional[str], claims: Dict[str, Any]):
+    """
+    Set the tokens issued by Cognito just now to cookie and register their claims as verified,
+    so that neither this request nor the following ones verify the signature of the access token with JWKS.
+    """
+    set_cookie_secured(fastApiResponse, 'access_token', access_token)
+    if refresh_token is not None:
+        set_cookie_secured(fastApiResponse, 'refresh_token', refresh_token)
+    token_digest = get_token_digest(access_token)
+    __claims_cache.set(token_digest, claims, expires_at=claims.get("exp", 0))
+    mint_session_cookie(fastApiResponse, claims, token_digest)
+
+
+def use_jwt_verifier(verifier: IJwtVerifier):
+    """Only for testing and benchmark"""
+    global __jwks_cache
+    __jwks_cache = CognitoJwksCache(ttl_seconds=JWKS_CACHE_TTL_SECONDS, verifier=verifier)
+    __claims_cache.clear()
+
+
+def clear_auth_caches():
+    """Only for testing"""
+    __jwks_cache.clear()
+    __claims_cache.clear()
+    __refreshed_tokens_cache.clear()
+
+
 # tokenUrl is used for only OpenAPI document generation and  Swagger UI to get access token by using email and password.
 # https://self-methods.com/fastapi-authentication/
 # But FastAPI actually does not use tokenUrl to get access token. So, it doesn't affect the operation of the FastAPI application itself.
@@ -130,54 +387,142 @@ def get_cognito_jwks() -> Dict[str, Any]:
 # https://developer.mozilla.org/ja/docs/Web/HTTP/Headers/Authorization
 # https://qiita.com/h_tyokinuhata/items/ab8e0337085997be04b1
 
+def __get_access_token(request: Request, access_token: Optional[str]) -> str:
+    if access_token is not None:
+        return access_token
+    print("Request cookies: " + str(request.cookies))
+    access_token = request.cookies.get('access_token')
+    if access_token is None:
+        print("Access token is not set in Cookie.")
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="アクセストークンがCookieに設定されていません。サインインし直して下さい。"
+        )
+    return access_token
+
+
+def __get_claims_without_signature_verification(request: Request, token_digest: str) -> Optional[Dict[str, Any]]:
+    """Returns the claims already verified by this Lambda container or carried by the session cookie, or None."""
+    cached_claims = __claims_cache.get(token_digest)
+    if cached_claims is not None:
+        # Return a copy so that the caller can't modify the cached claims.
+        return dict(cached_claims)
+    stats = get_claims_cache_stats()
+    if CLAIMS_CACHE_STATS_LOG_INTERVAL > 0 and stats["misses"] % CLAIMS_CACHE_STATS_LOG_INTERVAL == 0:
+        # Logged once per the interval of misses instead of every miss, which is every cold start and every new token.
+        print(f"claims cache stats: {stats}")
+
+    # The session cookie is verified with HMAC only if the claims are not cached in this Lambda container (ex: cold start).
+    return verify_session_cookie(request.cookies.get(SESSION_COOKIE_KEY), token_digest)
+
+
+def __get_kid_and_alg(access_token: str) -> Tuple[str, str]:
+    # Decode JWT with python-jose.
+    # https://sal-blog.com/cognito%E3%81%AEjwt%E3%81%8B%E3%82%89%E3%83%A6%E3%83%BC%E3%82%B6%E6%83%85%E5%A0%B1%E3%82%92%E5%8F%96%E3%82%8A%E5%87%BA%E3%81%99python-jose/
+    # https://docs.aws.amazon.com/ja_jp/cognito/latest/developerguide/amazon-cognito-user-pools-using-tokens-verifying-a-jwt.html#amazon-cognito-user-pools-using-tokens-manually-inspect
+    header = jwt.get_unverified_header(access_token)
+    print(f"header: {header}")
+    return header.get("kid", ""), header["alg"]
+
+
+def __decode_access_token(fastApiResponse: Response, access_token: str, token_digest: str, pub_key: Optional[Any], alg: str) -> Dict[str, Any]:
+    if pub_key is None:
+        print(f"JWK not found.")
+        delete_tokens_from_cookie(fastApiResponse)
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="アクセストークンが無効です。サインインし直して下さい。"
+        )
+    # Simultaneously verify the signature and decode the payload with the public key and algorithm by the backend selected by JWT_VERIFIER_BACKEND.
+    claims = __jwks_cache.verifier.verify(access_token, pub_key, alg)
+    __claims_cache.set(token_digest, claims, expires_at=claims.get("exp", 0))
+    mint_session_cookie(fastApiResponse, claims, token_digest)
+    return dict(claims)
+
+
+def __raise_invalid_token(fastApiResponse: Response):
+    print("Invalid token")
+    delete_tokens_from_cookie(fastApiResponse)
+    raise HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        # detail is the error message that is displayed in the response body on the client side.
+        # https://fastapi.tiangolo.com/ja/tutorial/handling-errors/
+        detail='アクセストークンが無効です。サインインし直して下さい。',
+        # WWW-Authenticate header is used to indicate the authentication method(s) and parameters applicable to the target resource.
+        # https://developer.mozilla.org/ja/docs/Web/HTTP/Headers/WWW-Authenticate
+        headers={"WWW-Authenticate": "Bearer"})  # Specify the authentication method as "Bearer".
+
+
 def authenticate_user(fastApiResponse: Response, request: Request, access_token: Optional[str] = None):
     """Verify the signature of the JWT by using the public key of the Cognito User Pool."""
     path = f"{request.method}: {request.url.path}"
     print(f"================= {path} - authenticate_user =================")
 
-    if access_token is None:
-        print("Request cookies: " + str(request.cookies))
-        access_token = request.cookies.get('access_token')
-        if access_token is None:
-            print("Access token is not set in Cookie.")
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="アクセストークンがCookieに設定されていません。サインインし直して下さい。"
-            )
-
-    jwks = get_cognito_jwks()
+    access_token = __get_access_token(request, access_token)
+    token_digest = get_token_digest(access_token)
+    claims = __get_claims_without_signature_verification(request, token_digest)
+    if claims is not None:
+        return claims
+
     try:
-        # Decode JWT with python-jose.
-        # https://sal-blog.com/cognito%E3%81%AEjwt%E3%81%8B%E3%82%89%E3%83%A6%E3%83%BC%E3%82%B6%E6%83%85%E5%A0%B1%E3%82%92%E5%8F%96%E3%82%8A%E5%87%BA%E3%81%99python-jose/
-        # https://docs.aws.amazon.com/ja_jp/cognito/latest/developerguide/amazon-cognito-user-pools-using-tokens-verifying-a-jwt.html#amazon-cognito-user-pools-using-tokens-manually-inspect
-        header = jwt.get_unverified_header(access_token)
-        print(f"header: {header}")
-        alg = header["alg"]
-        target_jwk = jwks[header["kid"]]
-        if target_jwk is None:
-            print(f"JWK not found.")
-            delete_tokens_from_cookie(fastApiResponse)
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="アクセストークンが無効です。サインインし直して下さい。"
-            )
-        # Convert JWK to public key object of python-jose.
-        pub_key = jwk.construct(target_jwk)
-        # Simultaneously verify the signature and decode the payload with the public key and algorithm.
-        # PEM is a format for storing and transmitting cryptographic keys.
-        # https://zenn.dev/osai/articles/3941f2d1de94f0
-        return jwt.decode(access_token, pub_key.to_pem(), algorithms=[alg])
-    except JWTError:
-        print("Invalid token")
-        delete_tokens_from_cookie(fastApiResponse)
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            # detail is the error message that is displayed in the response body on the client side.
-            # https://fastapi.tiangolo.com/ja/tutorial/handling-errors/
-            detail='アクセストークンが無効です。サインインし直して下さい。',
-            # WWW-Authenticate header is used to indicate the authentication method(s) and parameters applicable to the target resource.
-            # https://developer.mozilla.org/ja/docs/Web/HTTP/Headers/WWW-Authenticate
-            headers={"WWW-Authenticate": "Bearer"})  # Specify the authentication method as "Bearer".
+        kid, alg = __get_kid_and_alg(access_token)
+        # Public key object of python-jose is cached per kid, so JWK is not converted to it on every request.
+        pub_key = __jwks_cache.get_public_key(kid, alg)
+        return __decode_access_token(fastApiResponse, access_token, token_digest, pub_key, alg)
+    except (JWTError, InvalidTokenError):
+        __raise_invalid_token(fastApiResponse)
+
+
+# FastAPI runs a dependency defined with def (ex: authenticate_user) in the threadpool whose size is limited,
+# so a thread is occupied while JWKS is fetched from Cognito. A dependency defined with async def runs on the event loop instead.
+# https://fastapi.tiangolo.com/async/#dependencies
+async def authenticate_user_async(fastApiResponse: Response, request: Request, access_token: Optional[str] = None):
+    """Same as authenticate_user() but fetches JWKS with the async HTTP client without occupying a thread."""
+    path = f"{request.method}: {request.url.path}"
+    print(f"================= {path} - authenticate_user_async =================")
+
+    access_token = __get_access_token(request, access_token)
+    token_digest = get_token_digest(access_token)
+    claims = __get_claims_without_signature_verification(request, token_digest)
+    if claims is not None:
+        return claims
+
+    try:
+        kid, alg = __get_kid_and_alg(access_token)
+        pub_key = await __jwks_cache.get_public_key_async(kid, alg)
+        return __decode_access_token(fastApiResponse, access_token, token_digest, pub_key, alg)
+    except (JWTError, InvalidTokenError):
+        __raise_invalid_token(fastApiResponse)
+
+
+# Dependency to authenticate the user in routers. The async one is selected by AUTHENTICATION_MODE=async.
+authenticate_user_dependency = authenticate_user_async if AUTHENTICATION_MODE == "async" else authenticate_user
+
+
+@dataclass
+class Principal:
+    """Authenticated user built from the claims of the access token without reading User table"""
+    uuid: str
+    is_admin: bool = False
+    name: Optional[str] = None
+    """None if the access token doesn't carry the custom claim (ex: issued before PreTokenGeneration trigger was deployed)"""
+    user_profile_img_url: Optional[str] = None
+
+    @staticmethod
+    def from_claims(claims: Dict[str, Any]) -> "Principal":
+        return Principal(
+            uuid=claims["sub"],
+            is_admin=claims.get(CLAIM_IS_ADMIN) is True,
+            name=claims.get(CLAIM_NAME),
+            user_profile_img_url=claims.get(CLAIM_USER_PROFILE_IMG_URL),
+        )
+
+
+# Sub-dependency of authenticate_user_dependency. It's defined with async def because it only converts the claims and
+# doesn't need to run in the threadpool.
+# https://fastapi.tiangolo.com/tutorial/dependencies/sub-dependencies/
+async def authenticate_principal(claims: Dict[str, Any] = Depends(authenticate_user_dependency)) -> Principal:
+    return Principal.from_claims(claims)
 
 
 def signup(email: str, password: str):
@@ -250,6 +595,8 @@ def signup(email: str, password: str):
 class SigninResponse:
     access_token: str
     refresh_token: str
+    claims: Dict[str, Any]
+    """Claims of the access token (ex: "sub" is UUID of the user)"""
 
 
 def signin(email: str, password: str):
@@ -268,7 +615,9 @@ def signin(email: str, password: str):
         auth_result = response['AuthenticationResult']
         access_token = auth_result['AccessToken']
         refresh_token = auth_result['RefreshToken']
-        return SigninResponse(access_token, refresh_token)  # To fetch item from User table in DynamoDB
+        # The access token has just been issued by Cognito via HTTPS, so its claims are trusted without verifying the signature with JWKS.
+        claims = jwt.get_unverified_claims(access_token)
+        return SigninResponse(access_token, refresh_token, claims)  # To fetch item from User table in DynamoDB
     except cognito_client.exceptions.NotAuthorizedException:
         print("Invalid email or password")
         raise HTTPException(
@@ -283,15 +632,91 @@ def signin(email: str, password: str):
         )
 
 
+# Tokens refreshed in this Lambda container are reused for a short while by the requests with the same refresh token
+# which arrive right after the refresh (ex: a burst of requests from SPA), so that Cognito is called only once.
+REFRESHED_TOKENS_REUSE_SECONDS = 30
+__refreshed_tokens_cache = LRUCache(max_size=256)
+# Refreshes in flight keyed by the digest of the refresh token to coalesce concurrent refreshes with the same refresh token.
+__inflight_refreshes: Dict[str, Future] = {}
+__inflight_refreshes_lock = threading.Lock()
+
+
+def refresh_tokens(refresh_token: str, before_cognito_call: Optional[Callable[[], None]] = None) -> SigninResponse:
+    """
+    Get new tokens from Cognito by using the refresh token.
+    Concurrent calls with the same refresh token in this process share one request to Cognito.
+    before_cognito_call is called only when Cognito is actually called (ex: admission control), and its exception is raised to all the callers.
+    Raises cognito_client.exceptions.NotAuthorizedException if the refresh token is invalid or expired.
+    """
+    refresh_token_digest = get_token_digest(refresh_token)
+    refreshed_tokens = __refreshed_tokens_cache.get(refresh_token_digest)
+    if refreshed_tokens is not None:
+        return refreshed_tokens
+
+    with __inflight_refreshes_lock:
+        inflight = __inflight_refreshes.get(refresh_token_digest)
+        is_leader = inflight is None
+        if inflight is None:
+            inflight = Future()
+            __inflight_refreshes[refresh_token_digest] = inflight
+    if not is_leader:
+        print("Wait for the refresh in flight with the same refresh token.")
+        return inflight.result()
+
+    try:
+        if before_cognito_call is not None:
+            before_cognito_call()
+        # Get new access token by using refresh token.
+        response = cognito_client.initiate_auth(
+            ClientId=COGNITO_USER_POOL_CLIENT_ID,
+            AuthFlow="REFRESH_TOKEN_AUTH",
+            AuthParameters={
+                'REFRESH_TOKEN': refresh_token
+            }
+        )
+        auth_result = response['AuthenticationResult']
+        access_token = auth_result['AccessToken']
+        refreshed_tokens = SigninResponse(
+            access_token,
+            # RefreshToken is not included in the result unless refresh token rotation is enabled in the User Pool.
+            # https://docs.aws.amazon.com/cognito/latest/developerguide/amazon-cognito-user-pools-using-the-refresh-token.html
+            auth_result.get('RefreshToken', refresh_token),
+            jwt.get_unverified_claims(access_token)
+        )
+        __refreshed_tokens_cache.set(refresh_token_digest, refreshed_tokens,
+                                     expires_at=time.time() + REFRESHED_TOKENS_REUSE_SECONDS)
+        inflight.set_result(refreshed_tokens)
+        return refreshed_tokens
+    except Exception as e:
+        inflight.set_exception(e)
+        raise e
+    finally:
+        with __inflight_refreshes_lock:
+            __inflight_refreshes.pop(refresh_token_digest, None)
+
+
+def is_access_token_expiring(access_token: Optional[str], within_seconds: int) -> bool:
+    """Returns True if the access token has expired or expires within the given seconds. The signature is not verified here."""
+    if access_token is None:
+        return False
+    try:
+        exp = jwt.get_unverified_claims(access_token).get("exp")
+    except JWTError:
+        return False
+    return isinstance(exp, (int, float)) and exp - time.time() <= within_seconds
+
+
 def delete_user(access_token: str, fastApiResponse: Response):
     try:
         # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/cognito-idp/client/delete_user.html
         cognito_client.delete_user(
             AccessToken=access_token
         )
+        # The token is revoked by deleting the user, so it must not be accepted from the cache any more.
+        __claims_cache.delete(get_token_digest(access_token))
     except cognito_client.exceptions.NotAuthorizedException:
         print("Invalid access token. User deletion failed.")
-        delete_tokens_from_cookie(fastApiResponse)
+        delete_tokens_from_cookie(fastApiResponse, access_token)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="アクセストークンが無効なため、ユーザーの削除に失敗しました。"
@@ -300,9 +725,13 @@ def delete_user(access_token: str, fastApiResponse: Response):
 
 # Signout API endpoint is unnecessary because each client (ex: Web browsers, App) can delete the access token and refresh token in Cookie by itself when a user signs out.
 # https://qiita.com/wasnot/items/949c6c4efe43ca0fa1cc
-def delete_tokens_from_cookie(fastApiResponse: Response):
+def delete_tokens_from_cookie(fastApiResponse: Response, access_token: Optional[str] = None):
+    if access_token is not None:
+        # Drop the verified claims of the token so that the token is verified again if it is sent after signing out.
+        __claims_cache.delete(get_token_digest(access_token))
     fastApiResponse.delete_cookie('access_token')
     fastApiResponse.delete_cookie('refresh_token')
+    fastApiResponse.delete_cookie(SESSION_COOKIE_KEY)
     # try:
     #     # Signs out users from all devices
     #     # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/cognito-idp/client/global_sign_out.html
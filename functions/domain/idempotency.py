@@ -0,0 +1,123 @@
+import os
+import sys
+import json
+import time
+import hashlib
+from typing import Any, Callable, Optional
+from botocore.exceptions import ClientError
+from fastapi import HTTPException, status
+
+ROOT_DIR_PATH = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR_PATH)
+
+from conf.env import STAGE, IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_LOCK_SECONDS
+from utils.aws import dynamodb_resource
+from utils.dynamodb import is_conditional_check_failed, get_item_on_condition_check_failure
+
+# Idempotency-Key header lets the client retry a request which creates something (ex: a post or a booking) safely.
+# The first request runs the operation and its result is stored, and the retries with the same key get the stored result
+# instead of running the operation again.
+# https://datatracker.ietf.org/doc/draft-ietf-httpapi-idempotency-key-header/
+# https://docs.aws.amazon.com/ja_jp/powertools/python/latest/utilities/idempotency/
+
+IDEMPOTENCY_KEY_HEADER = "Idempotency-Key"
+# Same as the limit of Stripe
+__MAX_IDEMPOTENCY_KEY_LENGTH = 255
+STATUS_IN_PROGRESS = "IN_PROGRESS"
+STATUS_COMPLETED = "COMPLETED"
+
+__table = dynamodb_resource.Table(f"terakoya-{STAGE}-idempotency")
+
+
+def __fingerprint(request_data: Any) -> str:
+    return hashlib.sha256(json.dumps(request_data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def __lock(record_key: str, fingerprint: str) -> Optional[dict]:
+    """Returns None if the lock is acquired, otherwise the existing record."""
+    now = int(time.time())
+    try:
+        # The conditional put lets only one of the concurrent requests with the same key run the operation.
+        __table.put_item(
+            Item={
+                "key": record_key,
+                "status": STATUS_IN_PROGRESS,
+                "fingerprint": fingerprint,
+                # The request which has crashed (ex: timeout of Lambda) releases the lock at locked_until.
+                "locked_until": now + IDEMPOTENCY_LOCK_SECONDS,
+                # The record is deleted by TTL of DynamoDB, which can be later than expires_at.
+                # https://docs.aws.amazon.com/ja_jp/amazondynamodb/latest/developerguide/TTL.html
+                "expires_at": now + IDEMPOTENCY_TTL_SECONDS,
+            },
+            ConditionExpression="attribute_not_exists(#key) OR expires_at < :now OR (#status = :in_progress AND locked_until < :now)",
+            ExpressionAttributeNames={
+                "#key": "key",
+                "#status": "status",
+            },
+            ExpressionAttributeValues={
+                ":now": now,
+                ":in_progress": STATUS_IN_PROGRESS,
+            },
+            ReturnValuesOnConditionCheckFailure="ALL_OLD"
+        )
+        return None
+    except ClientError as e:
+        if is_conditional_check_failed(e):
+            return get_item_on_condition_check_failure(e) or {}
+        raise e
+
+
+def run_idempotently(idempotency_key: Optional[str], scope: str, owner: str, request_data: Any, func: Callable[[], Any]) -> Any:
+    """
+    Run func() only once per idempotency_key within IDEMPOTENCY_TTL_SECONDS and return its result, which must be JSON serializable.
+    - The same key with the same request_data returns the stored result of the first request.
+    - The same key while the first request is running: 409
+    - The same key with different request_data: 422
+    func() runs as it is without the key. The record is deleted when func() fails, so that the client can retry with the same key.
+    scope (ex: "post-timeline") and owner (ex: UID of the user) keep the keys of different operations and users separately.
+    request_data must not have the values generated per request (ex: post_id), which makes every retry look different.
+    """
+    if not idempotency_key:
+        return func()
+    if len(idempotency_key) > __MAX_IDEMPOTENCY_KEY_LENGTH:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"{IDEMPOTENCY_KEY_HEADER}は{__MAX_IDEMPOTENCY_KEY_LENGTH}文字以内で指定して下さい。")
+
+    record_key = f"{scope}#{owner}#{idempotency_key}"
+    fingerprint = __fingerprint(request_data)
+    existing = __lock(record_key, fingerprint)
+    if existing is not None:
+        # existing is empty if the record has been deleted since the condition failed, which is handled as in progress.
+        if existing and existing.get("fingerprint") != fingerprint:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                                detail=f"同じ{IDEMPOTENCY_KEY_HEADER}で異なるリクエストが送信されました。")
+        if existing.get("status") == STATUS_COMPLETED:
+            print(f"Replay the stored result. key: {record_key}")
+            # The result is stored as a JSON string, so it's replayed as it was without being converted to Decimal.
+            return json.loads(existing["result"])
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail="同じリクエストを処理中です。しばらく時間をおいてから再度お試し下さい。")
+
+    try:
+        result = func()
+    except Exception as e:
+        __table.delete_item(Key={"key": record_key})
+        raise e
+
+    try:
+        __table.update_item(
+            Key={"key": record_key},
+            UpdateExpression="SET #status = :completed, #result = :result REMOVE locked_until",
+            ExpressionAttributeNames={
+                "#status": "status",
+                "#result": "result",
+            },
+            ExpressionAttributeValues={
+                ":completed": STATUS_COMPLETED,
+                ":result": json.dumps(result, default=str),
+            }
+        )
+    except ClientError as e:
+        # The operation has succeeded, so its result is returned. The retry after locked_until runs the operation again.
+        print(f"Failed to store the result of the idempotent request. key: {record_key}, Error message: {str(e)}")
+    return result
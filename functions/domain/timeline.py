@@ -1,144 +1,520 @@
 import os
 import sys
-from typing import List, Optional, TypeVar
+import json
+import time
+import zlib
+import random
+import heapq
+import base64
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type, TypeVar
+from botocore.exceptions import ClientError
 from fastapi import HTTPException, status
 from pydantic.generics import GenericModel, Generic, BaseModel
 
 ROOT_DIR_PATH = os.path.dirname(os.path.dirname(__file__))
 sys.path.append(ROOT_DIR_PATH)
 
-from utils.aws import dynamodb_resource
-from models.timeline import PK_FOR_ALL_POST_GSI, PostItem, CommentItem, Reaction
-from conf.env import STAGE
+from utils.aws import dynamodb_resource, s3_client
+from utils.cache import ICacheBackend, create_cache_backend
+from utils.dt import DT
+from utils.dynamodb import is_conditional_check_failed, get_item_on_condition_check_failure, get_cancellation_reason_codes
+from models.timeline import ACTIVE_UUID, COUNTERS_UPDATED_AT, REACTION_BY_USER, REACTION_COUNT_ATTRIBUTES, PostItem, CommentItem, Reaction, count_reactions, timestamp_from_item_id, post_gsi_shard_keys
+from conf.env import STAGE, TIMELINE_LIST_DEFAULT_LIMIT, TIMELINE_LIST_MAX_LIMIT, TIMELINE_BATCH_MAX_IDS, TIMELINE_REACTION_COUNTERS_BACKFILLED, TIMELINE_PREVIEW_COMMENTS_MAX, TIMELINE_PREVIEW_COMMENTS_MAX_WORKERS, TIMELINE_CACHE_BACKEND, TIMELINE_CACHE_TTL_SECONDS, TIMELINE_CACHE_MAX_SIZE, TIMELINE_CACHE_LIST_PAGES, S3_TERAKOYA_BUCKET_NAME, TIMELINE_TEXTS_COMPRESSION_THRESHOLD_BYTES, TIMELINE_TEXTS_OFFLOAD_THRESHOLD_BYTES, TIMELINE_TEXTS_PREVIEW_LENGTH
 
 __post_table = dynamodb_resource.Table(f"terakoya-{STAGE}-timeline-post")
 __comment_table = dynamodb_resource.Table(f"terakoya-{STAGE}-timeline-comment")
 
+# Read cache of the first TIMELINE_CACHE_LIST_PAGES pages of fetch_timeline_list() and of fetch_timeline_item(),
+# which most of the reads of the timeline hit. The writes to the posts invalidate them.
+# - Post: the entry per post_id is deleted.
+# - Pages: the key of every page has the generation, and a new generation invalidates all pages at once without knowing their keys.
+#   A page read before the write and stored after it is stored with the old generation, so it's never returned.
+#   The key of the pages with comment_previews also has the generation of the previews, which only the writes to comments change,
+#   so that they don't invalidate the pages without comment_previews.
+# Writes to the posts (including reactions and comment_count) invalidate the post and all pages,
+# and writes to the comments only shown in comment_previews (edits and reactions) invalidate the pages with comment_previews.
+# Writes from outside this module (ex: handlers/timeline/reconcile_counters.py) are reflected after TIMELINE_CACHE_TTL_SECONDS.
+__cache: ICacheBackend = create_cache_backend(TIMELINE_CACHE_BACKEND, max_size=TIMELINE_CACHE_MAX_SIZE)
+__LIST_GENERATION_CACHE_KEY = "timeline:list-generation"
+__PREVIEW_GENERATION_CACHE_KEY = "timeline:preview-generation"
+
+
+def __post_cache_key(post_id: str) -> str:
+    return f"timeline:post:{post_id}"
+
+
+def __generation(key: str) -> str:
+    generation = __cache.get(key)
+    if generation is None:
+        generation = __new_generation(key)
+    return generation
+
+
+def __new_generation(key: str) -> str:
+    generation = os.urandom(8).hex()
+    # The generation lives as long as the pages, which are unreachable after it expires anyway.
+    __cache.set(key, generation, TIMELINE_CACHE_TTL_SECONDS)
+    return generation
+
+
+def __invalidate_timeline_list():
+    __new_generation(__LIST_GENERATION_CACHE_KEY)
+
+
+def __invalidate_comment_previews():
+    """Invalidate only the pages with comment_previews, which the comments not changing comment_count of the post can change."""
+    __new_generation(__PREVIEW_GENERATION_CACHE_KEY)
+
+
+def __invalidate_post(post_id: str):
+    """Invalidate the post and the pages which can have it."""
+    __cache.delete(__post_cache_key(post_id))
+    __invalidate_timeline_list()
+
+
+def __read_through(key: str, fetch: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+    cached = __cache.get(key)
+    if cached is not None:
+        return cached
+    value = fetch()
+    __cache.set(key, value, TIMELINE_CACHE_TTL_SECONDS)
+    return value
+
+
+def use_timeline_cache_backend(backend: ICacheBackend):
+    """Only for testing"""
+    global __cache
+    __cache = backend
+
+
+# Storage codec of texts. Long texts are stored in either of the following attributes, and texts of the item is its preview.
+# - texts_compressed: texts compressed with zlib (Binary)
+# - texts_s3_key: key of the object of S3_TERAKOYA_BUCKET_NAME which has the compressed texts
+# get_item() restores the whole texts by __decode_texts(). The listing returns the preview as it is without reading S3,
+# and PostItem/CommentItem drops these attributes from the response because they are not the fields of the model.
+# https://docs.aws.amazon.com/ja_jp/amazondynamodb/latest/developerguide/bp-use-s3-too.html
+TEXTS_COMPRESSED = "texts_compressed"
+TEXTS_S3_KEY = "texts_s3_key"
+__TEXTS_CODEC_ATTRIBUTES = [TEXTS_COMPRESSED, TEXTS_S3_KEY]
+
+
+def __texts_object_key(item_id: str, version: int) -> str:
+    # The key differs per version, so that the edit never overwrites the object which the current item refers to.
+    return f"api/timeline/texts/{STAGE}/{item_id}/{version}.zlib"
+
+
+def __encode_texts(texts: str, item_id: str, version: int) -> Dict[str, Any]:
+    """
+    Returns the attributes of texts to be stored in the item: texts and is_texts_truncated, plus either of __TEXTS_CODEC_ATTRIBUTES if texts is long.
+    The object of S3 is uploaded before the item refers to it, so __discard_texts_object() must be called if the write of the item fails.
+    """
+    encoded = texts.encode("utf-8")
+    if len(encoded) <= TIMELINE_TEXTS_COMPRESSION_THRESHOLD_BYTES:
+        return {"texts": texts, "is_texts_truncated": False}
+
+    attributes: Dict[str, Any] = {"texts": texts[:TIMELINE_TEXTS_PREVIEW_LENGTH], "is_texts_truncated": True}
+    compressed = zlib.compress(encoded)
+    if len(compressed) <= TIMELINE_TEXTS_OFFLOAD_THRESHOLD_BYTES:
+        # bytes is serialized as Binary type of DynamoDB.
+        attributes[TEXTS_COMPRESSED] = compressed
+        return attributes
+
+    if S3_TERAKOYA_BUCKET_NAME is None:
+        raise Exception("S3_TERAKOYA_BUCKET_NAME is not defined")
+    object_key = __texts_object_key(item_id, version)
+    s3_client.put_object(Bucket=S3_TERAKOYA_BUCKET_NAME, Key=object_key, Body=compressed, ContentType="application/zlib")
+    attributes[TEXTS_S3_KEY] = object_key
+    return attributes
+
+
+def __decode_texts(item: Dict[str, Any]) -> Dict[str, Any]:
+    """Returns the item read by get_item() whose texts is the whole texts restored from __TEXTS_CODEC_ATTRIBUTES."""
+    if TEXTS_S3_KEY in item:
+        if S3_TERAKOYA_BUCKET_NAME is None:
+            raise Exception("S3_TERAKOYA_BUCKET_NAME is not defined")
+        compressed = s3_client.get_object(Bucket=S3_TERAKOYA_BUCKET_NAME, Key=item[TEXTS_S3_KEY])["Body"].read()
+    elif TEXTS_COMPRESSED in item:
+        # Binary type of DynamoDB is deserialized into Binary of boto3.
+        compressed = bytes(item[TEXTS_COMPRESSED])
+    else:
+        return item
+    return {**item, "texts": zlib.decompress(compressed).decode("utf-8"), "is_texts_truncated": False}
+
+
+def __discard_texts_object(object_key: Optional[str]):
+    """Delete the object of S3 which no item refers to. The failure is only logged because it leaves just an unused object."""
+    if object_key is None or S3_TERAKOYA_BUCKET_NAME is None:
+        return
+    try:
+        s3_client.delete_object(Bucket=S3_TERAKOYA_BUCKET_NAME, Key=object_key)
+    except ClientError as e:
+        print(f"Failed to delete the object of texts. key: {object_key}, Error message: {str(e)}")
+
 
 def post_timeline_item(post: PostItem):
-    __post_table.put_item(Item=post.dict())
+    item = {**post.to_dynamodb_item(), **__encode_texts(post.texts, post.post_id, post.version)}
+    try:
+        __post_table.put_item(Item=item)
+    except Exception as e:
+        __discard_texts_object(item.get(TEXTS_S3_KEY))
+        raise e
+    __invalidate_timeline_list()
     return {"post_id": post.post_id}
 
 
-def post_comment_item(post_id: str, comment: CommentItem):
-    __comment_table.put_item(Item=comment.dict())
-    __post_table.update_item(
-        Key={
-            "post_id": post_id
-        },
-        UpdateExpression="ADD comment_count :val",
-        ExpressionAttributeValues={
-            ":val": 1
-        }
-    )
+# Comment and comment_count of the post are written in one TransactWriteItems, so that the counter never drifts
+# when one of two separate writes fails, and it takes one round trip instead of two.
+# The client of the resource serializes Python values in the request like the Table resource does.
+# https://docs.aws.amazon.com/ja_jp/amazondynamodb/latest/developerguide/transaction-apis.html
+__transact_write_items = dynamodb_resource.meta.client.transact_write_items
+__CONDITIONAL_CHECK_FAILED = "ConditionalCheckFailed"
 
+
+def __not_deleted_condition(key_name: str) -> Tuple[str, Dict[str, int]]:
+    """
+    ConditionExpression and its ExpressionAttributeValues shared by the writes to the post/comment which must exist and not be deleted.
+    attribute_not_exists(is_deleted) is for the items created before is_deleted was added.
+    """
+    return f"attribute_exists({key_name}) AND (attribute_not_exists(is_deleted) OR is_deleted = :is_deleted_false)", {":is_deleted_false": 0}
+
+
+def post_comment_item(post_id: str, comment: CommentItem):
+    comment.post_id = post_id
+    item = {**comment.to_dynamodb_item(), **__encode_texts(comment.texts, comment.comment_id, comment.version)}
+    post_condition, post_condition_values = __not_deleted_condition("post_id")
+    try:
+        __transact_write_items(TransactItems=[
+            {
+                "Put": {
+                    "TableName": __comment_table.name,
+                    "Item": item,
+                    "ConditionExpression": "attribute_not_exists(comment_id)",
+                }
+            },
+            {
+                "Update": {
+                    "TableName": __post_table.name,
+                    "Key": {
+                        "post_id": post_id
+                    },
+                    "UpdateExpression": "SET #counters_updated_at = :now ADD comment_count :val",
+                    # Reject a comment on the post which doesn't exist or has been deleted without reading it beforehand.
+                    "ConditionExpression": post_condition,
+                    "ExpressionAttributeNames": {
+                        "#counters_updated_at": COUNTERS_UPDATED_AT
+                    },
+                    "ExpressionAttributeValues": {
+                        ":val": 1,
+                        ":now": DT.CURRENT_TIMESTAMP_MS,
+                        **post_condition_values
+                    }
+                }
+            },
+        ])
+    except ClientError as e:
+        __discard_texts_object(item.get(TEXTS_S3_KEY))
+        reason_codes = get_cancellation_reason_codes(e)
+        if len(reason_codes) == 2 and reason_codes[1] == __CONDITIONAL_CHECK_FAILED:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f"指定された投稿は存在しないか削除されています。\npost_id: {post_id}")
+        if len(reason_codes) == 2 and reason_codes[0] == __CONDITIONAL_CHECK_FAILED:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                                detail=f"同じIDのコメントが既に存在します。\ncomment_id: {comment.comment_id}")
+        raise e
+
+    # comment_count of the post has changed.
+    __invalidate_post(post_id)
     return {"comment_id": comment.comment_id}
 
 
 def delete_logical_timeline_item(post_id: str):
-    __post_table.update_item(Key={
-        "post_id": post_id
-    },
-        UpdateExpression="set is_deleted = :is_deleted_true",
-        ExpressionAttributeValues={
-        ":is_deleted_true": 1
-    })
+    condition, condition_values = __not_deleted_condition("post_id")
+    try:
+        __post_table.update_item(Key={
+            "post_id": post_id
+        },
+            # Removing the partition keys of the sparse GSIs drops the post from them.
+            # Then the listing queries never read it and every page is filled with the posts not deleted.
+            UpdateExpression="SET is_deleted = :is_deleted_true REMOVE pk_for_all_post_gsi, #active_uuid",
+            ConditionExpression=condition,
+            ExpressionAttributeNames={
+            "#active_uuid": ACTIVE_UUID
+        },
+            ExpressionAttributeValues={
+            ":is_deleted_true": 1,
+            **condition_values
+        })
+    except ClientError as e:
+        if is_conditional_check_failed(e):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f"指定された投稿は存在しないか削除されています。\npost_id: {post_id}")
+        raise e
+    __invalidate_post(post_id)
 
 
 def delete_logical_comment_item(post_id: str, comment_id: str):
-    __comment_table.update_item(Key={
-        "comment_id": comment_id
-    },
-        UpdateExpression="set is_deleted = :is_deleted_true",
-        ExpressionAttributeValues={
-        ":is_deleted_true": 1
-    })
-    __post_table.update_item(
-        Key={
-            "post_id": post_id
-        },
-        UpdateExpression="ADD comment_count :val",
-        ExpressionAttributeValues={
-            ":val": -1
-        }
-    )
+    comment_condition, comment_condition_values = __not_deleted_condition("comment_id")
+    try:
+        __transact_write_items(TransactItems=[
+            {
+                "Update": {
+                    "TableName": __comment_table.name,
+                    "Key": {
+                        "comment_id": comment_id
+                    },
+                    "UpdateExpression": "SET is_deleted = :is_deleted_true",
+                    # The condition of is_deleted makes the retry of the same deletion fail instead of decrementing comment_count twice.
+                    "ConditionExpression": f"{comment_condition} AND post_id = :post_id",
+                    "ExpressionAttributeValues": {
+                        ":post_id": post_id,
+                        ":is_deleted_true": 1,
+                        **comment_condition_values
+                    }
+                }
+            },
+            {
+                "Update": {
+                    "TableName": __post_table.name,
+                    "Key": {
+                        "post_id": post_id
+                    },
+                    "UpdateExpression": "SET #counters_updated_at = :now ADD comment_count :val",
+                    # ADD creates the item if it doesn't exist.
+                    "ConditionExpression": "attribute_exists(post_id)",
+                    "ExpressionAttributeNames": {
+                        "#counters_updated_at": COUNTERS_UPDATED_AT
+                    },
+                    "ExpressionAttributeValues": {
+                        ":val": -1,
+                        ":now": DT.CURRENT_TIMESTAMP_MS
+                    }
+                }
+            },
+        ])
+    except ClientError as e:
+        if __CONDITIONAL_CHECK_FAILED in get_cancellation_reason_codes(e):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f"指定されたコメントは存在しないか削除されています。\npost_id: {post_id}, comment_id: {comment_id}")
+        raise e
+    __invalidate_post(post_id)
+
+
+def __edit_texts(table: Any, key: Dict[str, str], texts: str, version: int, uuid: str, parent: Optional[Dict[str, str]] = None):
+    """
+    Update texts with one update_item() guarded by version (optimistic locking) without reading the item beforehand.
+    The item at the time of the failure is returned by ReturnValuesOnConditionCheckFailure to tell why the edit is rejected.
+    https://docs.aws.amazon.com/ja_jp/amazondynamodb/latest/developerguide/DynamoDBMapper.OptimisticLocking.html
+    """
+    key_name = next(iter(key))
+    # Legacy items which have never been edited don't have version.
+    version_condition = "(attribute_not_exists(#version) OR #version = :version)" if version == 0 else "#version = :version"
+    not_deleted_condition, not_deleted_values = __not_deleted_condition(key_name)
+    condition_expressions = [not_deleted_condition, "#uuid = :uuid", version_condition]
+    attribute_names = {"#version": "version", "#uuid": "uuid"}
+    attribute_values = {":version": version, ":next_version": version + 1, ":uuid": uuid, **not_deleted_values}
+    # The attributes of the codec which the new texts doesn't use are removed, so that the stale texts is never restored.
+    texts_attributes = __encode_texts(texts, key[key_name], version + 1)
+    removed_attributes = [name for name in __TEXTS_CODEC_ATTRIBUTES if name not in texts_attributes]
+    attribute_names.update({f"#{name}": name for name in [*texts_attributes.keys(), *removed_attributes]})
+    attribute_values.update({f":{name}": value for name, value in texts_attributes.items()})
+    update_expression = "SET " + ", ".join([f"#{name} = :{name}" for name in texts_attributes.keys()] + ["#version = :next_version"])
+    update_expression += " REMOVE " + ", ".join([f"#{name}" for name in removed_attributes])
+    if parent is not None:
+        # The comment must belong to the post of the path.
+        parent_name, parent_value = next(iter(parent.items()))
+        condition_expressions.append("#parent = :parent")
+        attribute_names["#parent"] = parent_name
+        attribute_values[":parent"] = parent_value
+    try:
+        response = table.update_item(
+            Key=key,
+            UpdateExpression=update_expression,
+            ConditionExpression=" AND ".join(condition_expressions),
+            ExpressionAttributeNames=attribute_names,
+            ExpressionAttributeValues=attribute_values,
+            # The previous values tell the object of S3 which the item has referred to until this edit.
+            ReturnValues="UPDATED_OLD",
+            ReturnValuesOnConditionCheckFailure="ALL_OLD"
+        )
+    except ClientError as e:
+        __discard_texts_object(texts_attributes.get(TEXTS_S3_KEY))
+        if not is_conditional_check_failed(e):
+            raise e
+        item = get_item_on_condition_check_failure(e)
+        if item is None or item.get("is_deleted", 0) != 0 or (parent is not None and item.get(parent_name) != parent_value):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f"指定された項目は存在しないか削除されています。\n{key_name}: {key[key_name]}")
+        if item.get("uuid") != uuid:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                                detail=f"投稿者以外は編集できません。\n{key_name}: {key[key_name]}")
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail=f"他の編集と競合しました。最新の内容を取得してから再度編集して下さい。\n{key_name}: {key[key_name]}, version: {int(item.get('version', 0))}")
+    __discard_texts_object(response.get("Attributes", {}).get(TEXTS_S3_KEY))
+    # The condition of version guarantees that the edit is based on the current version.
+    return {key_name: key[key_name], "version": version + 1}
+
+
+def edit_timeline_item(post_id: str, texts: str, version: int, uuid: str):
+    response = __edit_texts(__post_table, {"post_id": post_id}, texts, version, uuid)
+    __invalidate_post(post_id)
+    return response
+
+
+def edit_comment_item(post_id: str, comment_id: str, texts: str, version: int, uuid: str):
+    response = __edit_texts(__comment_table, {"comment_id": comment_id}, texts, version, uuid, parent={"post_id": post_id})
+    # The cached pages may have the comment in comment_previews.
+    __invalidate_comment_previews()
+    return response
+
+
+# Retry when the reaction of the same user is changed concurrently between the conditional updates.
+__MAX_REACTION_ATTEMPTS = 3
+
+
+def __init_reaction_by_user(table: Any, key: Dict[str, str], legacy_reactions: List[Dict[str, Any]]):
+    """Convert reactions stored as a list (legacy item) into reaction_by_user map and the counters."""
+    key_name = next(iter(key))
+    reaction_by_user = {r["uuid"]: int(r["type"]) for r in legacy_reactions}
+    counts = count_reactions(reaction_by_user)
+    try:
+        table.update_item(
+            Key=key,
+            UpdateExpression="SET #reaction_by_user = :reaction_by_user, #like_count = :like_count, #bad_count = :bad_count REMOVE #reactions",
+            # Another request may have converted it already.
+            ConditionExpression="attribute_exists(#key) AND attribute_not_exists(#reaction_by_user)",
+            ExpressionAttributeNames={
+                "#key": key_name,
+                "#reaction_by_user": REACTION_BY_USER,
+                "#reactions": "reactions",
+                "#like_count": "like_count",
+                "#bad_count": "bad_count",
+            },
+            ExpressionAttributeValues={
+                ":reaction_by_user": reaction_by_user,
+                ":like_count": counts["like_count"],
+                ":bad_count": counts["bad_count"],
+            }
+        )
+    except ClientError as e:
+        if not is_conditional_check_failed(e):
+            raise e
+
+
+def __toggle_reaction(table: Any, key: Dict[str, str], reaction: Reaction):
+    """
+    Add, change or remove (if the same type) one user's reaction with a conditional update_item() of reaction_by_user map,
+    without rewriting the whole list of reactions. It takes the same cost however many reactions the item has.
+    The counter of the reaction type (like_count or bad_count) is updated atomically in the same write, and counters_updated_at as well.
+    https://docs.aws.amazon.com/ja_jp/amazondynamodb/latest/developerguide/Expressions.UpdateExpressions.html#Expressions.UpdateExpressions.SET.AddingNestedMapAttributes
+    """
+    count_attribute = REACTION_COUNT_ATTRIBUTES.get(reaction.type)
+    if count_attribute is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"リアクションの種類が不正です。\ntype: {reaction.type}")
+    expression_attribute_names = {
+        "#reaction_by_user": REACTION_BY_USER,
+        # UID of user is used as a key of the map.
+        "#uuid": reaction.uuid,
+        "#count": count_attribute,
+        "#counters_updated_at": COUNTERS_UPDATED_AT,
+    }
+
+    for _ in range(__MAX_REACTION_ATTEMPTS):
+        try:
+            table.update_item(
+                Key=key,
+                UpdateExpression="SET #reaction_by_user.#uuid = :type, #counters_updated_at = :now ADD #count :one",
+                # attribute_exists(#reaction_by_user) also prevents update_item() from creating a new item for the nonexistent key.
+                ConditionExpression="attribute_exists(#reaction_by_user) AND attribute_not_exists(#reaction_by_user.#uuid)",
+                ExpressionAttributeNames=expression_attribute_names,
+                ExpressionAttributeValues={
+                    ":type": reaction.type,
+                    ":one": 1,
+                    ":now": DT.CURRENT_TIMESTAMP_MS,
+                },
+                # The item is returned when the condition fails, so the current reaction of the user is known without get_item().
+                ReturnValuesOnConditionCheckFailure="ALL_OLD"
+            )
+            print("Not reacted yet. So added reaction.")
+            return
+        except ClientError as e:
+            if not is_conditional_check_failed(e):
+                raise e
+            item = get_item_on_condition_check_failure(e)
+
+        if item is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f"リアクション対象の投稿またはコメントは存在しません。\n{key}")
+        if REACTION_BY_USER not in item:
+            print("Legacy item which stores reactions as a list. So converted it into reaction_by_user.")
+            __init_reaction_by_user(table, key, item.get("reactions", []))
+            continue
+        current_type = item[REACTION_BY_USER].get(reaction.uuid)
+        if current_type is None:
+            # The reaction was removed concurrently.
+            continue
+
+        try:
+            if int(current_type) == reaction.type:
+                table.update_item(
+                    Key=key,
+                    UpdateExpression="SET #counters_updated_at = :now REMOVE #reaction_by_user.#uuid ADD #count :minus_one",
+                    ConditionExpression="#reaction_by_user.#uuid = :type",
+                    ExpressionAttributeNames=expression_attribute_names,
+                    ExpressionAttributeValues={
+                        ":type": reaction.type,
+                        ":minus_one": -1,
+                        ":now": DT.CURRENT_TIMESTAMP_MS,
+                    }
+                )
+                print("Already reacted with the same reaction type. So removed reaction.")
+                return
+
+            current_count_attribute = REACTION_COUNT_ATTRIBUTES.get(int(current_type))
+            update_expression = "SET #reaction_by_user.#uuid = :type, #counters_updated_at = :now ADD #count :one"
+            if current_count_attribute is not None:
+                update_expression += ", #current_count :minus_one"
+            table.update_item(
+                Key=key,
+                UpdateExpression=update_expression,
+                ConditionExpression="#reaction_by_user.#uuid = :current_type",
+                ExpressionAttributeNames={
+                    **expression_attribute_names,
+                    **({"#current_count": current_count_attribute} if current_count_attribute is not None else {}),
+                },
+                ExpressionAttributeValues={
+                    ":type": reaction.type,
+                    ":current_type": current_type,
+                    ":one": 1,
+                    ":now": DT.CURRENT_TIMESTAMP_MS,
+                    **({":minus_one": -1} if current_count_attribute is not None else {}),
+                }
+            )
+            print("Already reacted with the different reaction type. So updated reaction.")
+            return
+        except ClientError as e:
+            if not is_conditional_check_failed(e):
+                raise e
+            # The reaction of the user was changed concurrently, so retry.
+
+    raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                        detail="リアクションが同時に更新されました。もう一度お試し下さい。")
 
 
 def put_reaction_to_timeline_item(post_id: str, reaction: Reaction):
     print(f"post_id: {post_id}, reaction: {reaction}")
-
-    post_item = __post_table.get_item(Key={
-        "post_id": post_id
-    }).get("Item", {})
-    pi = PostItem(**post_item)
-
-    same_user_reactions = [r for r in pi.reactions if r.uuid == reaction.uuid]
-
-    new_reactions = []
-    if len(same_user_reactions) == 0:
-        print("Not reacted to this post yet. So added reaction.")
-        new_reactions = pi.reactions + [reaction]
-    elif len(same_user_reactions) == 1:
-        existing_reaction = same_user_reactions[0]
-        if reaction.type == existing_reaction.type:
-            print(
-                "Already reacted to the post with the same reaction type. So removed reaction.")
-            new_reactions = [
-                r for r in pi.reactions if r.uuid != reaction.uuid]
-        else:
-            print(
-                "Already reacted to the post with the different reaction type. So updated reaction.")
-            # raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="この投稿には既に別のリアクションがされています。")
-            new_reactions = [
-                r for r in pi.reactions if r.uuid != reaction.uuid] + [reaction]
-
-    __post_table.update_item(
-        Key={
-            "post_id": post_id
-        },
-        UpdateExpression="SET reactions = :val",
-        ExpressionAttributeValues={
-            ":val": [r.dict() for r in new_reactions]
-        }
-    )
+    __toggle_reaction(__post_table, {"post_id": post_id}, reaction)
+    # like_count/bad_count of the post in the pages have changed as well.
+    __invalidate_post(post_id)
 
 
 def put_reaction_to_comment_item(comment_id: str, reaction: Reaction):
     print(f"comment_id: {comment_id}, reaction: {reaction}")
-
-    comment_item = __comment_table.get_item(Key={
-        "comment_id": comment_id
-    }).get("Item", {})
-    ci = CommentItem(**comment_item)
-
-    same_user_reactions = [r for r in ci.reactions if r.uuid == reaction.uuid]
-
-    new_reactions = []
-    if len(same_user_reactions) == 0:
-        print("Not reacted to this comment yet. So added reaction.")
-        new_reactions = ci.reactions + [reaction]
-    elif len(same_user_reactions) == 1:
-        existing_reaction = same_user_reactions[0]
-        if reaction.type == existing_reaction.type:
-            print(
-                "Already reacted to this comment with same reaction type. So removed reaction.")
-            new_reactions = [
-                r for r in ci.reactions if r.uuid != reaction.uuid]
-        else:
-            print("Already reacted to this comment with different reaction type.")
-            # raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="この投稿には既に別のリアクションがされています。")
-            new_reactions = [
-                r for r in ci.reactions if r.uuid != reaction.uuid] + [reaction]
-
-    __comment_table.update_item(
-        Key={
-            "comment_id": comment_id
-        },
-        UpdateExpression="SET reactions = :val",
-        ExpressionAttributeValues={
-            ":val": [r.dict() for r in new_reactions]
-        }
-    )
+    __toggle_reaction(__comment_table, {"comment_id": comment_id}, reaction)
+    # The cached pages may have the counters of the comment in comment_previews.
+    __invalidate_comment_previews()
 
 
 T = TypeVar("T", bound=BaseModel)
@@ -148,79 +524,369 @@ class FetchListResponseBody(GenericModel, Generic[T]):
     items: List[T]
     last_evaluated_timestamp: Optional[int]
     last_evaluated_id: Optional[str]
+    last_evaluated_cursor: Optional[str] = None
+    """Opaque cursor of the next page, which is given as "cursor" of the next request. None if it's the last page."""
     count: int
+    comment_previews: Optional[Dict[str, List[CommentItem]]] = None
+    """Newest comments by post_id of the items, only if preview_comments is given. The posts without comments are not included."""
+
+
+class FetchDetailResponseBody(BaseModel):
+    post: PostItem
+    comments: FetchListResponseBody[CommentItem]
+    """The first page of the comments of the post"""
+
+
+class FetchBatchResponseBody(BaseModel):
+    items: List[PostItem]
+    """Posts in the order of the requested IDs"""
+    missing_ids: List[str]
+    """Requested IDs of the posts which don't exist or have been deleted"""
+
+
+def __add_projection_without_reactions(query_params: Dict[str, Any], model: Type[BaseModel]):
+    """
+    Fetch the attributes except reactions so that the response carries only like_count and bad_count.
+    ProjectionExpression reduces the size of the response, though RCU of Query is still calculated by the size of the whole items.
+    https://docs.aws.amazon.com/ja_jp/amazondynamodb/latest/developerguide/Expressions.ProjectionExpressions.html
+    Until the counters are backfilled, reactions are still fetched and dropped by __counts_only() after they are counted.
+    """
+    excluded = ("reactions", REACTION_BY_USER) if TIMELINE_REACTION_COUNTERS_BACKFILLED else ()
+    attribute_names = [name for name in model.__fields__.keys() if name not in excluded]
+    # Every attribute name is replaced with a placeholder because some of them are reserved words (ex: timestamp).
+    # https://docs.aws.amazon.com/ja_jp/amazondynamodb/latest/developerguide/ReservedWords.html
+    query_params["ProjectionExpression"] = ", ".join([f"#projection_{name}" for name in attribute_names])
+    query_params["ExpressionAttributeNames"] = {
+        **query_params.get("ExpressionAttributeNames", {}),
+        **{f"#projection_{name}": name for name in attribute_names},
+    }
+
+
+def __counts_only(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Drop the reactions of the items fetched with __add_projection_without_reactions(), counting them if the item has no counters."""
+    for item in items:
+        # Legacy item stores reactions as a list instead of reaction_by_user (tools/timeline_migration.py reactions).
+        reactions = item.pop("reactions", None) or []
+        reaction_by_user = item.pop(REACTION_BY_USER, None) or {r["uuid"]: r["type"] for r in reactions}
+        if not any([count_attribute in item for count_attribute in REACTION_COUNT_ATTRIBUTES.values()]):
+            item.update(count_reactions(reaction_by_user))
+    return items
+
+
+# Each shard of timeline-post-all GSI is queried in parallel (scatter) and the results are merged in newest-first order (gather).
+# Table resource is not thread-safe, but the client is. The client of the resource serializes Python values like the Table resource does.
+# https://boto3.amazonaws.com/v1/documentation/api/latest/guide/clients.html#multithreading-or-multiprocessing-with-clients
+__client = dynamodb_resource.meta.client
+__shard_executor = ThreadPoolExecutor(max_workers=len(post_gsi_shard_keys()))
+
 
+# Cursor of the listing is an opaque token (base64url of JSON) which the client only passes back as "cursor" of the next page,
+# so that the layout of the tables and GSIs can change without breaking the clients.
+# "v" is the version of the format and "kind" is the listing which issued it. A cursor of another version or listing is rejected.
+__CURSOR_VERSION = 1
+__CURSOR_KIND_TIMELINE = "timeline"
+__CURSOR_KIND_TIMELINE_BY_USER = "timeline-by-user"
+__CURSOR_KIND_COMMENT = "comment"
 
-def fetch_timeline_list(timestamp: Optional[int] = None, post_id: Optional[str] = None):
-    print(f"timestamp: {timestamp}")
 
+def __page_limit(limit: Optional[int]) -> int:
+    if limit is None:
+        return TIMELINE_LIST_DEFAULT_LIMIT
+    if not 1 <= limit <= TIMELINE_LIST_MAX_LIMIT:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"limitは1以上{TIMELINE_LIST_MAX_LIMIT}以下で指定して下さい。\nlimit: {limit}")
+    return limit
+
+
+def __invalid_cursor(cursor: str) -> HTTPException:
+    return HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"不正なカーソルです。\ncursor: {cursor}")
+
+
+def __is_int(value: Any) -> bool:
+    # bool is a subclass of int, but true/false of JSON is not a timestamp.
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def __is_shard_position(position: Any) -> bool:
+    """[timestamp, post_id] of a shard, which becomes ExclusiveStartKey as it is, so a value of another type must not reach DynamoDB."""
+    return isinstance(position, list) and len(position) == 2 and __is_int(position[0]) and isinstance(position[1], str)
+
+
+def __encode_cursor(kind: str, body: Dict[str, Any]) -> str:
+    # Numbers of the items read by the Table resource are Decimal. Every number in the keys is an integer (timestamp).
+    encoded = json.dumps({"v": __CURSOR_VERSION, "kind": kind, **body}, default=int, separators=(",", ":"))
+    return base64.urlsafe_b64encode(encoded.encode()).decode()
+
+
+def __decode_cursor(cursor: str, kind: str) -> Dict[str, Any]:
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise __invalid_cursor(cursor)
+    if not isinstance(decoded, dict):
+        raise __invalid_cursor(cursor)
+    if decoded.get("v") != __CURSOR_VERSION or decoded.get("kind") != kind:
+        raise __invalid_cursor(cursor)
+    return decoded
+
+
+def __encode_key_cursor(kind: str, last_evaluated_key: Optional[Dict[str, Any]]) -> Optional[str]:
+    """Cursor which has LastEvaluatedKey of the Query as it is, or None if it's the last page."""
+    return __encode_cursor(kind, {"key": last_evaluated_key}) if last_evaluated_key else None
+
+
+def __decode_key_cursor(cursor: str, kind: str, partition_key: Tuple[str, str], key_names: List[str]) -> Dict[str, Any]:
+    """
+    Returns ExclusiveStartKey restored from the cursor.
+    The key must be of the same partition as the request (ex: the cursor of another user's posts is rejected),
+    and have exactly the key attributes of the GSI and the table, i.e., timestamp of int and the IDs of str.
+    """
+    key = __decode_cursor(cursor, kind).get("key")
+    partition_key_name, partition_key_value = partition_key
+    if not isinstance(key, dict) or set(key.keys()) != {partition_key_name, *key_names} or key[partition_key_name] != partition_key_value:
+        raise __invalid_cursor(cursor)
+    if not all([__is_int(key[name]) if name == "timestamp" else isinstance(key[name], str) for name in key_names]):
+        raise __invalid_cursor(cursor)
+    return key
+
+
+def __encode_shard_cursor(positions: Dict[str, Optional[List[Any]]], before: Optional[int], page: Optional[int]) -> str:
+    """page is the number of the page which the cursor points (the first page is 0, None if unknown), which tells whether the page is cached."""
+    return __encode_cursor(__CURSOR_KIND_TIMELINE, {"positions": positions, "before": before, "page": page})
+
+
+def __decode_shard_cursor(cursor: str) -> Tuple[Dict[str, Optional[List[Any]]], Optional[int], Optional[int]]:
+    decoded = __decode_cursor(cursor, __CURSOR_KIND_TIMELINE)
+    if not {"positions", "before", "page"} <= decoded.keys():
+        raise __invalid_cursor(cursor)
+    positions, before, page = decoded["positions"], decoded["before"], decoded["page"]
+    # page is None in the cursors which continue the legacy timestamp and post_id.
+    if not isinstance(positions, dict) or not (before is None or __is_int(before)) or not (page is None or (__is_int(page) and page >= 0)):
+        raise __invalid_cursor(cursor)
+    shard_keys = post_gsi_shard_keys()
+    for shard_key, position in positions.items():
+        if shard_key not in shard_keys or not (position is None or __is_shard_position(position)):
+            raise __invalid_cursor(cursor)
+    return positions, before, page
+
+
+def __query_post_gsi_shard(shard_key: str, position: Optional[List[Any]], timestamp_condition: Optional[Tuple[str, int]], counts_only: bool, limit: int):
     query_params = {
+        "TableName": __post_table.name,
         "IndexName": f"terakoya-{STAGE}-timeline-post-all",
         "KeyConditionExpression": 'pk_for_all_post_gsi = :value',
         # Filtering with is_deleted = 0 is not allowed because it is not a part of the partition key.
         # "KeyConditionExpression": 'pk_for_all_post_gsi = :value and is_deleted = :is_deleted_false',
         "ExpressionAttributeValues": {
-            ':value': PK_FOR_ALL_POST_GSI
+            ':value': shard_key
         },
-        "Limit": 20,
+        # Any shard can have all items of the page.
+        "Limit": limit,
         # The result of query() is sorted by sort key in ascending order by default.
         # But ScanIndexForward=False makes it descending order. If sort key is timestamp, it means latest first.
         # https://docs.aws.amazon.com/ja_jp/amazondynamodb/latest/developerguide/Query.html#Query.KeyConditionExpressions
         "ScanIndexForward": False,
     }
-
-    if timestamp and post_id:
+    if position is not None:
         query_params["ExclusiveStartKey"] = {
-            "pk_for_all_post_gsi": PK_FOR_ALL_POST_GSI,
-            "timestamp": timestamp,
-            "post_id": post_id
+            "pk_for_all_post_gsi": shard_key,
+            "timestamp": position[0],
+            "post_id": position[1]
         }
+    elif timestamp_condition is not None:
+        operator, timestamp = timestamp_condition
+        query_params["KeyConditionExpression"] += f" AND #timestamp {operator} :timestamp"
+        query_params["ExpressionAttributeNames"] = {"#timestamp": "timestamp"}
+        query_params["ExpressionAttributeValues"][":timestamp"] = timestamp
 
-    response = __post_table.query(**query_params)
-    IS_NOT_DELETED = 0
-    active_posts = [p for p in response.get("Items", []) if p.get(
-        "is_deleted", IS_NOT_DELETED) == IS_NOT_DELETED]
+    if counts_only:
+        __add_projection_without_reactions(query_params, PostItem)
+
+    response = __client.query(**query_params)
+    if counts_only:
+        __counts_only(response.get("Items", []))
+    return response
+
+
+# Comment previews of the posts of a page are fetched with a query per post in parallel instead of a request per post from the client (N+1).
+# The executor is separate from __shard_executor, which may be busy with the shards of the other requests.
+__preview_executor = ThreadPoolExecutor(max_workers=TIMELINE_PREVIEW_COMMENTS_MAX_WORKERS)
 
-    last_evaluated_key = response.get("LastEvaluatedKey", None)
-    timestamp = last_evaluated_key.get(
-        "timestamp", None) if last_evaluated_key else None
-    post_id = last_evaluated_key.get(
-        "post_id", None) if last_evaluated_key else None
+
+def __preview_count(preview_comments: int) -> int:
+    if not 0 <= preview_comments <= TIMELINE_PREVIEW_COMMENTS_MAX:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"preview_commentsは0以上{TIMELINE_PREVIEW_COMMENTS_MAX}以下で指定して下さい。\npreview_comments: {preview_comments}")
+    return preview_comments
+
+
+def __query_comment_preview(post_id: str, count: int, counts_only: bool) -> List[Dict[str, Any]]:
+    query_params = {
+        "TableName": __comment_table.name,
+        "IndexName": f"terakoya-{STAGE}-timeline-comment-for-post",
+        "KeyConditionExpression": 'post_id = :value',
+        # The deleted comments are kept in timeline-comment-for-post GSI, so they are filtered out.
+        "FilterExpression": 'attribute_not_exists(is_deleted) OR is_deleted = :is_deleted_false',
+        "ExpressionAttributeValues": {
+            ':value': post_id,
+            ':is_deleted_false': 0
+        },
+        "Limit": count,
+        "ScanIndexForward": False,
+    }
+    if counts_only:
+        __add_projection_without_reactions(query_params, CommentItem)
+    # Limit is applied before FilterExpression, so a page can have fewer comments than count if some of them are deleted.
+    # The next pages are read until count comments are collected or the comments of the post run out.
+    # https://docs.aws.amazon.com/ja_jp/amazondynamodb/latest/developerguide/Query.FilterExpression.html
+    comments = []
+    while True:
+        response = __client.query(**query_params)
+        comments += response.get("Items", [])
+        if len(comments) >= count or "LastEvaluatedKey" not in response:
+            break
+        query_params["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    if counts_only:
+        __counts_only(comments)
+    return comments[:count]
+
+
+def __fetch_comment_previews(posts: List[Dict[str, Any]], count: int, counts_only: bool) -> Optional[Dict[str, List[Dict[str, Any]]]]:
+    """Returns the newest count comments by post_id. The posts whose comment_count is 0 are skipped without the query."""
+    if count == 0:
+        return None
+    futures = {p["post_id"]: __preview_executor.submit(__query_comment_preview, p["post_id"], count, counts_only)
+               for p in posts if p.get("comment_count", 0) > 0}
+    previews = {post_id: f.result() for post_id, f in futures.items()}
+    return {post_id: comments for post_id, comments in previews.items() if comments}
+
+
+def fetch_timeline_list(timestamp: Optional[int] = None, post_id: Optional[str] = None, counts_only: bool = False, cursor: Optional[str] = None, limit: Optional[int] = None, preview_comments: int = 0):
+    """
+    Fetch the latest posts (limit per page) from all shards of timeline-post-all GSI.
+    cursor (last_evaluated_cursor of the previous page) holds the position per shard:
+    - [timestamp, post_id]: the last item of the shard returned, which is ExclusiveStartKey of the shard.
+    - None: the shard has been read to the end.
+    - missing: no item of the shard has been returned yet, so the shard is read from "before" (the timestamp of the last item returned).
+    timestamp and post_id is the cursor for the clients before sharding, which is the position of all shards.
+    preview_comments is the number of the newest comments embedded per post as comment_previews.
+    """
+    print(f"timestamp: {timestamp}, cursor: {cursor}, limit: {limit}, preview_comments: {preview_comments}")
+    page_limit = __page_limit(limit)
+    preview_count = __preview_count(preview_comments)
+
+    positions: Dict[str, Optional[List[Any]]] = {}
+    timestamp_condition: Optional[Tuple[str, int]] = None
+    # None if the number of the page is unknown (i.e., the legacy cursor), which is not cached.
+    page_number: Optional[int] = 0
+    if cursor:
+        positions, before, page_number = __decode_shard_cursor(cursor)
+        # The items of the same timestamp as "before" in the shards without the position have not been returned yet.
+        timestamp_condition = ("<=", before) if before is not None else None
+    else:
+        if post_id and not timestamp:
+            # The ID of the post created after IDs became ULID carries its timestamp, so it's the cursor by itself.
+            timestamp = timestamp_from_item_id(post_id)
+        if timestamp and post_id:
+            # ExclusiveStartKey is a position in the order of (timestamp, post_id) of the GSI and doesn't have to be an item of the shard,
+            # so the posts of the same timestamp as the last one are returned from the next post_id instead of being skipped.
+            positions = {k: [timestamp, post_id] for k in post_gsi_shard_keys()}
+            page_number = None
+
+    def fetch():
+        return __fetch_timeline_list(positions, timestamp_condition, page_number, counts_only, page_limit, preview_count)
+    if page_number is not None and page_number < TIMELINE_CACHE_LIST_PAGES:
+        # The cursor identifies the page, whose items are fixed by the positions in it, until the next write.
+        # Writes of comments also invalidate the pages, so comment_previews is cached with them.
+        generation = __generation(__LIST_GENERATION_CACHE_KEY)
+        if preview_count > 0:
+            generation += f"-{__generation(__PREVIEW_GENERATION_CACHE_KEY)}"
+        return __read_through(f"timeline:list:{generation}:{counts_only}:{page_limit}:{preview_count}:{cursor or ''}", fetch)
+    return fetch()
+
+
+def __fetch_timeline_list(positions: Dict[str, Optional[List[Any]]], timestamp_condition: Optional[Tuple[str, int]], page_number: Optional[int], counts_only: bool, page_limit: int, preview_count: int):
+    shard_keys = [k for k in post_gsi_shard_keys() if k not in positions or positions[k] is not None]
+    futures = {k: __shard_executor.submit(__query_post_gsi_shard, k, positions.get(k), timestamp_condition, counts_only, page_limit) for k in shard_keys}
+    responses = {k: f.result() for k, f in futures.items()}
+
+    # Each shard is already sorted in newest-first order, so heapq.merge() merges them without sorting all items.
+    # https://docs.python.org/ja/3/library/heapq.html#heapq.merge
+    merged = heapq.merge(
+        *[[(item, k) for item in response.get("Items", [])] for k, response in responses.items()],
+        key=lambda entry: (entry[0]["timestamp"], entry[0]["post_id"]),
+        reverse=True
+    )
+    page = list(itertools.islice(merged, page_limit))
+
+    next_positions = dict(positions)
+    for k, response in responses.items():
+        items = response.get("Items", [])
+        returned = [item for item, shard_key in page if shard_key == k]
+        if len(returned) == len(items) and "LastEvaluatedKey" not in response:
+            next_positions[k] = None
+        elif returned:
+            next_positions[k] = [int(returned[-1]["timestamp"]), returned[-1]["post_id"]]
+
+    has_next = any([next_positions.get(k, "") is not None for k in post_gsi_shard_keys()])
+    last_item = page[-1][0] if page else None
+    next_before = int(last_item["timestamp"]) if last_item else (timestamp_condition[1] if timestamp_condition else None)
+
+    # Only for the posts deleted before the GSIs became sparse and not migrated yet (tools/timeline_migration.py active).
+    IS_NOT_DELETED = 0
+    active_posts = [p for p, _ in page if p.get("is_deleted", IS_NOT_DELETED) == IS_NOT_DELETED]
 
     return FetchListResponseBody[PostItem](
         items=active_posts,
-        last_evaluated_timestamp=timestamp,
-        last_evaluated_id=post_id,
-        count=response.get("Count", -1)
+        last_evaluated_timestamp=last_item["timestamp"] if has_next and last_item else None,
+        last_evaluated_id=last_item["post_id"] if has_next and last_item else None,
+        last_evaluated_cursor=__encode_shard_cursor(next_positions, next_before, page_number + 1 if page_number is not None else None) if has_next else None,
+        count=len(page),
+        comment_previews=__fetch_comment_previews(active_posts, preview_count, counts_only)
     ).dict()
 
 
-def fetch_timeline_list_by_user(uuid: str, timestamp: Optional[int] = None, post_id: Optional[str] = None):
-    print(f"uuid: {uuid}, timestamp: {timestamp}")
+def fetch_timeline_list_by_user(uuid: str, timestamp: Optional[int] = None, post_id: Optional[str] = None, counts_only: bool = False, cursor: Optional[str] = None, limit: Optional[int] = None, preview_comments: int = 0):
+    """cursor is last_evaluated_cursor of the previous page. timestamp and post_id are the cursor for the clients before cursor was added."""
+    print(f"uuid: {uuid}, timestamp: {timestamp}, cursor: {cursor}, limit: {limit}, preview_comments: {preview_comments}")
+    preview_count = __preview_count(preview_comments)
 
     query_params = {
-        "IndexName": f"terakoya-{STAGE}-timeline-post-by-user",
-        "KeyConditionExpression": '#uuid = :value',
-        # "uuid" is a reserved keyword in DynamoDB. So you need to use ExpressionAttributeNames.
-        # https://dev.classmethod.jp/articles/dynamodb_handling_reserved_keyword/
+        # Sparse GSI which doesn't have the deleted posts.
+        # timeline-post-by-user still has them, which is used to update all posts of the user (ex: update_user_name).
+        "IndexName": f"terakoya-{STAGE}-timeline-post-active-by-user",
+        "KeyConditionExpression": '#active_uuid = :value',
         "ExpressionAttributeNames": {
-            "#uuid": "uuid"
+            "#active_uuid": ACTIVE_UUID
         },
         "ExpressionAttributeValues": {
             ':value': uuid
         },
-        "Limit": 20,
+        "Limit": __page_limit(limit),
         "ScanIndexForward": False,
     }
 
-    if timestamp and post_id:
-        query_params["ExclusiveStartKey"] = {
-            "uuid": uuid,
-            "timestamp": timestamp,
-            "post_id": post_id
-        }
+    if cursor:
+        query_params["ExclusiveStartKey"] = __decode_key_cursor(
+            cursor, __CURSOR_KIND_TIMELINE_BY_USER, (ACTIVE_UUID, uuid), ["timestamp", "post_id"])
+    else:
+        if post_id and not timestamp:
+            # The ID of the post created after IDs became ULID carries its timestamp, so it's the cursor by itself.
+            timestamp = timestamp_from_item_id(post_id)
+        if timestamp and post_id:
+            query_params["ExclusiveStartKey"] = {
+                ACTIVE_UUID: uuid,
+                "timestamp": timestamp,
+                "post_id": post_id
+            }
+
+    if counts_only:
+        __add_projection_without_reactions(query_params, PostItem)
 
     response = __post_table.query(**query_params)
+    if counts_only:
+        __counts_only(response.get("Items", []))
+    # Only for the posts deleted before the GSIs became sparse and not migrated yet (tools/timeline_migration.py active).
     IS_NOT_DELETED = 0
     active_posts = [p for p in response.get("Items", []) if p.get(
         "is_deleted", IS_NOT_DELETED) == IS_NOT_DELETED]
@@ -235,12 +901,15 @@ def fetch_timeline_list_by_user(uuid: str, timestamp: Optional[int] = None, post
         items=active_posts,
         last_evaluated_timestamp=timestamp,
         last_evaluated_id=post_id,
-        count=response.get("Count", -1)
+        last_evaluated_cursor=__encode_key_cursor(__CURSOR_KIND_TIMELINE_BY_USER, last_evaluated_key),
+        count=response.get("Count", -1),
+        comment_previews=__fetch_comment_previews(active_posts, preview_count, counts_only)
     ).dict()
 
 
-def fetch_comment_list(post_id: str, timestamp: Optional[int] = None, comment_id: Optional[str] = None):
-    print(f"post_id: {post_id}, timestamp: {timestamp}")
+def fetch_comment_list(post_id: str, timestamp: Optional[int] = None, comment_id: Optional[str] = None, counts_only: bool = False, cursor: Optional[str] = None, limit: Optional[int] = None):
+    """cursor is last_evaluated_cursor of the previous page. timestamp and comment_id are the cursor for the clients before cursor was added."""
+    print(f"post_id: {post_id}, timestamp: {timestamp}, cursor: {cursor}, limit: {limit}")
 
     query_params = {
         "IndexName": f"terakoya-{STAGE}-timeline-comment-for-post",
@@ -248,21 +917,32 @@ def fetch_comment_list(post_id: str, timestamp: Optional[int] = None, comment_id
         "ExpressionAttributeValues": {
             ':value': post_id
         },
-        "Limit": 20,
+        "Limit": __page_limit(limit),
         # The result of query() is sorted by sort key in ascending order by default.
         # But ScanIndexForward=False makes it descending order. If sort key is timestamp, it means latest first.
         # https://docs.aws.amazon.com/ja_jp/amazondynamodb/latest/developerguide/Query.html#Query.KeyConditionExpressions
         "ScanIndexForward": False,
     }
 
-    if timestamp and comment_id:
-        query_params["ExclusiveStartKey"] = {
-            "post_id": post_id,
-            "timestamp": timestamp,
-            "comment_id": comment_id
-        }
+    if cursor:
+        query_params["ExclusiveStartKey"] = __decode_key_cursor(
+            cursor, __CURSOR_KIND_COMMENT, ("post_id", post_id), ["timestamp", "comment_id"])
+    else:
+        if comment_id and not timestamp:
+            timestamp = timestamp_from_item_id(comment_id)
+        if timestamp and comment_id:
+            query_params["ExclusiveStartKey"] = {
+                "post_id": post_id,
+                "timestamp": timestamp,
+                "comment_id": comment_id
+            }
+
+    if counts_only:
+        __add_projection_without_reactions(query_params, CommentItem)
 
     response = __comment_table.query(**query_params)
+    if counts_only:
+        __counts_only(response.get("Items", []))
 
     last_evaluated_key = response.get("LastEvaluatedKey", None)
     timestamp = last_evaluated_key.get(
@@ -274,11 +954,16 @@ def fetch_comment_list(post_id: str, timestamp: Optional[int] = None, comment_id
         items=response.get("Items", []),
         last_evaluated_timestamp=timestamp,
         last_evaluated_id=comment_id,
+        last_evaluated_cursor=__encode_key_cursor(__CURSOR_KIND_COMMENT, last_evaluated_key),
         count=response.get("Count", -1)
     ).dict()
 
 
 def fetch_timeline_item(post_id: str):
+    return __read_through(__post_cache_key(post_id), lambda: __fetch_timeline_item(post_id))
+
+
+def __fetch_timeline_item(post_id: str):
     response = __post_table.get_item(Key={
         "post_id": post_id
     })
@@ -288,7 +973,86 @@ def fetch_timeline_item(post_id: str):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"指定された投稿は存在しません。\npost_id: {post_id}")
 
-    return dict(timeline_item)
+    # Convert to PostItem to derive reactions from reaction_by_user.
+    return PostItem(**__decode_texts(timeline_item)).dict()
+
+
+# The comments are fetched in another thread while the post is fetched in the thread of the request.
+# The threads are shared by the requests in the Lambda container, so the comments wait for a free thread when they are exhausted.
+__detail_executor = ThreadPoolExecutor(max_workers=4)
+
+
+def fetch_timeline_detail(post_id: str, counts_only: bool = False, limit: Optional[int] = None):
+    """
+    Fetch the post and the first page of its comments concurrently for the page of the post,
+    which takes as long as the slower of them instead of the sum of two requests.
+    """
+    comments_future = __detail_executor.submit(fetch_comment_list, post_id=post_id, counts_only=counts_only, limit=limit)
+    # 404 of the post is raised without waiting for the comments.
+    post = fetch_timeline_item(post_id)
+    return FetchDetailResponseBody(post=post, comments=comments_future.result()).dict()
+
+
+# BatchGetItem takes up to 100 keys per request and may return a part of them as UnprocessedKeys (ex: throttling),
+# which are retried with exponential backoff and jitter.
+# https://docs.aws.amazon.com/ja_jp/amazondynamodb/latest/APIReference/API_BatchGetItem.html
+# https://aws.amazon.com/jp/blogs/architecture/exponential-backoff-and-jitter/
+__BATCH_GET_MAX_KEYS = 100
+__BATCH_GET_MAX_ATTEMPTS = 5
+__BATCH_GET_BASE_DELAY_SECONDS = 0.05
+# The texts offloaded to S3 of the posts of a batch are read in parallel instead of one GetObject after another.
+__batch_texts_executor = ThreadPoolExecutor(max_workers=8)
+
+
+def __batch_get_post_items(post_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Returns the items found by post_id. The IDs must be unique."""
+    found: Dict[str, Dict[str, Any]] = {}
+    for i in range(0, len(post_ids), __BATCH_GET_MAX_KEYS):
+        request_items = {__post_table.name: {"Keys": [{"post_id": post_id} for post_id in post_ids[i:i + __BATCH_GET_MAX_KEYS]]}}
+        for attempt in range(__BATCH_GET_MAX_ATTEMPTS):
+            if attempt > 0:
+                time.sleep(random.uniform(0, __BATCH_GET_BASE_DELAY_SECONDS * 2 ** attempt))
+            response = __client.batch_get_item(RequestItems=request_items)
+            for item in response.get("Responses", {}).get(__post_table.name, []):
+                found[item["post_id"]] = item
+            request_items = response.get("UnprocessedKeys", {})
+            if not request_items:
+                break
+        if request_items:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="混雑しているため投稿を取得できませんでした。しばらく時間をおいてから再度お試し下さい。")
+    return found
+
+
+def fetch_timeline_items(post_ids: List[str]):
+    """
+    Fetch the posts of the IDs (ex: bookmarks) with BatchGetItem instead of GetItem per post.
+    The posts cached by fetch_timeline_item() are not read again. The deleted posts are reported in missing_ids.
+    """
+    print(f"post_ids: {post_ids}")
+    # dict keeps the order of the IDs and drops the duplicates.
+    unique_ids = list(dict.fromkeys(post_ids))
+    if len(unique_ids) > TIMELINE_BATCH_MAX_IDS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"一度に取得できる投稿は{TIMELINE_BATCH_MAX_IDS}件までです。\ncount: {len(unique_ids)}")
+
+    posts: Dict[str, Dict[str, Any]] = {}
+    for post_id in unique_ids:
+        cached = __cache.get(__post_cache_key(post_id))
+        if cached is not None:
+            posts[post_id] = cached
+    items = __batch_get_post_items([i for i in unique_ids if i not in posts])
+    # The texts compressed in the item are decoded in this thread because it takes no round trip.
+    offloaded = {post_id: __batch_texts_executor.submit(__decode_texts, item) for post_id, item in items.items() if TEXTS_S3_KEY in item}
+    for post_id, item in items.items():
+        posts[post_id] = PostItem(**(offloaded[post_id].result() if post_id in offloaded else __decode_texts(item))).dict()
+        __cache.set(__post_cache_key(post_id), posts[post_id], TIMELINE_CACHE_TTL_SECONDS)
+
+    IS_NOT_DELETED = 0
+    return FetchBatchResponseBody(
+        items=[posts[i] for i in unique_ids if i in posts and posts[i].get("is_deleted", IS_NOT_DELETED) == IS_NOT_DELETED],
+        missing_ids=[i for i in unique_ids if i not in posts or posts[i].get("is_deleted", IS_NOT_DELETED) != IS_NOT_DELETED]
+    ).dict()
 
 
 def fetch_comment_item(comment_id: str):
@@ -302,7 +1066,7 @@ def fetch_comment_item(comment_id: str):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"指定されたコメントは存在しません。\ncomment_id: {comment_id}")
 
-    return dict(comment_item)
+    return CommentItem(**__decode_texts(comment_item)).dict()
 
 
 def update_user_profile_img(uuid: str, user_profile_img_url: str, timestamp: Optional[int] = None):
@@ -362,6 +1126,7 @@ def update_user_profile_img(uuid: str, user_profile_img_url: str, timestamp: Opt
                 ":user_profile_img_url": user_profile_img_url
             }
         )
+        __invalidate_post(p.get("post_id"))
 
     comment_query_params = {
         "IndexName": f"terakoya-{STAGE}-timeline-comment-by-user",
@@ -474,6 +1239,7 @@ def update_user_name(uuid: str, user_name: str, timestamp: Optional[int] = None)
                 ":user_name": user_name,
             }
         )
+        __invalidate_post(p.get("post_id"))
 
     comment_query_params = {
         "IndexName": f"terakoya-{STAGE}-timeline-comment-by-user",
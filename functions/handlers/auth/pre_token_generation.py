@@ -0,0 +1,45 @@
+import os
+import sys
+
+FUNCTIONS_DIR_PATH = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+sys.path.append(FUNCTIONS_DIR_PATH)
+
+from domain.user import fetch_item
+from models.user import UserItem, EMPTY_SK
+from utils.slack import SlackErrorNotification
+
+slack_error_notifier = SlackErrorNotification()
+
+
+# This Lambda function is triggered by PreTokenGeneration trigger of Cognito User Pool. i.e., every time Cognito issues tokens (sign-in and refresh).
+# is_admin, name and user_profile_img_url of User table are embedded in the access token as custom claims,
+# so that the hub can authorize the user without reading User table on every request.
+# name and user_profile_img_url are only the profile at the time of issue, so the hub doesn't stamp posts/comments with them.
+# Customizing the access token requires the event version 2 (LambdaVersion: V2_0).
+# https://docs.aws.amazon.com/cognito/latest/developerguide/user-pool-lambda-pre-token-generation.html
+def lambda_handler(event, context):
+    print(f"event: {event}")
+    try:
+        user_name = event['userName']
+        item = fetch_item(user_name, EMPTY_SK)
+        if not item:
+            # User table has no item yet just after PostConfirmation trigger fails, so tokens are issued without custom claims.
+            print(f"User item is not found. uuid: {user_name}")
+            return event
+
+        claims = UserItem(**item).to_token_claims()
+        print(f"claims: {claims}")
+        event['response'] = {
+            'claimsAndScopeOverrideDetails': {
+                'accessTokenGeneration': {
+                    'claimsToAddOrOverride': claims
+                }
+            }
+        }
+        # PreTokenGeneration trigger must return event
+        return event
+    except Exception as e:
+        # Tokens are issued without custom claims rather than failing sign-in.
+        print(f"Error happend. Error message: {str(e)}")
+        slack_error_notifier.notify(path="pre_token_generation", msg=str(e), request_data=event)
+        return event
@@ -2,12 +2,14 @@ import os
 import sys
 import json
 from typing import Any, Dict
+from fastapi import HTTPException
 
 FUNCTIONS_DIR_PATH = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
 sys.path.append(FUNCTIONS_DIR_PATH)
 
 from conf.env import TERAKOYA_GMAIL_ADDRESS, TERAKOYA_GROUP_MAIL_ADDRESS
 from domain.booking import BookingTable
+from domain.idempotency import run_idempotently, IDEMPOTENCY_KEY_HEADER
 from models.booking import ARRIVAL_TIME, TERAKOYA_EXPERIENCE, TERAKOYA_TYPE, BookRequestBody, BookingItem
 from utils.mail import SesMail
 from utils.dt import DT
@@ -88,4 +90,23 @@ class BookingRequest:
 
 
 def lambda_handler(event, context):
-    return lambda_handler_wrapper(event, BookingRequest(json.loads(event["body"])).book)
+    request_body_json = json.loads(event["body"])
+    # Header names in the event of API Gateway (v2 HTTP API) are lowercase.
+    # https://docs.aws.amazon.com/ja_jp/apigateway/latest/developerguide/http-api-develop-integrations-lambda.html
+    idempotency_key = (event.get("headers") or {}).get(IDEMPOTENCY_KEY_HEADER.lower())
+    try:
+        # A retry with the same Idempotency-Key neither books the same dates again nor sends the confirmation email twice.
+        return run_idempotently(
+            idempotency_key,
+            scope="book",
+            # The booking API has no signed-in user, so the key is scoped to the email of the booking like the timeline scopes it to uuid.
+            # Otherwise a key of a client would replay or reject (409/422) the booking of another client with the same key.
+            owner=str(request_body_json.get("email", "")).strip().lower(),
+            request_data=request_body_json,
+            func=lambda: lambda_handler_wrapper(event, BookingRequest(request_body_json).book)
+        )
+    except HTTPException as e:
+        if e.status_code >= 500:
+            raise e
+        # The request with the same key is in progress or has a different body.
+        return {"statusCode": e.status_code, "body": json.dumps({"detail": e.detail}, ensure_ascii=False)}
@@ -0,0 +1,266 @@
+import os
+import sys
+import time
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional
+from botocore.exceptions import ClientError
+
+FUNCTIONS_DIR_PATH = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+sys.path.append(FUNCTIONS_DIR_PATH)
+
+from conf.env import STAGE, COUNTER_RECONCILIATION_LOOKBACK_SECONDS, COUNTER_RECONCILIATION_COUNTERS_INDEX_ENABLED, COUNTER_RECONCILIATION_MAX_WORKERS, COUNTER_RECONCILIATION_REQUESTS_PER_SECOND
+from models.timeline import COUNTERS_UPDATED_AT, REACTION_BY_USER, count_reactions, post_gsi_shard_keys
+from utils.aws import dynamodb_resource
+from utils.dynamodb import is_conditional_check_failed
+from utils.process import lambda_handler_wrapper_with_rtn_value
+from utils.rate_limit import TokenBucket
+
+__POST_TABLE_NAME = f"terakoya-{STAGE}-timeline-post"
+__COMMENT_TABLE_NAME = f"terakoya-{STAGE}-timeline-comment"
+__POST_ALL_INDEX_NAME = f"terakoya-{STAGE}-timeline-post-all"
+__POST_COUNTERS_UPDATED_INDEX_NAME = f"terakoya-{STAGE}-timeline-post-counters-updated"
+__COMMENT_FOR_POST_INDEX_NAME = f"terakoya-{STAGE}-timeline-comment-for-post"
+# The watermark of the last run is kept in the table owned by this job.
+__STATE_TABLE_NAME = f"terakoya-{STAGE}-timeline-reconcile-state"
+__STATE_KEY = {"job": "reconcile-counters"}
+
+# Table resource is not thread-safe, but the client is. The client of the resource serializes Python values like the Table resource does.
+# https://boto3.amazonaws.com/v1/documentation/api/latest/guide/clients.html#multithreading-or-multiprocessing-with-clients
+__client = dynamodb_resource.meta.client
+
+# Every request to DynamoDB (query, scan and update) of the workers takes a token, so that the job doesn't consume the capacity the hub needs.
+__bucket = TokenBucket(capacity=max(1, COUNTER_RECONCILIATION_REQUESTS_PER_SECOND),
+                       refill_per_second=COUNTER_RECONCILIATION_REQUESTS_PER_SECOND)
+
+RESULT_UNCHANGED = "unchanged"
+RESULT_FIXED = "fixed"
+# The counter has been updated by the hub since it was read. The next run checks it again.
+RESULT_CONFLICT = "conflict"
+RESULT_FAILED = "failed"
+
+
+def __paginate(method: Any, params: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    while True:
+        __bucket.acquire()
+        response = method(**params)
+        yield response
+        if "LastEvaluatedKey" not in response:
+            return
+        params = {**params, "ExclusiveStartKey": response["LastEvaluatedKey"]}
+
+
+def __iterate_post_pages(since: Optional[int]) -> Iterator[List[Dict[str, Any]]]:
+    if since is None:
+        for page in __paginate(__client.scan, {"TableName": __POST_TABLE_NAME}):
+            yield page.get("Items", [])
+        return
+    if COUNTER_RECONCILIATION_COUNTERS_INDEX_ENABLED:
+        # Posts created after the watermark and the older posts which have got comments or reactions after it
+        # are found by the sort keys of the GSIs without scanning the whole table.
+        pages = itertools.chain.from_iterable([__paginate(__client.query, {
+            "TableName": __POST_TABLE_NAME,
+            "IndexName": index_name,
+            "KeyConditionExpression": "pk_for_all_post_gsi = :pk AND #sort_key >= :since",
+            "ExpressionAttributeNames": {"#sort_key": sort_key},
+            "ExpressionAttributeValues": {":pk": shard_key, ":since": since},
+        }) for index_name, sort_key in [(__POST_ALL_INDEX_NAME, "timestamp"), (__POST_COUNTERS_UPDATED_INDEX_NAME, COUNTERS_UPDATED_AT)]
+            for shard_key in post_gsi_shard_keys()])
+    else:
+        # Until timeline-post-counters-updated GSI is deployed, all posts not deleted are read from timeline-post-all GSI
+        # and only the ones created or updated after the watermark are returned by the filter.
+        # FilterExpression doesn't reduce the read capacity, so it costs as much as reading all posts every run.
+        # https://docs.aws.amazon.com/ja_jp/amazondynamodb/latest/developerguide/Query.FilterExpression.html
+        pages = itertools.chain.from_iterable([__paginate(__client.query, {
+            "TableName": __POST_TABLE_NAME,
+            "IndexName": __POST_ALL_INDEX_NAME,
+            "KeyConditionExpression": "pk_for_all_post_gsi = :pk",
+            "FilterExpression": "#timestamp >= :since OR #counters_updated_at >= :since",
+            "ExpressionAttributeNames": {"#timestamp": "timestamp", "#counters_updated_at": COUNTERS_UPDATED_AT},
+            "ExpressionAttributeValues": {":pk": shard_key, ":since": since},
+        }) for shard_key in post_gsi_shard_keys()])
+    # A post can be in both GSIs, and it's reconciled only once per run.
+    seen_post_ids = set()
+    for page in pages:
+        posts = [p for p in page.get("Items", []) if p["post_id"] not in seen_post_ids]
+        seen_post_ids.update([p["post_id"] for p in posts])
+        yield posts
+
+
+def __load_watermark() -> Optional[int]:
+    __bucket.acquire()
+    item = __client.get_item(TableName=__STATE_TABLE_NAME, Key=__STATE_KEY, ConsistentRead=True).get("Item")
+    return int(item["watermark"]) if item else None
+
+
+def __save_watermark(watermark: int) -> None:
+    __bucket.acquire()
+    try:
+        __client.update_item(
+            TableName=__STATE_TABLE_NAME,
+            Key=__STATE_KEY,
+            UpdateExpression="SET watermark = :watermark",
+            # A run which started later may have saved its watermark already (ex: the full run overlapping the incremental one).
+            ConditionExpression="attribute_not_exists(watermark) OR watermark < :watermark",
+            ExpressionAttributeValues={":watermark": watermark},
+        )
+    except ClientError as e:
+        if not is_conditional_check_failed(e):
+            raise e
+
+
+def count_active_comments(post_id: str) -> int:
+    """
+    Count the comments of the post which are not deleted with Select=COUNT, which returns only the number of the items.
+    Query reads 1MB at most at a time, so the count is summed over the pages.
+    https://docs.aws.amazon.com/ja_jp/amazondynamodb/latest/developerguide/Query.html#Query.Count
+    """
+    pages = __paginate(__client.query, {
+        "TableName": __COMMENT_TABLE_NAME,
+        "IndexName": __COMMENT_FOR_POST_INDEX_NAME,
+        "KeyConditionExpression": "post_id = :post_id",
+        "FilterExpression": "attribute_not_exists(is_deleted) OR is_deleted = :is_deleted_false",
+        "Select": "COUNT",
+        "ExpressionAttributeValues": {":post_id": post_id, ":is_deleted_false": 0},
+    })
+    return sum([page["Count"] for page in pages])
+
+
+def __write_corrections(table_name: str, key_name: str, item: Dict[str, Any], corrections: Dict[str, int]) -> str:
+    """
+    Set the counters to the true values only if they are the same as when they were read.
+    The hub updates the counters with ADD concurrently, and the condition prevents the job from overwriting them with a stale value.
+    """
+    update_expressions = []
+    condition_expressions = ["attribute_exists(#key)"]
+    attribute_names = {"#key": key_name}
+    attribute_values = {}
+    for i, (attribute, value) in enumerate(corrections.items()):
+        attribute_names[f"#attribute_{i}"] = attribute
+        attribute_values[f":value_{i}"] = value
+        update_expressions.append(f"#attribute_{i} = :value_{i}")
+        if attribute in item:
+            attribute_values[f":observed_{i}"] = item[attribute]
+            condition_expressions.append(f"#attribute_{i} = :observed_{i}")
+        else:
+            condition_expressions.append(f"attribute_not_exists(#attribute_{i})")
+    __bucket.acquire()
+    try:
+        __client.update_item(
+            TableName=table_name,
+            Key={key_name: item[key_name]},
+            UpdateExpression="SET " + ", ".join(update_expressions),
+            ConditionExpression=" AND ".join(condition_expressions),
+            ExpressionAttributeNames=attribute_names,
+            ExpressionAttributeValues=attribute_values,
+        )
+    except ClientError as e:
+        if is_conditional_check_failed(e):
+            return RESULT_CONFLICT
+        raise e
+    print(f"Fixed {table_name} {item[key_name]}: {', '.join([f'{a}: {item.get(a)} -> {v}' for a, v in corrections.items()])}")
+    return RESULT_FIXED
+
+
+def __reaction_count_corrections(item: Dict[str, Any]) -> Dict[str, int]:
+    # Legacy items which store reactions as a list are converted by tools/timeline_migration.py reactions.
+    if REACTION_BY_USER not in item:
+        return {}
+    return {attribute: count for attribute, count in count_reactions(item[REACTION_BY_USER]).items() if item.get(attribute) != count}
+
+
+def reconcile_post(post: Dict[str, Any]) -> Dict[str, Any]:
+    try:
+        corrections = __reaction_count_corrections(post)
+        comment_count = count_active_comments(post["post_id"])
+        if post.get("comment_count") != comment_count:
+            corrections["comment_count"] = comment_count
+        result = __write_corrections(__POST_TABLE_NAME, "post_id", post, corrections) if corrections else RESULT_UNCHANGED
+        return {"result": result, "corrected_attributes": list(corrections.keys())}
+    except Exception as e:
+        print(f"Failed to reconcile post {post.get('post_id')}. Error message: {str(e)}")
+        return {"result": RESULT_FAILED, "corrected_attributes": []}
+
+
+def __reconcile_comment_reactions(report: Dict[str, Any]) -> None:
+    for page in __paginate(__client.scan, {"TableName": __COMMENT_TABLE_NAME}):
+        for comment in page.get("Items", []):
+            report["scanned_comments"] += 1
+            corrections = __reaction_count_corrections(comment)
+            if not corrections:
+                continue
+            try:
+                result = __write_corrections(__COMMENT_TABLE_NAME, "comment_id", comment, corrections)
+            except Exception as e:
+                print(f"Failed to reconcile comment {comment.get('comment_id')}. Error message: {str(e)}")
+                result = RESULT_FAILED
+            report["fixed_comments" if result == RESULT_FIXED else f"{result}_comments"] += 1
+
+
+def reconcile_counters(since: Optional[int] = None, full: bool = False) -> Dict[str, Any]:
+    """
+    Recompute comment_count from the comment-for-post GSI and like_count/bad_count from reaction_by_user,
+    and write them only to the items whose counters have drifted.
+    - incremental (default): posts created, commented or reacted at or after "since" (UNIX time in milliseconds).
+      It defaults to the watermark saved by the last run, or COUNTER_RECONCILIATION_LOOKBACK_SECONDS ago for the first run.
+      Legacy posts whose timestamp is in seconds and which have no counters_updated_at are reconciled only by the full run.
+    - full: all posts and the reaction counters of all comments.
+    "watermark" in the report is the time the run started. It's saved for the next run unless any post failed,
+    so that the failed posts are checked again. The posts updated during the run are newer than it, so they are checked by the next run.
+    """
+    started_at = time.time()
+    if full:
+        since = None
+    elif since is None:
+        since = __load_watermark()
+        if since is None:
+            since = int((started_at - COUNTER_RECONCILIATION_LOOKBACK_SECONDS) * 1000)
+    report: Dict[str, Any] = {
+        "mode": "full" if full else "incremental",
+        "since": since,
+        "watermark": int(started_at * 1000),
+        "scanned_posts": 0,
+        "fixed_posts": 0,
+        "fixed_comment_counts": 0,
+        "fixed_reaction_counts": 0,
+        "conflict_posts": 0,
+        "failed_posts": 0,
+        "scanned_comments": 0,
+        "fixed_comments": 0,
+        "conflict_comments": 0,
+        "failed_comments": 0,
+    }
+
+    # Counting comments of a post takes one round trip or more, so the posts of a page are reconciled concurrently.
+    # The workers are shared by the pages to bound the number of threads and the items held in memory to a page.
+    with ThreadPoolExecutor(max_workers=COUNTER_RECONCILIATION_MAX_WORKERS) as executor:
+        for posts in __iterate_post_pages(since):
+            report["scanned_posts"] += len(posts)
+            for outcome in executor.map(reconcile_post, posts):
+                if outcome["result"] == RESULT_FIXED:
+                    report["fixed_posts"] += 1
+                    report["fixed_comment_counts"] += int("comment_count" in outcome["corrected_attributes"])
+                    report["fixed_reaction_counts"] += int(any([a != "comment_count" for a in outcome["corrected_attributes"]]))
+                elif outcome["result"] != RESULT_UNCHANGED:
+                    report[f"{outcome['result']}_posts"] += 1
+
+    if full:
+        __reconcile_comment_reactions(report)
+
+    if report["failed_posts"] == 0:
+        __save_watermark(report["watermark"])
+
+    report["elapsed_seconds"] = round(time.time() - started_at, 3)
+    print(f"report: {report}")
+    return report
+
+
+def lambda_handler(event, context):
+    print(f"event: {str(event)}")
+    # EventBridge passes the input of the rule as the event, ex: {"full": true} or {"since": 1700000000000}
+    # https://docs.aws.amazon.com/ja_jp/eventbridge/latest/userguide/eb-create-rule-schedule.html
+    return lambda_handler_wrapper_with_rtn_value(
+        event,
+        lambda: reconcile_counters(since=event.get("since"), full=bool(event.get("full", False))),
+        os.environ['AWS_LAMBDA_FUNCTION_NAME']
+    )
@@ -3,6 +3,7 @@ from fastapi.middleware.cors import CORSMiddleware
 from mangum import Mangum
 
 from .routers import booking_router, authentication_router, user_router, timeline_router
+from .middlewares import TokenRefreshMiddleware
 
 app = FastAPI()
 
@@ -11,6 +12,9 @@ app.include_router(booking_router, prefix="/booking", tags=["booking"])
 app.include_router(user_router, prefix="/user", tags=["user"])
 app.include_router(timeline_router, prefix="/timeline", tags=["timeline"])
 
+# Middleware added later wraps the ones added earlier, so CORSMiddleware (added below) runs before TokenRefreshMiddleware.
+# https://www.starlette.io/middleware/#using-middleware
+app.add_middleware(TokenRefreshMiddleware)
 
 # FastAPI restricts OPTIONS requests (preflight requests) by default, so even if you allow them on the API Gateway side, if you do not allow them on the FastAPI side, a 405 error will be returned.
 # So, you need to explicitly include CORS headers in the response in FastAPI middleware so that the browser can make preflight requests.
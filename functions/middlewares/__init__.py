@@ -0,0 +1,4 @@
+# Putting __init__.py in a directory, makes it a package.
+# https://qiita.com/miyuki_samitani/items/a7758ba44bf00ef30f26
+
+from .token_refresh import TokenRefreshMiddleware
@@ -0,0 +1,91 @@
+import os
+import sys
+from http.cookies import SimpleCookie
+from typing import Dict, List, Tuple
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+ROOT_DIR_PATH = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR_PATH)
+
+from conf.env import TOKEN_REFRESH_BEFORE_SECONDS
+from domain import authentication as auth, admission
+
+# Endpoints which issue or delete tokens by themselves.
+EXCLUDED_PATHS = ("/signin", "/signout", "/refresh-token")
+
+
+# Pure ASGI middleware instead of BaseHTTPMiddleware (@app.middleware("http")) because
+# the request headers have to be replaced before the endpoint reads the cookies and BaseHTTPMiddleware can't do it.
+# https://www.starlette.io/middleware/#pure-asgi-middleware
+class TokenRefreshMiddleware:
+    """
+    Refresh the access token which has expired or is about to expire with the refresh token in cookie before the request is handled,
+    so that the request succeeds without 401 and the round trip to /refresh-token from the client.
+    The new tokens are set to cookie of the response of the original request.
+    """
+
+    def __init__(self, app: ASGIApp, refresh_before_seconds: int = TOKEN_REFRESH_BEFORE_SECONDS) -> None:
+        self.app = app
+        self.refresh_before_seconds = refresh_before_seconds
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["path"] in EXCLUDED_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        request = Request(scope)
+        cookies = request.cookies
+        refresh_token = cookies.get("refresh_token")
+        if refresh_token is None or not auth.is_access_token_expiring(cookies.get("access_token"), self.refresh_before_seconds):
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            # boto3 is blocking, so Cognito is called in the threadpool not to block the event loop.
+            # Concurrent requests with the same refresh token share one request to Cognito in auth.refresh_tokens().
+            # The refresh shares the admission control of /refresh-token, which is checked only when Cognito is actually called
+            # so that the requests coalesced into one refresh don't consume the tokens of the bucket.
+            tokens = await run_in_threadpool(
+                auth.refresh_tokens,
+                refresh_token,
+                lambda: admission.admit(request, "refresh-token", auth.get_token_digest(refresh_token))
+            )
+        except Exception as e:
+            # The original request is handled as it is (ex: 401 by authenticate_user) if the refresh fails or is throttled.
+            print(f"Failed to refresh tokens in TokenRefreshMiddleware: {e}")
+            await self.app(scope, receive, send)
+            return
+
+        print("Access token is refreshed in TokenRefreshMiddleware.")
+        cookies = {**cookies, "access_token": tokens.access_token, "refresh_token": tokens.refresh_token}
+        # Set-Cookie headers are built with the same attributes as /signin and /refresh-token.
+        cookie_response = Response()
+        auth.accept_issued_tokens(cookie_response, tokens.access_token, tokens.refresh_token, tokens.claims)
+        # The session cookie minted for the new access token is also handed to the endpoint.
+        cookies.update(self.__get_cookies_to_set(cookie_response))
+        set_cookie_headers = [(k, v) for k, v in cookie_response.raw_headers if k == b"set-cookie"]
+
+        async def send_with_new_tokens(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                message = {**message, "headers": list(message.get("headers", [])) + set_cookie_headers}
+            await send(message)
+
+        await self.app(self.__replace_cookie_header(scope, cookies), receive, send_with_new_tokens)
+
+    @staticmethod
+    def __get_cookies_to_set(response: Response) -> Dict[str, str]:
+        cookies: Dict[str, str] = {}
+        for key, value in response.raw_headers:
+            if key == b"set-cookie":
+                cookie = SimpleCookie(value.decode("latin-1"))
+                cookies.update({name: morsel.value for name, morsel in cookie.items()})
+        return cookies
+
+    @staticmethod
+    def __replace_cookie_header(scope: Scope, cookies: Dict[str, str]) -> Scope:
+        headers: List[Tuple[bytes, bytes]] = [(k, v) for k, v in scope["headers"] if k != b"cookie"]
+        headers.append((b"cookie", "; ".join([f"{k}={v}" for k, v in cookies.items()]).encode("latin-1")))
+        return {**scope, "headers": headers}
@@ -1,15 +1,77 @@
 import os
 import sys
-import uuid
-from typing import Any, List
-from pydantic import BaseModel
+import zlib
+from typing import Any, Dict, List, Optional
+from pydantic import BaseModel, Field
 
 ROOT_DIR_PATH = os.path.dirname(os.path.dirname(__file__))
 sys.path.append(ROOT_DIR_PATH)
 
+from conf.env import TIMELINE_POST_GSI_SHARD_COUNT
 from utils.dt import DT
+from utils.ulid import MAX_TIMESTAMP_MS, generate_ulid, decode_timestamp_ms
 
+# Partition key of timeline-post-all GSI of the posts created before the GSI was sharded (tools/timeline_migration.py shards moves them).
 PK_FOR_ALL_POST_GSI = "pk_for_all_post_gsi"
+REACTION_BY_USER = "reaction_by_user"
+# Partition key of timeline-post-active-by-user GSI, which is the same as uuid and removed when the post is logically deleted.
+# The GSI is sparse, i.e., it has only the items which have the key attribute.
+# https://docs.aws.amazon.com/ja_jp/amazondynamodb/latest/developerguide/bp-indexes-general-sparse-indexes.html
+ACTIVE_UUID = "active_uuid"
+
+REACTION_TYPE_LIKE = 1
+REACTION_TYPE_BAD = 2
+# Counter attribute per reaction type, which is updated in the same write as reaction_by_user.
+REACTION_COUNT_ATTRIBUTES = {
+    REACTION_TYPE_LIKE: "like_count",
+    REACTION_TYPE_BAD: "bad_count",
+}
+# Time (UNIX time in milliseconds) of the last write which changed comment_count or the reaction counters.
+# It's the sort key of timeline-post-counters-updated GSI, which tells handlers/timeline/reconcile_counters.py the posts to check.
+COUNTERS_UPDATED_AT = "counters_updated_at"
+
+
+# Timestamps of the items created before they were changed to milliseconds are in seconds.
+# Any timestamp in milliseconds since 1973 is larger than this, and any in seconds until 5138 is smaller.
+MILLISECONDS_TIMESTAMP_THRESHOLD = 10 ** 11
+
+
+def generate_item_id(timestamp: int = -1) -> str:
+    """
+    Generate post_id/comment_id which is ULID, so that IDs sort in the order of creation and the ID alone can be the cursor of pagination.
+    Legacy items have uuid4().hex as ID, which has no order.
+    """
+    return generate_ulid(timestamp if timestamp != -1 else DT.CURRENT_TIMESTAMP_MS)
+
+
+def timestamp_from_item_id(item_id: str) -> Optional[int]:
+    """Returns the timestamp in milliseconds embedded in the ID generated by generate_item_id(), or None for legacy IDs."""
+    return decode_timestamp_ms(item_id)
+
+
+def post_gsi_shard_key(post_id: str) -> str:
+    """
+    Partition key of timeline-post-all GSI of the post. The posts are spread over the shards by the hash of post_id,
+    so that the writes of new posts don't concentrate on one partition key.
+    """
+    # crc32 is used instead of hash() whose value for str differs per process.
+    # https://docs.python.org/ja/3/reference/datamodel.html#object.__hash__
+    return f"{PK_FOR_ALL_POST_GSI}#{zlib.crc32(post_id.encode()) % TIMELINE_POST_GSI_SHARD_COUNT}"
+
+
+def post_gsi_shard_keys() -> List[str]:
+    """All partition keys of timeline-post-all GSI to be read, including the legacy one."""
+    return [PK_FOR_ALL_POST_GSI] + [f"{PK_FOR_ALL_POST_GSI}#{i}" for i in range(TIMELINE_POST_GSI_SHARD_COUNT)]
+
+
+def count_reactions(reaction_by_user: Dict[str, Any]) -> Dict[str, int]:
+    """Returns { "like_count": n, "bad_count": m } counted from reaction_by_user"""
+    counts = {count_attribute: 0 for count_attribute in REACTION_COUNT_ATTRIBUTES.values()}
+    for type in reaction_by_user.values():
+        count_attribute = REACTION_COUNT_ATTRIBUTES.get(int(type))
+        if count_attribute is not None:
+            counts[count_attribute] += 1
+    return counts
 
 
 class Reaction(BaseModel):
@@ -24,21 +86,60 @@ class Reaction(BaseModel):
         }
 
 
+class EditTextsRequestBody(BaseModel):
+    texts: str
+    """New texts of post/comment"""
+    version: int
+    """version of the post/comment which the client has read. The edit is rejected if it has been edited since then."""
+
+
 class BaseTimelineItem(BaseModel):
     uuid: str
     """UID of user who posted/commented"""
-    timestamp: int = -1
-    """Timestamp of post/comment"""
+    # The range which the ID (ULID) can carry. A request out of it is rejected with 422 instead of failing to generate the ID.
+    timestamp: int = Field(default=-1, ge=-1, le=MAX_TIMESTAMP_MS)
+    """Timestamp of post/comment (UNIX time in milliseconds). -1 means the current time."""
     user_name: str = ""
     """Nick name of user who posted/commented"""
     user_profile_img_url: str = ""
     """URL of user profile image uploaded to S3"""
     texts: str = ""
-    """Texts of post/comment"""
+    """Texts of post/comment (the preview if is_texts_truncated)"""
+    is_texts_truncated: bool = False
+    """True if texts is the preview of the long texts stored compressed or in S3, which is returned by the listing. Fetch the item to read the whole texts."""
     reactions: List[Reaction] = []
-    """List of Reaction"""
+    """List of Reaction (derived from reaction_by_user and not stored in DynamoDB)"""
+    # exclude=True excludes the field from .dict() and then the response of API, which has reactions instead.
+    # https://docs.pydantic.dev/1.10/usage/exporting_models/#advanced-include-and-exclude
+    reaction_by_user: Dict[str, int] = Field(default={}, exclude=True)
+    """Reaction type by UID of user who reacted, which is stored in DynamoDB as a map so that one user's reaction is updated atomically"""
+    like_count: int = 0
+    """Number of reactions of like"""
+    bad_count: int = 0
+    """Number of reactions of bad"""
     is_deleted: int = 0
     """0: not deleted, 1: deleted"""
+    version: int = 0
+    """Incremented every time texts is edited. Legacy items don't have it, which means 0."""
+
+    def __init__(self, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        if 0 <= self.timestamp < MILLISECONDS_TIMESTAMP_THRESHOLD:
+            # Legacy item whose timestamp is in seconds. The stored value is kept as it is, which is the sort key of GSIs.
+            self.timestamp *= 1000
+        if self.reaction_by_user:
+            self.reactions = [Reaction(uuid=uuid, type=type) for uuid, type in self.reaction_by_user.items()]
+        elif self.reactions:
+            # Legacy item which stores reactions as a list
+            self.reaction_by_user = {r.uuid: r.type for r in self.reactions}
+        if not any([count_attribute in kwargs for count_attribute in REACTION_COUNT_ATTRIBUTES.values()]):
+            # Item which has not been backfilled with the counters yet (tools/timeline_migration.py counters)
+            for count_attribute, count in count_reactions(self.reaction_by_user).items():
+                setattr(self, count_attribute, count)
+
+    def to_dynamodb_item(self) -> Dict[str, Any]:
+        # reactions is not stored because it's derived from reaction_by_user.
+        return {**self.dict(exclude={"reactions"}), REACTION_BY_USER: self.reaction_by_user}
 
 
 class CommentItem(BaseTimelineItem):
@@ -50,9 +151,10 @@ class CommentItem(BaseTimelineItem):
     def __init__(self, **kwargs: Any) -> None:
         super().__init__(**kwargs)
         if self.comment_id == "":
-            self.comment_id = uuid.uuid4().hex
+            self.comment_id = generate_item_id(self.timestamp)
         if self.timestamp == -1:
-            self.timestamp = int(DT.CURRENT_JST_DATETIME.timestamp())
+            # The same milliseconds as the ID, so that the ID alone can restore the cursor (ExclusiveStartKey) of the GSI.
+            self.timestamp = timestamp_from_item_id(self.comment_id) or DT.CURRENT_TIMESTAMP_MS
 
 
 class PostItem(BaseTimelineItem):
@@ -61,19 +163,27 @@ class PostItem(BaseTimelineItem):
     post_id: str = ""
     """UID of post (used for URL)"""
     pk_for_all_post_gsi: str = PK_FOR_ALL_POST_GSI
-    """Partition key for GSI"""
+    """Partition key for GSI (shard key given by post_gsi_shard_key())"""
 
     # __init__ method is required to convert DynamoDB item to Pydantic model.
     def __init__(self, **kwargs: Any) -> None:
         super().__init__(**kwargs)
 
-        # The same value is used by all instances of PostItem during the same process if uuid.uuid4().hex is set in class level.
+        # The same value is used by all instances of PostItem during the same process if the ID is generated in class level.
         # Lambda process for production runs longer than development environment.
         if self.post_id == "":
-            # uuid.uuid4() generates random UUID.
-            # https://yumarublog.com/python/uuid/
-            # .hex returns UUID string without hyphens.
-            # https://www.python.ambitious-engineer.com/archives/1436
-            self.post_id = uuid.uuid4().hex
+            self.post_id = generate_item_id(self.timestamp)
         if self.timestamp == -1:
-            self.timestamp = int(DT.CURRENT_JST_DATETIME.timestamp())
+            # The same milliseconds as the ID, so that the ID alone can restore the cursor (ExclusiveStartKey) of the GSI.
+            self.timestamp = timestamp_from_item_id(self.post_id) or DT.CURRENT_TIMESTAMP_MS
+        if "pk_for_all_post_gsi" not in kwargs:
+            self.pk_for_all_post_gsi = post_gsi_shard_key(self.post_id)
+
+    def to_dynamodb_item(self) -> Dict[str, Any]:
+        item = super().to_dynamodb_item()
+        if self.is_deleted:
+            # The keys of the listing GSIs are not stored, so that the deleted post is not read by the listing queries.
+            del item["pk_for_all_post_gsi"]
+        else:
+            item[ACTIVE_UUID] = self.uuid
+        return item
@@ -1,6 +1,6 @@
 import os
 import sys
-from typing import Any, List
+from typing import Any, Dict, List
 from enum import Enum
 from decimal import Decimal
 from pydantic import BaseModel
@@ -12,6 +12,11 @@ from utils.dt import DT
 
 EMPTY_SK = "EMPTY_SK"
 
+# Names of custom claims of the access token which carry the fields of UserItem.
+CLAIM_IS_ADMIN = "is_admin"
+CLAIM_NAME = "name"
+CLAIM_USER_PROFILE_IMG_URL = "user_profile_img_url"
+
 
 class GRADE(Enum):
     """学年 (grade)"""
@@ -135,3 +140,11 @@ class UserItem(UserProfile):
 
     def to_profile(self):
         return UserProfile(**self.dict())
+
+    def to_token_claims(self) -> Dict[str, Any]:
+        """Custom claims embedded in the access token by PreTokenGeneration trigger of Cognito User Pool"""
+        return {
+            CLAIM_IS_ADMIN: self.is_admin == AUTHORITY.ADMIN,
+            CLAIM_NAME: self.name,
+            CLAIM_USER_PROFILE_IMG_URL: self.user_profile_img_url,
+        }
@@ -9,7 +9,7 @@ from fastapi.exceptions import HTTPException
 FUNCTIONS_DIR_PATH = os.path.dirname(os.path.dirname(__file__))
 sys.path.append(FUNCTIONS_DIR_PATH)
 
-from domain import authentication as auth, user
+from domain import authentication as auth, user, admission
 from utils.process import hub_lambda_handler_wrapper, hub_lambda_handler_wrapper_with_rtn_value
 
 authentication_router = APIRouter()
@@ -24,6 +24,8 @@ class AuthAccountRequestBody(BaseModel):
 # https://www.integrate.io/jp/blog/best-practices-for-naming-rest-api-endpoints-ja/#one
 @authentication_router.post("/signup")
 def signup(requset_body: AuthAccountRequestBody, request: Request, response: Response):
+    # Excess requests are rejected before Cognito is called and without notifying Slack of every rejected request.
+    admission.admit(request, "signup", requset_body.email)
     return hub_lambda_handler_wrapper_with_rtn_value(lambda: auth.signup(
         email=requset_body.email,
         password=requset_body.password,
@@ -53,21 +55,21 @@ def delete_account(requset_body: DeleteAccountRequestBody, request: Request, res
 
 @authentication_router.post("/signin")
 def sign_in(respose: Response, requset_body: AuthAccountRequestBody, request: Request):
+    admission.admit(request, "signin", requset_body.email)
     def __sign_in():
         tokens = auth.signin(requset_body.email, requset_body.password)
-        auth.set_cookie_secured(respose, 'access_token', tokens.access_token)
-        auth.set_cookie_secured(respose, 'refresh_token', tokens.refresh_token)
-        jwt = auth.authenticate_user(request=request, fastApiResponse=respose, access_token=tokens.access_token)
-        print(f"jwt: {jwt}")
-        uuid = jwt["sub"]
+        # "sub" is read from the token issued by Cognito just now without verifying it again with JWKS,
+        # so the user item is fetched right after Cognito responds.
+        uuid = tokens.claims["sub"]
         user_item = user.fetch_item(uuid, EMPTY_SK)
+        auth.accept_issued_tokens(respose, tokens.access_token, tokens.refresh_token, tokens.claims)
         return user_item
     return hub_lambda_handler_wrapper_with_rtn_value(__sign_in, request, requset_body.dict())
 
 
 @authentication_router.post("/signout")
-def sign_out(response: Response, request: Request):
-    return hub_lambda_handler_wrapper(lambda: auth.delete_tokens_from_cookie(response), request)
+def sign_out(response: Response, request: Request, access_token: Annotated[Optional[str], Cookie()] = None):
+    return hub_lambda_handler_wrapper(lambda: auth.delete_tokens_from_cookie(response, access_token), request)
 
 
 # It's recommended to use Annotated[Optional[str], Cookie()] = None instead of Optional[str] = Cookie(None) to get a cookie value.
@@ -87,6 +89,7 @@ def refresh_token(response: Response, request: Request, refresh_token: Annotated
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Refresh token is not set in cookie. Please sign in again."
         )
+    admission.admit(request, "refresh-token", auth.get_token_digest(refresh_token))
     print(f"refresh_token: ${refresh_token}")
     return hub_lambda_handler_wrapper(lambda: auth.issue_new_access_token(refresh_token, response), request)
 
@@ -95,6 +98,7 @@ class ForgotPasswordRequestBody(BaseModel):
 
 @authentication_router.post("/forgot-password")
 def forgot_password(request: Request, response: Response, request_body: ForgotPasswordRequestBody):
+    admission.admit(request, "forgot-password", request_body.email)
     return hub_lambda_handler_wrapper(lambda: auth.send_verification_code_for_forgot_password(
         request_body.email
     ), request, request_data=request_body.dict())
@@ -1,14 +1,14 @@
 import os
 import sys
-from typing import Any, Dict, Optional
-from fastapi import APIRouter, Request, Response, Depends, Query
+from typing import Any, Dict, List, Optional
+from fastapi import APIRouter, Request, Response, Depends, Query, Header
 
 FUNCTIONS_DIR_PATH = os.path.dirname(os.path.dirname(__file__))
 sys.path.append(FUNCTIONS_DIR_PATH)
 
-from domain import timeline
-from functions.domain.authentication import authenticate_user
-from models.timeline import PostItem, CommentItem, Reaction
+from domain import timeline, idempotency
+from domain.authentication import authenticate_user_dependency, authenticate_principal, Principal
+from models.timeline import BaseTimelineItem, PostItem, CommentItem, Reaction, EditTextsRequestBody
 from utils.process import hub_lambda_handler_wrapper_with_rtn_value, hub_lambda_handler_wrapper
 
 
@@ -17,14 +17,31 @@ timeline_router = APIRouter()
 # https://fastapi.tiangolo.com/ja/tutorial/query-params/
 
 
+def __stamp_author(item: BaseTimelineItem, principal: Principal):
+    """Overwrite the author of the post/comment with the user of the access token so that nobody can post as another user."""
+    item.uuid = principal.uuid
+    # user_name and user_profile_img_url are taken from the request body as before, not from the claims.
+    # The claims keep the profile at the time the token was issued until it's refreshed (and the session cookie carries them as well),
+    # so they would stamp the old profile after update_user_name()/update_user_profile_img() have rewritten the existing posts/comments.
+
+
 @timeline_router.post("")
 def post_timeline(
         request_body: PostItem,
         request: Request,
         response: Response,
-        _: Dict[str, Any] = Depends(authenticate_user)):
+        principal: Principal = Depends(authenticate_principal),
+        idempotency_key: Optional[str] = Header(None, alias=idempotency.IDEMPOTENCY_KEY_HEADER)):
+    __stamp_author(request_body, principal)
     return hub_lambda_handler_wrapper_with_rtn_value(
-        lambda: timeline.post_timeline_item(post=request_body),
+        lambda: idempotency.run_idempotently(
+            idempotency_key,
+            scope="post-timeline",
+            owner=principal.uuid,
+            # post_id and timestamp are generated per request, so they are not a part of the request.
+            request_data={"texts": request_body.texts},
+            func=lambda: timeline.post_timeline_item(post=request_body)
+        ),
         request=request,
         request_data=request_body.dict()
     )
@@ -36,11 +53,19 @@ def post_comment(
         request_body: CommentItem,
         request: Request,
         response: Response,
-        _: Dict[str, Any] = Depends(authenticate_user)):
+        principal: Principal = Depends(authenticate_principal),
+        idempotency_key: Optional[str] = Header(None, alias=idempotency.IDEMPOTENCY_KEY_HEADER)):
+    __stamp_author(request_body, principal)
     return hub_lambda_handler_wrapper_with_rtn_value(
-        lambda: timeline.post_comment_item(
-            post_id=post_id,
-            comment=request_body
+        lambda: idempotency.run_idempotently(
+            idempotency_key,
+            scope="post-comment",
+            owner=principal.uuid,
+            request_data={"post_id": post_id, "texts": request_body.texts},
+            func=lambda: timeline.post_comment_item(
+                post_id=post_id,
+                comment=request_body
+            )
         ),
         request=request,
         request_data=request_body.dict()
@@ -53,7 +78,9 @@ def put_reaction_to_post(
         request_body: Reaction,
         request: Request,
         response: Response,
-        _: Dict[str, Any] = Depends(authenticate_user)):
+        principal: Principal = Depends(authenticate_principal)):
+    # The reaction is always the one of the user of the access token, whatever uuid the request body has.
+    request_body.uuid = principal.uuid
     return hub_lambda_handler_wrapper(
         lambda: timeline.put_reaction_to_timeline_item(
             post_id=post_id,
@@ -70,7 +97,9 @@ def put_reaction_to_comment(
         request_body: Reaction,
         request: Request,
         response: Response,
-        _: Dict[str, Any] = Depends(authenticate_user)):
+        principal: Principal = Depends(authenticate_principal)):
+    # The reaction is always the one of the user of the access token, whatever uuid the request body has.
+    request_body.uuid = principal.uuid
     return hub_lambda_handler_wrapper(
         lambda: timeline.put_reaction_to_comment_item(
             comment_id=comment_id,
@@ -81,12 +110,53 @@ def put_reaction_to_comment(
     )
 
 
+@timeline_router.put("/{post_id}")
+def edit_post(
+        post_id: str,
+        request_body: EditTextsRequestBody,
+        request: Request,
+        response: Response,
+        principal: Principal = Depends(authenticate_principal)):
+    """Returns the new version, which the client sends with the next edit."""
+    return hub_lambda_handler_wrapper_with_rtn_value(
+        lambda: timeline.edit_timeline_item(
+            post_id=post_id,
+            texts=request_body.texts,
+            version=request_body.version,
+            uuid=principal.uuid
+        ),
+        request=request,
+        request_data=request_body.dict()
+    )
+
+
+@timeline_router.put("/{post_id}/comment/{comment_id}")
+def edit_comment(
+        post_id: str,
+        comment_id: str,
+        request_body: EditTextsRequestBody,
+        request: Request,
+        response: Response,
+        principal: Principal = Depends(authenticate_principal)):
+    return hub_lambda_handler_wrapper_with_rtn_value(
+        lambda: timeline.edit_comment_item(
+            post_id=post_id,
+            comment_id=comment_id,
+            texts=request_body.texts,
+            version=request_body.version,
+            uuid=principal.uuid
+        ),
+        request=request,
+        request_data=request_body.dict()
+    )
+
+
 @timeline_router.delete("/{post_id}")
 def delete_post(
         post_id: str,
         request: Request,
         response: Response,
-        _: Dict[str, Any] = Depends(authenticate_user)):
+        _: Dict[str, Any] = Depends(authenticate_user_dependency)):
     return hub_lambda_handler_wrapper(
         lambda: timeline.delete_logical_timeline_item(post_id=post_id),
         request=request,
@@ -99,7 +169,7 @@ def delete_comment(
         comment_id: str,
         request: Request,
         response: Response,
-        _: Dict[str, Any] = Depends(authenticate_user)):
+        _: Dict[str, Any] = Depends(authenticate_user_dependency)):
     return hub_lambda_handler_wrapper(
         lambda: timeline.delete_logical_comment_item(
             post_id=post_id, comment_id=comment_id),
@@ -119,19 +189,49 @@ def get_timeline_list(
         response: Response,
         timestamp: Optional[int] = Query(None),
         post_id: Optional[str] = Query(None),
-        uuid: Optional[str] = Query(None)):
+        uuid: Optional[str] = Query(None),
+        # counts_only=true omits reactions and returns only like_count and bad_count.
+        counts_only: bool = Query(False),
+        # last_evaluated_cursor of the previous page, which is used instead of timestamp and post_id.
+        cursor: Optional[str] = Query(None),
+        # Number of posts of the page (TIMELINE_LIST_DEFAULT_LIMIT if not given), which can differ per page.
+        limit: Optional[int] = Query(None),
+        # Number of the newest comments per post embedded as comment_previews (0: none)
+        preview_comments: int = Query(0)):
     if uuid:
         return hub_lambda_handler_wrapper_with_rtn_value(
             lambda: timeline.fetch_timeline_list_by_user(
                 uuid=uuid,
                 timestamp=timestamp,
-                post_id=post_id
+                post_id=post_id,
+                counts_only=counts_only,
+                cursor=cursor,
+                limit=limit,
+                preview_comments=preview_comments
             ),
             request=request
         )
 
     return hub_lambda_handler_wrapper_with_rtn_value(
-        lambda: timeline.fetch_timeline_list(timestamp=timestamp, post_id=post_id),
+        lambda: timeline.fetch_timeline_list(timestamp=timestamp, post_id=post_id, counts_only=counts_only, cursor=cursor, limit=limit, preview_comments=preview_comments),
+        request=request
+    )
+
+
+# It must be declared before /{post_id}, otherwise "batch" is taken as post_id.
+# https://fastapi.tiangolo.com/ja/tutorial/path-params/#_4
+@timeline_router.get(
+    "/batch",
+    response_model=timeline.FetchBatchResponseBody
+)
+def get_timeline_batch(
+        request: Request,
+        response: Response,
+        # Comma-separated IDs (?ids=a,b,c) or the repeated parameter (?ids=a&ids=b&ids=c)
+        ids: List[str] = Query(...)):
+    post_ids = [post_id for value in ids for post_id in value.split(",") if post_id]
+    return hub_lambda_handler_wrapper_with_rtn_value(
+        lambda: timeline.fetch_timeline_items(post_ids=post_ids),
         request=request
     )
 
@@ -145,17 +245,41 @@ def get_comment_list(
         request: Request,
         response: Response,
         timestamp: Optional[int] = Query(None),
-        comment_id: Optional[str] = Query(None)):
+        comment_id: Optional[str] = Query(None),
+        counts_only: bool = Query(False),
+        cursor: Optional[str] = Query(None),
+        limit: Optional[int] = Query(None)):
     return hub_lambda_handler_wrapper_with_rtn_value(
         lambda: timeline.fetch_comment_list(
             post_id=post_id,
             timestamp=timestamp,
-            comment_id=comment_id
+            comment_id=comment_id,
+            counts_only=counts_only,
+            cursor=cursor,
+            limit=limit
         ),
         request=request
     )
 
 
+@timeline_router.get(
+    "/{post_id}/detail",
+    response_model=timeline.FetchDetailResponseBody
+)
+def get_timeline_detail(
+        post_id: str,
+        request: Request,
+        response: Response,
+        counts_only: bool = Query(False),
+        # Number of comments of the first page
+        limit: Optional[int] = Query(None)):
+    """The post and the first page of its comments, which GET /{post_id} and GET /{post_id}/comment/list return"""
+    return hub_lambda_handler_wrapper_with_rtn_value(
+        lambda: timeline.fetch_timeline_detail(post_id=post_id, counts_only=counts_only, limit=limit),
+        request=request
+    )
+
+
 @timeline_router.get(
     "/{post_id}",
     response_model=PostItem
@@ -7,7 +7,7 @@ FUNCTIONS_DIR_PATH = os.path.dirname(os.path.dirname(__file__))
 sys.path.append(FUNCTIONS_DIR_PATH)
 
 from domain import user
-from domain.authentication import authenticate_user
+from domain.authentication import authenticate_user_dependency
 from models.user import EMPTY_SK, UserItem, UserProfile
 from utils.process import hub_lambda_handler_wrapper_with_rtn_value, hub_lambda_handler_wrapper
 
@@ -20,7 +20,7 @@ user_router = APIRouter()
 # GET request should not have a request body. It's not recommended.
 # https://pandadannikki.blogspot.com/2021/11/riss-http02.html
 @user_router.get("/{uuid}", response_model=UserItem)
-def get_user(uuid: str, request: Request, response: Response, claims: Dict[str, Any] = Depends(authenticate_user)):
+def get_user(uuid: str, request: Request, response: Response, claims: Dict[str, Any] = Depends(authenticate_user_dependency)):
     def __get_user():
         user_item = user.fetch_item(uuid, EMPTY_SK)
         return user_item
@@ -28,7 +28,7 @@ def get_user(uuid: str, request: Request, response: Response, claims: Dict[str,
 
 
 @user_router.put("/{uuid}")
-def put_user(request_body: UserItem, request: Request, response: Response, claims: Dict[str, Any] = Depends(authenticate_user)):
+def put_user(request_body: UserItem, request: Request, response: Response, claims: Dict[str, Any] = Depends(authenticate_user_dependency)):
     return hub_lambda_handler_wrapper(lambda: user.update_item(request_body), request, request_body.dict())
 
 
@@ -46,5 +46,5 @@ def put_profile_img(
     response: Response, 
     # https://fastapi.tiangolo.com/tutorial/request-files/#file-parameters-with-uploadfile
     file: UploadFile = File(...), 
-    claims: Dict[str, Any] = Depends(authenticate_user)):
+    claims: Dict[str, Any] = Depends(authenticate_user_dependency)):
     return hub_lambda_handler_wrapper(lambda: user.update_profile_img(uuid, file), request, {"uuid": uuid, "file": file.__dict__})
\ No newline at end of file
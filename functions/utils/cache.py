@@ -0,0 +1,142 @@
+import copy
+import time
+import threading
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+
+class LRUCache:
+    """
+    Bounded in-process LRU cache whose entries expire at the given UNIX time.
+    The least recently used entry is evicted when max_size is exceeded.
+    It lives as long as the warm Lambda container, so it must not hold any data which can't be lost.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        if max_size <= 0:
+            raise ValueError("max_size must be positive")
+        self.__max_size = max_size
+        # OrderedDict keeps the order of access to find the least recently used entry in O(1).
+        # https://docs.python.org/ja/3/library/collections.html#ordereddict-examples-and-recipes
+        self.__entries: "OrderedDict[Hashable, Tuple[Any, float]]" = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+        self.__expirations = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.__misses += 1
+                return None
+            value, expires_at = entry
+            if expires_at <= time.time():
+                del self.__entries[key]
+                self.__expirations += 1
+                self.__misses += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.__hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, expires_at: float) -> None:
+        if expires_at <= time.time():
+            return
+        with self.__lock:
+            self.__entries[key] = (value, expires_at)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.__max_size:
+                self.__entries.popitem(last=False)
+                self.__evictions += 1
+
+    def delete(self, key: Hashable) -> bool:
+        with self.__lock:
+            return self.__entries.pop(key, None) is not None
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self.__lock:
+            return {
+                "size": len(self.__entries),
+                "max_size": self.__max_size,
+                "hits": self.__hits,
+                "misses": self.__misses,
+                "evictions": self.__evictions,
+                "expirations": self.__expirations,
+            }
+
+
+class ICacheBackend(metaclass=ABCMeta):
+    """
+    Backend of the read cache which maps str keys to JSON-like values (dict, list, str, int, ...) for ttl_seconds.
+    An in-memory backend serves only its Lambda container, and a shared one (ex: ElastiCache) can replace it without changing the callers.
+    A failure of the backend must not fail the request, i.e., get() returns None and set()/delete() do nothing.
+    """
+    name: str
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[Any]:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def set(self, key: str, value: Any, ttl_seconds: float) -> None:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        raise NotImplementedError()
+
+
+class InMemoryCacheBackend(ICacheBackend):
+    """LRUCache of the Lambda container. The values are copied in and out like a shared cache serializes them, so the caller can modify them."""
+    name = "memory"
+
+    def __init__(self, max_size: int) -> None:
+        self.__cache = LRUCache(max_size=max_size)
+
+    def get(self, key: str) -> Optional[Any]:
+        value = self.__cache.get(key)
+        return copy.deepcopy(value) if value is not None else None
+
+    def set(self, key: str, value: Any, ttl_seconds: float) -> None:
+        self.__cache.set(key, copy.deepcopy(value), expires_at=time.time() + ttl_seconds)
+
+    def delete(self, key: str) -> None:
+        self.__cache.delete(key)
+
+    def stats(self) -> Dict[str, int]:
+        return self.__cache.stats()
+
+
+class NullCacheBackend(ICacheBackend):
+    """Disables the cache"""
+    name = "none"
+
+    def get(self, key: str) -> Optional[Any]:
+        return None
+
+    def set(self, key: str, value: Any, ttl_seconds: float) -> None:
+        pass
+
+    def delete(self, key: str) -> None:
+        pass
+
+
+__CACHE_BACKENDS = {
+    InMemoryCacheBackend.name: lambda max_size: InMemoryCacheBackend(max_size=max_size),
+    NullCacheBackend.name: lambda max_size: NullCacheBackend(),
+}
+
+
+def create_cache_backend(backend: str, max_size: int) -> ICacheBackend:
+    """Returns the cache of the backend ("memory" or "none")."""
+    factory = __CACHE_BACKENDS.get(backend)
+    if factory is None:
+        raise ValueError(f"Unknown cache backend: {backend}. Choose one of {list(__CACHE_BACKENDS.keys())}")
+    return factory(max_size)
@@ -30,6 +30,12 @@ class DT:
     def CURRENT_JST_ISO_8601_DATETIME(cls) -> str:
         return cls.CURRENT_JST_DATETIME.strftime(ISO_DATETIME_FORMAT)
 
+    @classproperty
+    @classmethod
+    def CURRENT_TIMESTAMP_MS(cls) -> int:
+        """UNIX time in milliseconds"""
+        return int(cls.CURRENT_JST_DATETIME.timestamp() * 1000)
+
     @staticmethod
     def convert_iso_to_slushdate(iso_date: str):
         return datetime.fromisoformat(iso_date).strftime(f"%m/%d")
@@ -0,0 +1,34 @@
+from typing import Any, Dict, List, Optional
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
+
+# Table resource of boto3 deserializes items in responses, but not the item in the error response.
+# https://boto3.amazonaws.com/v1/documentation/api/latest/reference/customizations/dynamodb.html#boto3.dynamodb.types.TypeDeserializer
+__deserializer = TypeDeserializer()
+
+
+def is_conditional_check_failed(e: ClientError) -> bool:
+    return e.response.get("Error", {}).get("Code") == "ConditionalCheckFailedException"
+
+
+def get_item_on_condition_check_failure(e: ClientError) -> Optional[Dict[str, Any]]:
+    """
+    Returns the item at the time of the failure of ConditionExpression if ReturnValuesOnConditionCheckFailure="ALL_OLD" is specified,
+    or None if the item doesn't exist. It saves get_item() to find out why the condition failed.
+    https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_UpdateItem.html#DDB-UpdateItem-request-ReturnValuesOnConditionCheckFailure
+    """
+    item = e.response.get("Item")
+    if not item:
+        return None
+    return {k: __deserializer.deserialize(v) for k, v in item.items()}
+
+
+def get_cancellation_reason_codes(e: ClientError) -> List[str]:
+    """
+    Returns the code of the reason why each action of TransactWriteItems was canceled, in the same order as TransactItems.
+    The code is "None" for the actions which didn't cause the cancellation (ex: ["None", "ConditionalCheckFailed"]).
+    https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_TransactWriteItems.html#API_TransactWriteItems_Errors
+    """
+    if e.response.get("Error", {}).get("Code") != "TransactionCanceledException":
+        return []
+    return [reason.get("Code", "None") for reason in e.response.get("CancellationReasons", [])]
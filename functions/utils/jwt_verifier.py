@@ -0,0 +1,133 @@
+import json
+import time
+import base64
+import binascii
+from abc import ABCMeta, abstractmethod
+from typing import Any, Dict
+from jose import jwt, jwk, JWTError
+from jose.exceptions import JWKError
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicKey, RSAPublicNumbers
+
+
+class InvalidTokenError(Exception):
+    """Raised by every backend when the token or the key is invalid, so that the caller doesn't depend on the backend."""
+
+
+class IJwtVerifier(metaclass=ABCMeta):
+    """
+    Backend to verify the signature and the time claims ("exp" and "nbf") of JWT.
+    The key object returned by construct_key() is specific to the backend and cached by the caller per (kid, alg).
+    """
+    name: str
+
+    @abstractmethod
+    def construct_key(self, target_jwk: Dict[str, Any], alg: str) -> Any:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def verify(self, token: str, key: Any, alg: str) -> Dict[str, Any]:
+        """Returns the claims of the token if it's valid, otherwise raises InvalidTokenError."""
+        raise NotImplementedError()
+
+
+class JoseJwtVerifier(IJwtVerifier):
+    """python-jose which AWS uses in the official sample to verify JWT of Cognito"""
+    name = "jose"
+
+    def construct_key(self, target_jwk: Dict[str, Any], alg: str) -> Any:
+        try:
+            return jwk.construct(target_jwk, alg)
+        except JWKError as e:
+            raise InvalidTokenError(str(e))
+
+    def verify(self, token: str, key: Any, alg: str) -> Dict[str, Any]:
+        try:
+            # The key object is passed as it is instead of PEM to skip encoding it to PEM and parsing PEM again in jwt.decode().
+            # https://zenn.dev/osai/articles/3941f2d1de94f0
+            return dict(jwt.decode(token, key, algorithms=[alg]))
+        except (JWTError, JWKError) as e:
+            raise InvalidTokenError(str(e))
+
+
+class CryptographyJwtVerifier(IJwtVerifier):
+    """
+    Verifies RS256 signature directly with cryptography, which python-jose also uses under the hood,
+    without the generic processing of python-jose (ex: parsing options and validating every registered claim).
+    Cognito signs tokens only with RS256.
+    https://docs.aws.amazon.com/ja_jp/cognito/latest/developerguide/amazon-cognito-user-pools-using-tokens-verifying-a-jwt.html
+    """
+    name = "cryptography"
+    SUPPORTED_ALG = "RS256"
+
+    def construct_key(self, target_jwk: Dict[str, Any], alg: str) -> RSAPublicKey:
+        if alg != self.SUPPORTED_ALG or target_jwk.get("kty") != "RSA":
+            raise InvalidTokenError(f"Unsupported key. alg: {alg}, kty: {target_jwk.get('kty')}")
+        try:
+            # "n" (modulus) and "e" (exponent) of RSA public key are base64url-encoded big-endian integers.
+            # https://datatracker.ietf.org/doc/html/rfc7518#section-6.3.1
+            n = int.from_bytes(self.__b64decode(target_jwk["n"]), "big")
+            e = int.from_bytes(self.__b64decode(target_jwk["e"]), "big")
+            return RSAPublicNumbers(e, n).public_key()
+        except (KeyError, ValueError, binascii.Error) as e:
+            raise InvalidTokenError(f"Invalid JWK: {str(e)}")
+
+    def verify(self, token: str, key: RSAPublicKey, alg: str) -> Dict[str, Any]:
+        if alg != self.SUPPORTED_ALG:
+            raise InvalidTokenError(f"Unsupported alg: {alg}")
+        try:
+            header_b64, payload_b64, signature_b64 = token.split(".")
+            header = json.loads(self.__b64decode(header_b64))
+            signature = self.__b64decode(signature_b64)
+        except (ValueError, binascii.Error) as e:
+            raise InvalidTokenError(f"Malformed token: {str(e)}")
+        # alg in the header is signed as well, so it must be the same as the one the key is constructed for.
+        if not isinstance(header, dict) or header.get("alg") != alg:
+            raise InvalidTokenError("alg in the header doesn't match.")
+
+        try:
+            # The signing input of JWS is "<header>.<payload>" encoded in base64url.
+            # https://datatracker.ietf.org/doc/html/rfc7515#section-5.2
+            key.verify(signature, f"{header_b64}.{payload_b64}".encode("ascii"), padding.PKCS1v15(), hashes.SHA256())
+        except (InvalidSignature, UnicodeEncodeError):
+            raise InvalidTokenError("Signature verification failed.")
+
+        try:
+            claims = json.loads(self.__b64decode(payload_b64))
+        except (ValueError, binascii.Error) as e:
+            raise InvalidTokenError(f"Malformed payload: {str(e)}")
+        if not isinstance(claims, dict):
+            raise InvalidTokenError("Payload is not a JSON object.")
+        self.__validate_time_claims(claims)
+        return claims
+
+    @staticmethod
+    def __validate_time_claims(claims: Dict[str, Any]) -> None:
+        # https://datatracker.ietf.org/doc/html/rfc7519#section-4.1.4
+        now = time.time()
+        exp = claims.get("exp")
+        if exp is not None and (not isinstance(exp, (int, float)) or exp <= now):
+            raise InvalidTokenError("Signature has expired.")
+        nbf = claims.get("nbf")
+        if nbf is not None and (not isinstance(nbf, (int, float)) or nbf > now):
+            raise InvalidTokenError("The token is not yet valid (nbf).")
+
+    @staticmethod
+    def __b64decode(data: str) -> bytes:
+        return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+__JWT_VERIFIERS = {
+    JoseJwtVerifier.name: JoseJwtVerifier,
+    CryptographyJwtVerifier.name: CryptographyJwtVerifier,
+}
+
+
+def create_jwt_verifier(backend: str) -> IJwtVerifier:
+    """Returns the verifier of the backend ("jose" or "cryptography")."""
+    verifier_class = __JWT_VERIFIERS.get(backend)
+    if verifier_class is None:
+        raise ValueError(f"Unknown JWT verifier backend: {backend}. Choose one of {list(__JWT_VERIFIERS.keys())}")
+    return verifier_class()
@@ -0,0 +1,54 @@
+import time
+import threading
+
+
+class TokenBucket:
+    """
+    Token bucket which holds up to capacity tokens and is refilled at refill_per_second.
+    A burst up to capacity is allowed and the sustained rate is limited to refill_per_second.
+    https://en.wikipedia.org/wiki/Token_bucket
+    """
+
+    def __init__(self, capacity: float, refill_per_second: float) -> None:
+        if capacity <= 0 or refill_per_second <= 0:
+            raise ValueError("capacity and refill_per_second must be positive")
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.__tokens = float(capacity)
+        # time.monotonic() is used instead of time.time() not to be affected by the change of the system clock.
+        # https://docs.python.org/ja/3/library/time.html#time.monotonic
+        self.__updated_at = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def __refill(self) -> None:
+        now = time.monotonic()
+        self.__tokens = min(self.capacity, self.__tokens + (now - self.__updated_at) * self.refill_per_second)
+        self.__updated_at = now
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        """Take the tokens and return True if available, otherwise return False without waiting."""
+        with self.__lock:
+            self.__refill()
+            if self.__tokens < tokens:
+                return False
+            self.__tokens -= tokens
+            return True
+
+    def acquire(self, tokens: float = 1) -> None:
+        """Wait until the tokens are available and take them. It's for background jobs, not for requests of users."""
+        if tokens > self.capacity:
+            raise ValueError("tokens must not exceed capacity")
+        while not self.try_acquire(tokens):
+            # Other threads may take the refilled tokens first, so check again after waiting.
+            time.sleep(max(self.seconds_until_available(tokens), 0.001))
+
+    def seconds_until_available(self, tokens: float = 1) -> float:
+        with self.__lock:
+            self.__refill()
+            return max(0.0, (tokens - self.__tokens) / self.refill_per_second)
+
+    def seconds_until_full(self) -> float:
+        """The bucket is identical to a new one after this period, so it can be discarded when it's idle for this period."""
+        with self.__lock:
+            self.__refill()
+            return (self.capacity - self.__tokens) / self.refill_per_second
@@ -0,0 +1,79 @@
+import os
+import time
+import threading
+from typing import Optional
+
+# ULID is a 128-bit ID which consists of 48-bit UNIX time in milliseconds and 80-bit randomness,
+# encoded in 26 characters of Crockford's Base32. IDs sort lexicographically in the order of their creation time.
+# https://github.com/ulid/spec
+# Lowercase is used to be consistent with the legacy IDs (uuid4().hex). ULID is case-insensitive.
+__ENCODING = "0123456789abcdefghjkmnpqrstvwxyz"
+__DECODING = {c: i for i, c in enumerate(__ENCODING)}
+ULID_LENGTH = 26
+TIMESTAMP_BITS = 48
+RANDOMNESS_BITS = 80
+MAX_RANDOMNESS = (1 << RANDOMNESS_BITS) - 1
+MAX_TIMESTAMP_MS = (1 << TIMESTAMP_BITS) - 1
+
+
+class MonotonicUlidGenerator:
+    """
+    Generates ULIDs which are strictly increasing in the process even if they are generated in the same millisecond
+    or the system clock goes back, by incrementing the randomness of the previous ULID instead of generating new one.
+    https://github.com/ulid/spec#monotonicity
+    """
+
+    def __init__(self) -> None:
+        self.__last_timestamp_ms = -1
+        self.__last_randomness = 0
+        self.__lock = threading.Lock()
+
+    def generate(self, timestamp_ms: Optional[int] = None) -> str:
+        if timestamp_ms is None:
+            timestamp_ms = time.time_ns() // 1_000_000
+        with self.__lock:
+            if timestamp_ms <= self.__last_timestamp_ms:
+                timestamp_ms = self.__last_timestamp_ms
+                randomness = self.__last_randomness + 1
+                if randomness > MAX_RANDOMNESS:
+                    # Practically unreachable (2^80 IDs in a millisecond), so move on to the next millisecond.
+                    timestamp_ms += 1
+                    randomness = int.from_bytes(os.urandom(10), "big")
+            else:
+                randomness = int.from_bytes(os.urandom(10), "big")
+            self.__last_timestamp_ms = timestamp_ms
+            self.__last_randomness = randomness
+        return encode_ulid(timestamp_ms, randomness)
+
+
+def encode_ulid(timestamp_ms: int, randomness: int) -> str:
+    if not 0 <= timestamp_ms <= MAX_TIMESTAMP_MS:
+        raise ValueError(f"timestamp_ms is out of range: {timestamp_ms}")
+    value = (timestamp_ms << RANDOMNESS_BITS) | (randomness & MAX_RANDOMNESS)
+    chars = []
+    for _ in range(ULID_LENGTH):
+        chars.append(__ENCODING[value & 0x1f])
+        value >>= 5
+    return "".join(reversed(chars))
+
+
+def is_ulid(value: str) -> bool:
+    # The first character is 7 at most because ULID is 128 bits of 130 bits (26 characters * 5 bits).
+    return len(value) == ULID_LENGTH and value[0] in "01234567" and all([c in __DECODING for c in value.lower()])
+
+
+def decode_timestamp_ms(value: str) -> Optional[int]:
+    """Returns UNIX time in milliseconds when the ULID was generated, or None if the value is not ULID (ex: uuid4().hex)."""
+    if not is_ulid(value):
+        return None
+    decoded = 0
+    for c in value.lower():
+        decoded = (decoded << 5) | __DECODING[c]
+    return decoded >> RANDOMNESS_BITS
+
+
+__generator = MonotonicUlidGenerator()
+
+
+def generate_ulid(timestamp_ms: Optional[int] = None) -> str:
+    return __generator.generate(timestamp_ms)
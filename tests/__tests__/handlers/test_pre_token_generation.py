@@ -0,0 +1,37 @@
+import os
+import sys
+
+ROOT_DIR_PATH = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+sys.path.append(ROOT_DIR_PATH)
+
+from functions.handlers.auth import pre_token_generation
+from functions.models.user import AUTHORITY
+
+from tests.samples.user import PYTEST_USER_UUID
+
+
+def make_event():
+    # https://docs.aws.amazon.com/cognito/latest/developerguide/user-pool-lambda-pre-token-generation.html
+    return {
+        "version": "2",
+        "triggerSource": "TokenGeneration_Authentication",
+        "userName": PYTEST_USER_UUID,
+        "request": {"userAttributes": {"email": "pytest@example.com"}},
+        "response": {"claimsAndScopeOverrideDetails": None},
+    }
+
+
+class TestPreTokenGeneration:
+    def test_embed_user_item_in_access_token(self, monkeypatch):
+        monkeypatch.setattr(pre_token_generation, "fetch_item", lambda uuid, sk: {
+            "uuid": uuid, "sk": sk, "email": "pytest@example.com", "name": "pytest",
+            "user_profile_img_url": "https://example.com/pytest.png", "is_admin": AUTHORITY.ADMIN.value
+        })
+        event = pre_token_generation.lambda_handler(make_event(), None)
+        claims = event["response"]["claimsAndScopeOverrideDetails"]["accessTokenGeneration"]["claimsToAddOrOverride"]
+        assert claims == {"is_admin": True, "name": "pytest", "user_profile_img_url": "https://example.com/pytest.png"}
+
+    def test_issue_tokens_without_user_item(self, monkeypatch):
+        monkeypatch.setattr(pre_token_generation, "fetch_item", lambda uuid, sk: {})
+        event = pre_token_generation.lambda_handler(make_event(), None)
+        assert event["response"]["claimsAndScopeOverrideDetails"] is None
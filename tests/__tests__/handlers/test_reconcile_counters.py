@@ -0,0 +1,105 @@
+import os
+import sys
+import pytest
+
+ROOT_DIR_PATH = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+sys.path.append(ROOT_DIR_PATH)
+
+from functions.handlers.timeline.reconcile_counters import reconcile_counters, count_active_comments
+from functions.domain import timeline
+from functions.models.timeline import CommentItem, PostItem
+from functions.utils.aws import dynamodb_resource
+from functions.utils.dt import DT
+from functions.conf.env import STAGE
+from functions.conf.util import IS_PROD
+
+from tests.samples.user import PYTEST_USER_UUID, PYTEST_USER_NAME
+
+if IS_PROD:
+    pytest.skip("Skip the test for production environment", allow_module_level=True)
+
+
+def test_reconcile_drifted_counters():
+    post = PostItem(**{
+        "uuid": PYTEST_USER_UUID,
+        "user_name": PYTEST_USER_NAME,
+        "texts": f"Reconcile counters\n{DT.CURRENT_JST_ISO_8601_DATETIME}",
+        "reaction_by_user": {PYTEST_USER_UUID: 1},
+    })
+    post_id = timeline.post_timeline_item(post).get("post_id")
+    for _ in range(2):
+        timeline.post_comment_item(post_id=post_id, comment=CommentItem(**{
+            "post_id": post_id,
+            "uuid": PYTEST_USER_UUID,
+            "user_name": PYTEST_USER_NAME,
+            "texts": f"Reconcile counters\n{DT.CURRENT_JST_ISO_8601_DATETIME}",
+        }))
+    assert count_active_comments(post_id) == 2
+
+    # Make the counters drift
+    dynamodb_resource.Table(f"terakoya-{STAGE}-timeline-post").update_item(
+        Key={"post_id": post_id},
+        UpdateExpression="SET comment_count = :comment_count, like_count = :like_count",
+        ExpressionAttributeValues={":comment_count": 5, ":like_count": 0}
+    )
+
+    report = reconcile_counters(since=post.timestamp)
+    print(f"report: {report}")
+    assert report["mode"] == "incremental"
+    assert report["fixed_posts"] >= 1
+
+    timeline_item = timeline.fetch_timeline_item(post_id)
+    assert timeline_item.get("comment_count") == 2
+    assert timeline_item.get("like_count") == 1
+
+
+
+@pytest.mark.parametrize("index_enabled", [True, False])
+def test_incremental_run_resumes_from_saved_watermark(monkeypatch, index_enabled):
+    """
+    Posts commented or reacted after the watermark are checked as well as new ones, and the watermark is saved for the next run.
+    They are read from timeline-post-counters-updated GSI once it's deployed, and filtered from timeline-post-all GSI before that.
+    """
+    from functions.handlers.timeline import reconcile_counters as module
+
+    old_post = {"post_id": "old", "comment_count": 1, "like_count": 0, "bad_count": 0, "reaction_by_user": {PYTEST_USER_UUID: 1}}
+    new_post = {"post_id": "new", "comment_count": 0, "like_count": 0, "bad_count": 0, "reaction_by_user": {}}
+    queries = []
+    watermarks = {}
+
+    class FakeClient:
+        def query(self, **params):
+            queries.append(params)
+            if params["IndexName"].endswith("comment-for-post"):
+                return {"Count": 1 if params["ExpressionAttributeValues"][":post_id"] == "old" else 0}
+            if params["ExpressionAttributeValues"][":pk"] != "pk_for_all_post_gsi":
+                return {"Items": []}
+            if params["IndexName"].endswith("post-all") and "FilterExpression" not in params:
+                return {"Items": [new_post]}
+            # The new post is in both GSIs because it has got a reaction
+            return {"Items": [old_post, new_post]}
+
+        def get_item(self, **params):
+            assert params["TableName"].endswith("timeline-reconcile-state")
+            return {"Item": {**params["Key"], "watermark": watermarks["saved"]}} if "saved" in watermarks else {}
+
+        def update_item(self, **params):
+            if params["TableName"].endswith("timeline-reconcile-state"):
+                watermarks["saved"] = params["ExpressionAttributeValues"][":watermark"]
+
+    monkeypatch.setattr(module, "__client", FakeClient())
+    monkeypatch.setattr(module, "COUNTER_RECONCILIATION_COUNTERS_INDEX_ENABLED", index_enabled)
+    first_report = reconcile_counters()
+    assert first_report["scanned_posts"] == 2
+    assert first_report["fixed_reaction_counts"] == 1
+    assert watermarks["saved"] == first_report["watermark"]
+    post_queries = [q for q in queries if not q["IndexName"].endswith("comment-for-post")]
+    if index_enabled:
+        assert {q["ExpressionAttributeNames"]["#sort_key"] for q in post_queries} == {"timestamp", "counters_updated_at"}
+    else:
+        assert all([q["IndexName"].endswith("post-all") and "FilterExpression" in q for q in post_queries])
+
+    queries.clear()
+    second_report = reconcile_counters()
+    assert second_report["since"] == first_report["watermark"]
+    assert all([q["ExpressionAttributeValues"][":since"] == first_report["watermark"] for q in queries if ":since" in q["ExpressionAttributeValues"]])
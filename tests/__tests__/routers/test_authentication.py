@@ -0,0 +1,339 @@
+import os
+import sys
+import time
+import asyncio
+import pytest
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import FastAPI, Depends, Request, Response, HTTPException
+from fastapi.testclient import TestClient
+
+ROOT_DIR_PATH = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+sys.path.append(ROOT_DIR_PATH)
+
+from tests.samples.authentication import sample_jwks, make_access_token, SAMPLE_KID
+from tests.samples.user import PYTEST_USER_UUID
+from functions.domain import authentication as auth, admission
+from botocore.exceptions import ClientError
+from functions.middlewares import TokenRefreshMiddleware
+
+
+def make_request(cookies: dict = {}) -> Request:
+    cookie_header = "; ".join([f"{k}={v}" for k, v in cookies.items()])
+    return Request({
+        "type": "http",
+        "method": "GET",
+        "path": "/pytest",
+        "headers": [(b"cookie", cookie_header.encode("utf-8"))] if cookie_header else [],
+    })
+
+
+class JwksFetcher:
+    """Fake of get_cognito_jwks() which counts the number of requests to Cognito"""
+
+    def __init__(self) -> None:
+        self.call_count = 0
+        self.error = None
+
+    def __call__(self):
+        self.call_count += 1
+        if self.error is not None:
+            raise self.error
+        return sample_jwks
+
+
+@pytest.fixture
+def jwks_fetcher(monkeypatch):
+    fetcher = JwksFetcher()
+    monkeypatch.setattr(auth, "get_cognito_jwks", fetcher)
+    auth.clear_auth_caches()
+    yield fetcher
+    auth.clear_auth_caches()
+
+
+class TestJwksCache:
+    def test_fetch_jwks_only_once(self, jwks_fetcher: JwksFetcher):
+        for _ in range(3):
+            claims = auth.authenticate_user(Response(), make_request(), make_access_token())
+            assert claims.get("sub") == PYTEST_USER_UUID
+        assert jwks_fetcher.call_count == 1
+
+    def test_serve_last_good_jwks_on_error(self, jwks_fetcher: JwksFetcher):
+        cache = auth.CognitoJwksCache(ttl_seconds=0, min_refresh_interval_seconds=0)
+        assert cache.get_jwk(SAMPLE_KID) is not None
+
+        # The cache is expired (ttl_seconds=0) but the refetch fails.
+        jwks_fetcher.error = requests.ConnectionError("Cognito is unreachable")
+        assert cache.get_jwk(SAMPLE_KID) is not None
+        assert jwks_fetcher.call_count == 2
+
+    def test_refetch_on_unknown_kid_is_throttled(self, jwks_fetcher: JwksFetcher):
+        cache = auth.CognitoJwksCache(ttl_seconds=3600)
+        assert cache.get_jwk(SAMPLE_KID) is not None
+        assert cache.get_jwk("unknown-kid") is None
+        assert cache.get_jwk("unknown-kid") is None
+        # Unknown kid doesn't trigger refetch within JWKS_MIN_REFRESH_INTERVAL_SECONDS.
+        assert jwks_fetcher.call_count == 1
+
+    def test_reject_token_with_unknown_kid(self, jwks_fetcher: JwksFetcher):
+        with pytest.raises(HTTPException) as e:
+            auth.authenticate_user(Response(), make_request(), make_access_token(kid="unknown-kid"))
+        assert e.value.status_code == 401
+
+    def test_reuse_public_key_until_jwks_is_rotated(self, jwks_fetcher: JwksFetcher, monkeypatch):
+        cache = auth.CognitoJwksCache(ttl_seconds=0, min_refresh_interval_seconds=0)
+        public_key = cache.get_public_key(SAMPLE_KID, "RS256")
+        assert public_key is not None
+        assert cache.get_public_key(SAMPLE_KID, "RS256") is public_key
+        # alg which is different from the one of the JWK is rejected.
+        assert cache.get_public_key(SAMPLE_KID, "HS256") is None
+
+        # Rotate the signing keys.
+        rotated_jwks = {SAMPLE_KID: {**sample_jwks[SAMPLE_KID], "x-rotated": "true"}}
+        monkeypatch.setattr(auth, "get_cognito_jwks", lambda: rotated_jwks)
+        assert cache.get_public_key(SAMPLE_KID, "RS256") is not public_key
+
+
+class TestClaimsCache:
+    def test_skip_verification_for_same_token(self, jwks_fetcher: JwksFetcher, monkeypatch):
+        access_token = make_access_token()
+        auth.authenticate_user(Response(), make_request(), access_token)
+
+        # Signature verification is skipped for the cached token.
+        def fail_to_decode(*args, **kwargs):
+            raise AssertionError("jwt.decode() must not be called")
+        monkeypatch.setattr(auth.jwt, "decode", fail_to_decode)
+        claims = auth.authenticate_user(Response(), make_request(), access_token)
+        assert claims.get("sub") == PYTEST_USER_UUID
+        assert auth.get_claims_cache_stats()["hits"] >= 1
+
+    def test_drop_claims_when_signing_out(self, jwks_fetcher: JwksFetcher):
+        access_token = make_access_token()
+        auth.authenticate_user(Response(), make_request(), access_token)
+        size = auth.get_claims_cache_stats()["size"]
+
+        auth.delete_tokens_from_cookie(Response(), access_token)
+        assert auth.get_claims_cache_stats()["size"] == size - 1
+
+    def test_reject_expired_token(self, jwks_fetcher: JwksFetcher):
+        with pytest.raises(HTTPException) as e:
+            auth.authenticate_user(Response(), make_request(), make_access_token(expires_in_seconds=-1))
+        assert e.value.status_code == 401
+
+
+class TestSessionCookie:
+    @pytest.fixture(autouse=True)
+    def enable_session_cookie(self, jwks_fetcher: JwksFetcher, monkeypatch):
+        monkeypatch.setattr(auth, "SESSION_COOKIE_SECRET", "pytest-secret")
+
+    def mint(self, access_token: str) -> str:
+        response = Response()
+        auth.authenticate_user(response, make_request(), access_token)
+        session = response.headers.get("set-cookie", "").split(";")[0].split("=", 1)
+        assert session[0] == auth.SESSION_COOKIE_KEY
+        return session[1]
+
+    def test_authenticate_with_session_cookie(self, monkeypatch):
+        access_token = make_access_token()
+        session = self.mint(access_token)
+
+        # Another Lambda container which doesn't have the claims in its cache.
+        auth.clear_auth_caches()
+        monkeypatch.setattr(auth, "get_cognito_jwks", lambda: {})
+        claims = auth.authenticate_user(Response(), make_request({"session": session}), access_token)
+        assert claims.get("sub") == PYTEST_USER_UUID
+
+    def test_reject_forged_session_cookie(self):
+        access_token = make_access_token()
+        session = self.mint(access_token)
+        payload_b64, signature_b64 = session.split(".")
+        token_digest = auth.get_token_digest(access_token)
+
+        assert auth.verify_session_cookie(session, token_digest) is not None
+        assert auth.verify_session_cookie(f"{payload_b64}.{signature_b64[:-2]}AA", token_digest) is None
+        # Session cookie minted for another access token
+        assert auth.verify_session_cookie(session, auth.get_token_digest(make_access_token(foo="bar"))) is None
+
+    def test_session_cookie_never_outlives_access_token(self):
+        access_token = make_access_token(expires_in_seconds=2)
+        session = self.mint(access_token)
+        assert auth.verify_session_cookie(session, auth.get_token_digest(access_token)).get("exp") <= int(time.time()) + 2
+
+
+class TestPrincipal:
+    def test_build_principal_from_custom_claims(self, jwks_fetcher: JwksFetcher):
+        access_token = make_access_token(is_admin=True, name="pytest", user_profile_img_url="https://example.com/pytest.png")
+        claims = auth.authenticate_user(Response(), make_request(), access_token)
+        principal = auth.Principal.from_claims(claims)
+        assert principal == auth.Principal(PYTEST_USER_UUID, True, "pytest", "https://example.com/pytest.png")
+
+    def test_principal_without_custom_claims(self, jwks_fetcher: JwksFetcher):
+        claims = auth.authenticate_user(Response(), make_request(), make_access_token())
+        principal = auth.Principal.from_claims(claims)
+        assert principal.is_admin is False and principal.name is None
+
+    def test_session_cookie_carries_custom_claims(self, jwks_fetcher: JwksFetcher, monkeypatch):
+        monkeypatch.setattr(auth, "SESSION_COOKIE_SECRET", "pytest-secret")
+        access_token = make_access_token(is_admin=True, name="pytest")
+        response = Response()
+        auth.authenticate_user(response, make_request(), access_token)
+        session = response.headers.get("set-cookie", "").split(";")[0].split("=", 1)[1]
+
+        claims = auth.verify_session_cookie(session, auth.get_token_digest(access_token))
+        assert auth.Principal.from_claims(claims) == auth.Principal(PYTEST_USER_UUID, True, "pytest")
+
+
+class TestAuthenticateUserAsync:
+    def test_share_inflight_jwks_fetch(self, jwks_fetcher: JwksFetcher, monkeypatch):
+        async def get_cognito_jwks_async():
+            jwks_fetcher.call_count += 1
+            await asyncio.sleep(0.05)  # Network latency
+            return sample_jwks
+        monkeypatch.setattr(auth, "get_cognito_jwks_async", get_cognito_jwks_async)
+
+        async def authenticate_concurrently():
+            return await asyncio.gather(*[
+                auth.authenticate_user_async(Response(), make_request(), make_access_token(jti=str(i))) for i in range(5)
+            ])
+
+        claims_list = asyncio.run(authenticate_concurrently())
+        assert all([claims.get("sub") == PYTEST_USER_UUID for claims in claims_list])
+        assert jwks_fetcher.call_count == 1
+
+
+class TestSignin:
+    def test_accept_issued_tokens_without_verification(self, jwks_fetcher: JwksFetcher, monkeypatch):
+        access_token = make_access_token()
+        monkeypatch.setattr(auth.cognito_client, "initiate_auth", lambda **kwargs: {
+            "AuthenticationResult": {"AccessToken": access_token, "RefreshToken": "pytest-refresh-token"}
+        })
+
+        tokens = auth.signin("pytest@example.com", "password")
+        assert tokens.claims.get("sub") == PYTEST_USER_UUID
+
+        response = Response()
+        auth.accept_issued_tokens(response, tokens.access_token, tokens.refresh_token, tokens.claims)
+        claims = auth.authenticate_user(Response(), make_request(), access_token)
+        assert claims.get("sub") == PYTEST_USER_UUID
+        # JWKS is never fetched during sign-in and the following request.
+        assert jwks_fetcher.call_count == 0
+
+
+class CognitoRefresher:
+    """Fake of initiate_auth() with REFRESH_TOKEN_AUTH which counts the number of requests to Cognito"""
+
+    def __init__(self) -> None:
+        self.call_count = 0
+        self.access_token = make_access_token()
+
+    def __call__(self, **kwargs):
+        self.call_count += 1
+        time.sleep(0.05)  # Network latency
+        if kwargs["AuthParameters"]["REFRESH_TOKEN"] != "pytest-refresh-token":
+            raise auth.cognito_client.exceptions.NotAuthorizedException(
+                {"Error": {"Code": "NotAuthorizedException"}}, "InitiateAuth")
+        return {"AuthenticationResult": {"AccessToken": self.access_token}}
+
+
+@pytest.fixture
+def cognito_refresher(jwks_fetcher: JwksFetcher, monkeypatch):
+    refresher = CognitoRefresher()
+    monkeypatch.setattr(auth.cognito_client, "initiate_auth", refresher)
+    return refresher
+
+
+class TestTokenRefreshMiddleware:
+    @pytest.fixture
+    def client(self):
+        app = FastAPI()
+
+        @app.get("/pytest")
+        def get_claims(claims=Depends(auth.authenticate_user)):
+            return {"sub": claims.get("sub")}
+        app.add_middleware(TokenRefreshMiddleware)
+        return TestClient(app)
+
+    def test_refresh_expired_access_token(self, client: TestClient, cognito_refresher: CognitoRefresher):
+        response = client.get("/pytest", cookies={
+            "access_token": make_access_token(expires_in_seconds=-1),
+            "refresh_token": "pytest-refresh-token"
+        })
+        assert response.status_code == 200
+        assert response.json().get("sub") == PYTEST_USER_UUID
+        set_cookie = response.headers.get("set-cookie", "")
+        assert f"access_token={cognito_refresher.access_token}" in set_cookie
+        assert "refresh_token=pytest-refresh-token" in set_cookie
+
+    def test_pass_through_when_refresh_fails(self, client: TestClient, cognito_refresher: CognitoRefresher):
+        response = client.get("/pytest", cookies={
+            "access_token": make_access_token(expires_in_seconds=-1),
+            "refresh_token": "invalid-refresh-token"
+        })
+        assert response.status_code == 401
+
+    def test_skip_refresh_for_fresh_access_token(self, client: TestClient, cognito_refresher: CognitoRefresher):
+        response = client.get("/pytest", cookies={
+            "access_token": make_access_token(),
+            "refresh_token": "pytest-refresh-token"
+        })
+        assert response.status_code == 200
+        assert cognito_refresher.call_count == 0
+
+    def test_coalesce_concurrent_refreshes(self, cognito_refresher: CognitoRefresher):
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            tokens_list = list(executor.map(lambda _: auth.refresh_tokens("pytest-refresh-token"), range(5)))
+        assert all([tokens.access_token == cognito_refresher.access_token for tokens in tokens_list])
+        assert cognito_refresher.call_count == 1
+
+
+class RateLimitTable:
+    """Fake of terakoya-{STAGE}-rate-limit table which evaluates the condition of update_item()"""
+
+    def __init__(self) -> None:
+        self.counts = {}
+
+    def update_item(self, Key, ExpressionAttributeValues, **kwargs):
+        count = self.counts.get(Key["key"], 0)
+        if count >= ExpressionAttributeValues[":limit"]:
+            raise ClientError({"Error": {"Code": "ConditionalCheckFailedException"}}, "UpdateItem")
+        self.counts[Key["key"]] = count + 1
+
+
+class TestAdmission:
+    @pytest.fixture(autouse=True)
+    def clear_admission_state(self):
+        admission.clear_admission_state()
+        yield
+        admission.clear_admission_state()
+
+    def test_throttle_by_identity(self, monkeypatch):
+        monkeypatch.setattr(admission, "ADMISSION_IDENTITY_BURST", 3)
+        for _ in range(3):
+            admission.admit(make_request(), "signin", "pytest@example.com")
+        with pytest.raises(HTTPException) as e:
+            # Email is case-insensitive.
+            admission.admit(make_request(), "signin", "PYTEST@example.com")
+        assert e.value.status_code == 429
+        assert int(e.value.headers["Retry-After"]) >= 1
+        # Another identity is not affected.
+        admission.admit(make_request(), "signin", "another@example.com")
+
+        stats = admission.get_admission_stats()
+        assert stats["admitted"] == 4 and stats["throttled_by_identity"] == 1
+
+    def test_shared_tier_counts_across_containers(self, monkeypatch):
+        monkeypatch.setattr(admission, "ADMISSION_SHARED_TIER_ENABLED", True)
+        monkeypatch.setattr(admission, "ADMISSION_SHARED_IDENTITY_LIMIT", 2)
+        monkeypatch.setattr(admission, "__table", RateLimitTable())
+        assert admission.try_admit(make_request(), "signin", "pytest@example.com") is None
+        # Another Lambda container which has its own in-memory buckets.
+        admission.clear_admission_state()
+        assert admission.try_admit(make_request(), "signin", "pytest@example.com") is None
+        assert admission.try_admit(make_request(), "signin", "pytest@example.com") is not None
+        assert admission.get_admission_stats()["throttled_by_shared_tier"] == 1
+
+    def test_coalesced_refresh_is_admitted_once(self, cognito_refresher: CognitoRefresher):
+        admitted = []
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            list(executor.map(lambda _: auth.refresh_tokens("pytest-refresh-token", lambda: admitted.append(True)), range(5)))
+        assert len(admitted) == cognito_refresher.call_count == 1
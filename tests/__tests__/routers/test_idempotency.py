@@ -0,0 +1,79 @@
+import os
+import sys
+import pytest
+from boto3.dynamodb.types import TypeSerializer
+from botocore.exceptions import ClientError
+from fastapi import HTTPException
+
+ROOT_DIR_PATH = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+sys.path.append(ROOT_DIR_PATH)
+
+from functions.domain import idempotency
+
+
+class IdempotencyTable:
+    """Fake of terakoya-{STAGE}-idempotency table whose put_item() fails if the record exists"""
+
+    def __init__(self) -> None:
+        self.records = {}
+
+    def put_item(self, Item, **kwargs):
+        existing = self.records.get(Item["key"])
+        if existing is not None:
+            serializer = TypeSerializer()
+            raise ClientError({
+                "Error": {"Code": "ConditionalCheckFailedException"},
+                "Item": {k: serializer.serialize(v) for k, v in existing.items()},
+            }, "PutItem")
+        self.records[Item["key"]] = dict(Item)
+
+    def update_item(self, Key, ExpressionAttributeValues, **kwargs):
+        record = self.records[Key["key"]]
+        record["status"] = ExpressionAttributeValues[":completed"]
+        record["result"] = ExpressionAttributeValues[":result"]
+
+    def delete_item(self, Key):
+        self.records.pop(Key["key"], None)
+
+
+class TestIdempotency:
+    @pytest.fixture(autouse=True)
+    def table(self, monkeypatch):
+        table = IdempotencyTable()
+        monkeypatch.setattr(idempotency, "__table", table)
+        return table
+
+    def test_replay_stored_result(self):
+        calls = []
+
+        def post():
+            calls.append(1)
+            return {"post_id": f"post-{len(calls)}"}
+        first = idempotency.run_idempotently("key-1", "post-timeline", "pytest", {"texts": "hello"}, post)
+        second = idempotency.run_idempotently("key-1", "post-timeline", "pytest", {"texts": "hello"}, post)
+        assert first == second == {"post_id": "post-1"}
+        assert len(calls) == 1
+        # Another user or no key runs the operation.
+        idempotency.run_idempotently("key-1", "post-timeline", "another", {"texts": "hello"}, post)
+        idempotency.run_idempotently(None, "post-timeline", "pytest", {"texts": "hello"}, post)
+        assert len(calls) == 3
+
+    def test_reject_in_progress_and_different_request(self, table):
+        def post_during_first_request():
+            with pytest.raises(HTTPException) as e:
+                idempotency.run_idempotently("key-2", "post-timeline", "pytest", {"texts": "hello"}, lambda: {})
+            assert e.value.status_code == 409
+            return {"post_id": "post-1"}
+        idempotency.run_idempotently("key-2", "post-timeline", "pytest", {"texts": "hello"}, post_during_first_request)
+
+        with pytest.raises(HTTPException) as e:
+            idempotency.run_idempotently("key-2", "post-timeline", "pytest", {"texts": "different"}, lambda: {})
+        assert e.value.status_code == 422
+
+    def test_retry_after_failure(self, table):
+        def fail():
+            raise HTTPException(status_code=404)
+        with pytest.raises(HTTPException):
+            idempotency.run_idempotently("key-3", "post-comment", "pytest", {"texts": "hello"}, fail)
+        assert table.records == {}
+        assert idempotency.run_idempotently("key-3", "post-comment", "pytest", {"texts": "hello"}, lambda: {"ok": 1}) == {"ok": 1}
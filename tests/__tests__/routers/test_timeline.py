@@ -3,8 +3,13 @@ import sys
 from decimal import Decimal
 from typing import List
 import requests
+import io
 import json
+import zlib
+import base64
+import threading
 import pytest
+from fastapi import HTTPException
 
 ROOT_DIR_PATH = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
 sys.path.append(ROOT_DIR_PATH)
@@ -13,9 +18,11 @@ from tests.samples.user import pytest_user_account_request_body_json, PYTEST_USE
 from tests.samples.timeline import post_timeline_item_json, post_comment_item_json, put_reaction_json, TYPE_LIKE
 from tests.utils.const import base_url, headers
 from functions.utils.dt import DT
-from functions.models.timeline import CommentItem, PostItem, Reaction
+from functions.models.timeline import CommentItem, PostItem, Reaction, post_gsi_shard_key, post_gsi_shard_keys
+from functions.utils.cache import InMemoryCacheBackend
 from functions.domain import timeline
 from functions.conf.util import IS_PROD
+from functions.conf.env import TIMELINE_LIST_MAX_LIMIT, TIMELINE_BATCH_MAX_IDS, TIMELINE_PREVIEW_COMMENTS_MAX
 
 if IS_PROD:
     # allow_module_level=True is required to skip the test on the module(file) level
@@ -115,6 +122,7 @@ class TestFunc:
         assert len(reactions) == 1
         assert reactions[0].get("uuid") == PYTEST_USER_UUID
         assert reactions[0].get("type") == 1
+        assert timeline_item.get("like_count") == 1
 
         # Put the new reaction to the test data
         timeline.put_reaction_to_timeline_item(
@@ -129,10 +137,113 @@ class TestFunc:
         reactions = timeline_item.get("reactions", [])
         assert len(reactions) == 1
         assert reactions[0].get("type") == 2
+        assert timeline_item.get("like_count") == 0
+        assert timeline_item.get("bad_count") == 1
+
+        # Put the same reaction again to remove it
+        timeline.put_reaction_to_timeline_item(
+            post_id=post_id,
+            reaction=Reaction(uuid=PYTEST_USER_UUID, type=2)  # Bad
+        )
+        timeline_item = timeline.fetch_timeline_item(post_id)
+        assert timeline_item.get("reactions", []) == []
+        assert timeline_item.get("bad_count") == 0
 
         # Clean up the test data
         # timeline.delete_timeline_item(post_id)
 
+    def test_reactions_are_stored_as_map(self):
+        """reactions is derived from reaction_by_user map stored in DynamoDB"""
+        post_item = PostItem(**{
+            "uuid": PYTEST_USER_UUID,
+            "reaction_by_user": {PYTEST_USER_UUID: Decimal(1)},
+        })
+        assert post_item.reactions == [Reaction(uuid=PYTEST_USER_UUID, type=1)]
+        dynamodb_item = post_item.to_dynamodb_item()
+        assert "reactions" not in dynamodb_item
+        assert dynamodb_item["reaction_by_user"] == {PYTEST_USER_UUID: 1}
+        # reaction_by_user is not included in the response of API
+        assert "reaction_by_user" not in post_item.dict()
+
+        # Legacy item which stores reactions as a list
+        legacy_item = PostItem(**{
+            "uuid": PYTEST_USER_UUID,
+            "reactions": [{"uuid": PYTEST_USER_UUID, "type": Decimal(2)}],
+        })
+        assert legacy_item.reaction_by_user == {PYTEST_USER_UUID: 2}
+        # Counters are counted from reactions if the item has not been backfilled yet.
+        assert legacy_item.bad_count == 1 and legacy_item.like_count == 0
+
+    def test_edit_timeline_item(self):
+        post_id = timeline.post_timeline_item(PostItem(**{
+            "uuid": PYTEST_USER_UUID,
+            "user_name": PYTEST_USER_NAME,
+            "texts": f"Edit timeline item\n{DT.CURRENT_JST_ISO_8601_DATETIME}",
+        })).get("post_id")
+
+        response = timeline.edit_timeline_item(post_id=post_id, texts="Edited", version=0, uuid=PYTEST_USER_UUID)
+        assert response == {"post_id": post_id, "version": 1}
+        timeline_item = timeline.fetch_timeline_item(post_id)
+        assert timeline_item.get("texts") == "Edited"
+        assert timeline_item.get("version") == 1
+
+        # Edit based on the stale version
+        with pytest.raises(HTTPException) as e:
+            timeline.edit_timeline_item(post_id=post_id, texts="Stale", version=0, uuid=PYTEST_USER_UUID)
+        assert e.value.status_code == 409
+        # Edit by another user
+        with pytest.raises(HTTPException) as e:
+            timeline.edit_timeline_item(post_id=post_id, texts="Another", version=1, uuid="another-user")
+        assert e.value.status_code == 403
+
+        comment_id = timeline.post_comment_item(post_id=post_id, comment=CommentItem(**{
+            "post_id": post_id,
+            "uuid": PYTEST_USER_UUID,
+            "texts": "Comment",
+        })).get("comment_id")
+        assert timeline.edit_comment_item(post_id=post_id, comment_id=comment_id, texts="Edited", version=0, uuid=PYTEST_USER_UUID).get("version") == 1
+
+        timeline.delete_logical_timeline_item(post_id)
+        with pytest.raises(HTTPException) as e:
+            timeline.edit_timeline_item(post_id=post_id, texts="Deleted", version=1, uuid=PYTEST_USER_UUID)
+        assert e.value.status_code == 404
+
+    def test_long_texts_are_stored_compressed(self, monkeypatch):
+        """Long texts is stored compressed with its preview, and only fetch_timeline_item() restores the whole texts"""
+        items = {}
+
+        class PostTable:
+            def put_item(self, Item):
+                items[Item["post_id"]] = Item
+
+            def get_item(self, Key):
+                return {"Item": items[Key["post_id"]]}
+        monkeypatch.setattr(timeline, "__post_table", PostTable())
+
+        texts = f"Long texts\n{DT.CURRENT_JST_ISO_8601_DATETIME}\n" + "長い投稿です。" * 1000
+        post_id = timeline.post_timeline_item(PostItem(uuid=PYTEST_USER_UUID, texts=texts)).get("post_id")
+        stored_item = items[post_id]
+        assert "texts_compressed" in stored_item and "texts_s3_key" not in stored_item
+        assert texts.startswith(stored_item["texts"]) and len(stored_item["texts"]) < len(texts)
+        # The listing returns the preview.
+        listed_item = PostItem(**stored_item).dict()
+        assert listed_item.get("is_texts_truncated") is True
+        assert "texts_compressed" not in listed_item
+
+        timeline_item = timeline.fetch_timeline_item(post_id)
+        assert timeline_item.get("texts") == texts
+        assert timeline_item.get("is_texts_truncated") is False
+
+    def test_deleted_post_is_not_indexed(self):
+        """The keys of the listing GSIs are stored only for the posts not deleted"""
+        dynamodb_item = PostItem(uuid=PYTEST_USER_UUID).to_dynamodb_item()
+        assert dynamodb_item["active_uuid"] == PYTEST_USER_UUID
+        assert dynamodb_item["pk_for_all_post_gsi"].startswith("pk_for_all_post_gsi#")
+
+        deleted_item = PostItem(uuid=PYTEST_USER_UUID, is_deleted=1).to_dynamodb_item()
+        assert "active_uuid" not in deleted_item
+        assert "pk_for_all_post_gsi" not in deleted_item
+
     def test_put_reaction_to_comment_item(self):
         """Post a reaction to a comment item and update it"""
         # Post the test data
@@ -239,9 +350,44 @@ class TestFunc:
         assert timeline_item is not None
         assert timeline_item.get("comment_count") == 0
 
+        # Deleting the same comment again must not decrement the comment count twice
+        with pytest.raises(HTTPException) as e:
+            timeline.delete_logical_comment_item(
+                post_id=post_id, comment_id=comment_id)
+        assert e.value.status_code == 404
+        timeline_item = timeline.fetch_timeline_item(post_id)
+        assert timeline_item.get("comment_count") == 0
+
         # Clean up the test data
         # timeline.delete_timeline_item(post_id)
 
+    def test_post_comment_item_to_deleted_timeline_item(self):
+        post_response = timeline.post_timeline_item(
+            post=PostItem(**{
+                "uuid": PYTEST_USER_UUID,
+                "user_name": PYTEST_USER_NAME,
+                "texts": f"Post comment item to deleted post\n{DT.CURRENT_JST_ISO_8601_DATETIME}",
+            })
+        )
+        post_id = post_response.get("post_id")
+        timeline.delete_logical_timeline_item(post_id)
+
+        comment = CommentItem(**{
+            "post_id": post_id,
+            "uuid": PYTEST_USER_UUID,
+            "user_name": PYTEST_USER_NAME,
+            "texts": f"Post comment item to deleted post\n{DT.CURRENT_JST_ISO_8601_DATETIME}",
+        })
+        with pytest.raises(HTTPException) as e:
+            timeline.post_comment_item(post_id=post_id, comment=comment)
+        assert e.value.status_code == 404
+
+        # Neither the comment nor the comment count is written
+        with pytest.raises(HTTPException):
+            timeline.fetch_comment_item(comment.comment_id)
+        timeline_item = timeline.fetch_timeline_item(post_id)
+        assert timeline_item.get("comment_count") == 0
+
     def test_logical_delete_timeline_item(self):
         # Post the test data
         post_response = timeline.post_timeline_item(
@@ -282,6 +428,10 @@ class TestFunc:
                         for timeline_item in timeline_items]
             assert post_id not in post_ids
 
+        # The deleted post is dropped from the list of the user as well
+        response = timeline.fetch_timeline_list_by_user(target_timeline_item.get("uuid"))
+        assert post_id not in [item.get("post_id") for item in response.get("items", [])]
+
         # Clean up the test data
         # timeline.delete_timeline_item(post_id)
 
@@ -326,6 +476,74 @@ class TestFunc:
             else:    
                 assert last_evaluated_timestamp_2 is None
 
+    def test_fetch_timeline_items_with_counts_only(self):
+        post_response = timeline.post_timeline_item(
+            post=PostItem(**{
+                "uuid": PYTEST_USER_UUID,
+                "user_name": PYTEST_USER_NAME,
+                "texts": f"Fetch timeline items with counts only\n{DT.CURRENT_JST_ISO_8601_DATETIME}",
+            })
+        )
+        post_id = post_response.get("post_id")
+        timeline.put_reaction_to_timeline_item(post_id=post_id, reaction=Reaction(uuid=PYTEST_USER_UUID, type=1))
+
+        response = timeline.fetch_timeline_list(counts_only=True)
+        timeline_item = [item for item in response.get("items", []) if item.get("post_id") == post_id][0]
+        # reactions is not fetched but like_count is.
+        assert timeline_item.get("reactions") == []
+        assert timeline_item.get("like_count") == 1
+
+    @pytest.mark.parametrize("backfilled", [False, True])
+    def test_counts_only_counts_reactions_until_backfilled(self, monkeypatch, backfilled):
+        """The items without the counters are counted from reaction_by_user until the counters are backfilled"""
+        backfilled_post = PostItem(uuid=PYTEST_USER_UUID, reaction_by_user={PYTEST_USER_UUID: 1}).to_dynamodb_item()
+        # Item written before the counters were added
+        legacy_post = {k: v for k, v in PostItem(uuid=PYTEST_USER_UUID, reaction_by_user={PYTEST_USER_UUID: 2}).to_dynamodb_item().items()
+                       if k not in ("like_count", "bad_count")}
+        projections = []
+
+        class Client:
+            def query(self, **kwargs):
+                projected = set(kwargs["ExpressionAttributeNames"].values())
+                projections.append(projected)
+                shard_key = kwargs["ExpressionAttributeValues"][":value"]
+                return {"Items": [{k: v for k, v in p.items() if k in projected} for p in [backfilled_post, legacy_post]
+                                  if p["pk_for_all_post_gsi"] == shard_key]}
+        monkeypatch.setattr(timeline, "__client", Client())
+        monkeypatch.setattr(timeline, "TIMELINE_REACTION_COUNTERS_BACKFILLED", backfilled)
+        timeline.use_timeline_cache_backend(InMemoryCacheBackend(max_size=16))
+
+        items = {item["post_id"]: item for item in timeline.fetch_timeline_list(counts_only=True).get("items", [])}
+        assert all([("reaction_by_user" in projected) != backfilled for projected in projections])
+        assert all([item.get("reactions") == [] for item in items.values()])
+        assert items[backfilled_post["post_id"]].get("like_count") == 1
+        # The legacy item has no reaction_by_user fetched once the counters are backfilled.
+        assert items[legacy_post["post_id"]].get("bad_count") == (0 if backfilled else 1)
+
+    def test_fetch_timeline_items_from_shards(self):
+        post_ids = []
+        for i in range(3):
+            post = PostItem(**{
+                "uuid": PYTEST_USER_UUID,
+                "user_name": PYTEST_USER_NAME,
+                "texts": f"Fetch timeline items from shards {i}\n{DT.CURRENT_JST_ISO_8601_DATETIME}",
+            })
+            assert post.pk_for_all_post_gsi == post_gsi_shard_key(post.post_id)
+            post_ids.append(timeline.post_timeline_item(post).get("post_id"))
+
+        # The newest posts of all shards are merged in newest-first order.
+        response = timeline.fetch_timeline_list()
+        first_page = response.get("items", [])
+        fetched_post_ids = [item.get("post_id") for item in first_page]
+        assert set(post_ids) <= set(fetched_post_ids)
+        timestamps = [item.get("timestamp") for item in first_page]
+        assert timestamps == sorted(timestamps, reverse=True)
+
+        cursor = response.get("last_evaluated_cursor")
+        if cursor is not None:
+            second_page = timeline.fetch_timeline_list(cursor=cursor).get("items", [])
+            assert set(fetched_post_ids).isdisjoint([item.get("post_id") for item in second_page])
+
     def test_fetch_fetch_timeline_items_by_user(self):
         # Post the test data
         post_response = timeline.post_timeline_item(
@@ -365,6 +583,252 @@ class TestFunc:
             else:
                 assert last_post_id is None
 
+    def test_comment_list_cursor(self, monkeypatch):
+        """last_evaluated_cursor is an opaque token of LastEvaluatedKey, which is accepted only by the listing of the same post"""
+        query_requests = []
+
+        class CommentTable:
+            def query(self, **kwargs):
+                query_requests.append(kwargs)
+                return {
+                    "Items": [],
+                    "Count": 0,
+                    "LastEvaluatedKey": {"post_id": "post-1", "timestamp": Decimal(1_700_000_000_000), "comment_id": "comment-1"}
+                }
+        monkeypatch.setattr(timeline, "__comment_table", CommentTable())
+
+        cursor = timeline.fetch_comment_list(post_id="post-1", limit=5).get("last_evaluated_cursor")
+        timeline.fetch_comment_list(post_id="post-1", cursor=cursor, limit=TIMELINE_LIST_MAX_LIMIT)
+        assert query_requests[0]["Limit"] == 5
+        assert query_requests[1]["Limit"] == TIMELINE_LIST_MAX_LIMIT
+        assert query_requests[1]["ExclusiveStartKey"] == {"post_id": "post-1", "timestamp": 1_700_000_000_000, "comment_id": "comment-1"}
+
+        for invalid_request in [
+            lambda: timeline.fetch_comment_list(post_id="post-2", cursor=cursor),
+            lambda: timeline.fetch_comment_list(post_id="post-1", cursor="invalid"),
+            lambda: timeline.fetch_comment_list(post_id="post-1", limit=TIMELINE_LIST_MAX_LIMIT + 1),
+            lambda: timeline.fetch_timeline_list(cursor=cursor),
+            lambda: timeline.fetch_comment_list(post_id="post-1", cursor=base64.urlsafe_b64encode(json.dumps({
+                "v": 1, "kind": "comment", "key": {"post_id": "post-1", "timestamp": "1700000000000", "comment_id": "comment-1"}}).encode()).decode()),
+        ]:
+            with pytest.raises(HTTPException) as e:
+                invalid_request()
+            assert e.value.status_code == 400
+        assert len(query_requests) == 2
+
+    def test_timeline_list_cursor(self, monkeypatch):
+        """The positions of the shards in the cursor are validated before they become ExclusiveStartKey"""
+        query_requests = []
+
+        class Client:
+            def query(self, **kwargs):
+                query_requests.append(kwargs)
+                return {"Items": [], "Count": 0}
+        monkeypatch.setattr(timeline, "__client", Client())
+        monkeypatch.setattr(timeline, "__cache", InMemoryCacheBackend(max_size=16))
+
+        # The legacy cursor continues every shard from the next post_id of the same timestamp instead of skipping the timestamp.
+        timeline.fetch_timeline_list(timestamp=1_700_000_000_000, post_id="post-1")
+        assert [r["ExclusiveStartKey"] for r in query_requests] == [
+            {"pk_for_all_post_gsi": k, "timestamp": 1_700_000_000_000, "post_id": "post-1"} for k in post_gsi_shard_keys()]
+
+        def encode(body):
+            return base64.urlsafe_b64encode(json.dumps({"v": 1, "kind": "timeline", "before": None, "page": 1, **body}).encode()).decode()
+        shard_key = post_gsi_shard_keys()[0]
+        query_requests.clear()
+        for cursor in [
+            encode({"positions": {shard_key: "post-1"}}),
+            encode({"positions": {shard_key: [1_700_000_000_000]}}),
+            encode({"positions": {shard_key: ["1700000000000", "post-1"]}}),
+            encode({"positions": {shard_key: [True, "post-1"]}}),
+            encode({"positions": {shard_key: [1_700_000_000_000, 1]}}),
+            encode({"positions": {}, "before": "1700000000000"}),
+            # Cursors without the version or the page are never issued.
+            base64.urlsafe_b64encode(json.dumps({"positions": {}, "before": None, "page": 1}).encode()).decode(),
+            base64.urlsafe_b64encode(json.dumps({"v": 1, "kind": "timeline", "positions": {}, "before": None}).encode()).decode(),
+        ]:
+            with pytest.raises(HTTPException) as e:
+                timeline.fetch_timeline_list(cursor=cursor)
+            assert e.value.status_code == 400
+        assert query_requests == []
+
+    def test_cached_reads_are_invalidated_by_writes(self, monkeypatch):
+        """The post and the first pages of the timeline are read from the cache until the post or a comment in them is written"""
+        post = PostItem(uuid=PYTEST_USER_UUID, texts="Cached post").to_dynamodb_item()
+        reads = []
+
+        class PostTable:
+            name = "terakoya-pytest-timeline-post"
+
+            def get_item(self, Key):
+                reads.append("get_item")
+                return {"Item": post}
+
+            def update_item(self, **kwargs):
+                pass
+
+        class Client:
+            def query(self, **kwargs):
+                reads.append("query")
+                shard_key = kwargs["ExpressionAttributeValues"][":value"]
+                return {"Items": [post] if shard_key == post["pk_for_all_post_gsi"] else []}
+        monkeypatch.setattr(timeline, "__post_table", PostTable())
+        monkeypatch.setattr(timeline, "__client", Client())
+        timeline.use_timeline_cache_backend(InMemoryCacheBackend(max_size=16))
+
+        for _ in range(2):
+            assert timeline.fetch_timeline_item(post["post_id"]).get("texts") == "Cached post"
+            assert timeline.fetch_timeline_list().get("count") == 1
+        assert reads.count("get_item") == 1
+        assert reads.count("query") == len(post_gsi_shard_keys())
+
+        # A reaction changes like_count of the post in the pages as well.
+        timeline.put_reaction_to_timeline_item(post["post_id"], Reaction(uuid=PYTEST_USER_UUID, type=TYPE_LIKE))
+        timeline.fetch_timeline_item(post["post_id"])
+        timeline.fetch_timeline_list()
+        assert reads.count("get_item") == 2
+        assert reads.count("query") == 2 * len(post_gsi_shard_keys())
+
+        # A reaction to a comment invalidates only the pages with comment_previews.
+        class CommentTable:
+            name = "terakoya-pytest-timeline-comment"
+
+            def update_item(self, **kwargs):
+                pass
+        monkeypatch.setattr(timeline, "__comment_table", CommentTable())
+        timeline.fetch_timeline_list(preview_comments=1)
+        timeline.put_reaction_to_comment_item("comment-1", Reaction(uuid=PYTEST_USER_UUID, type=TYPE_LIKE))
+        timeline.fetch_timeline_list()
+        timeline.fetch_timeline_list(preview_comments=1)
+        assert reads.count("query") == 4 * len(post_gsi_shard_keys())
+
+        timeline.delete_logical_timeline_item(post["post_id"])
+        timeline.fetch_timeline_item(post["post_id"])
+        timeline.fetch_timeline_list()
+        assert reads.count("get_item") == 3
+        assert reads.count("query") == 5 * len(post_gsi_shard_keys())
+
+    def test_fetch_timeline_items_in_batch(self, monkeypatch):
+        """Posts are returned in the requested order after retrying UnprocessedKeys, and the others are reported as missing"""
+        posts = {p["post_id"]: p for p in [
+            PostItem(uuid=PYTEST_USER_UUID, texts="First").to_dynamodb_item(),
+            PostItem(uuid=PYTEST_USER_UUID, texts="Second").to_dynamodb_item(),
+            PostItem(uuid=PYTEST_USER_UUID, texts="Deleted", is_deleted=1).to_dynamodb_item(),
+        ]}
+        first_id, second_id, deleted_id = posts.keys()
+        batch_requests = []
+
+        class Client:
+            def batch_get_item(self, RequestItems):
+                table_name, request = next(iter(RequestItems.items()))
+                batch_requests.append(request["Keys"])
+                if len(batch_requests) == 1:
+                    # The first key is unprocessed.
+                    return {
+                        "Responses": {table_name: [posts[k["post_id"]] for k in request["Keys"][1:] if k["post_id"] in posts]},
+                        "UnprocessedKeys": {table_name: {"Keys": request["Keys"][:1]}}
+                    }
+                return {"Responses": {table_name: [posts[k["post_id"]] for k in request["Keys"] if k["post_id"] in posts]}}
+        monkeypatch.setattr(timeline, "__client", Client())
+        timeline.use_timeline_cache_backend(InMemoryCacheBackend(max_size=16))
+
+        response = timeline.fetch_timeline_items([second_id, "unknown", first_id, deleted_id, second_id])
+        assert [item.get("post_id") for item in response.get("items", [])] == [second_id, first_id]
+        assert response.get("missing_ids") == ["unknown", deleted_id]
+        assert batch_requests == [[{"post_id": i} for i in [second_id, "unknown", first_id, deleted_id]], [{"post_id": second_id}]]
+
+        # The posts fetched once are read from the cache.
+        timeline.fetch_timeline_items([first_id, "unknown"])
+        assert batch_requests[-1] == [{"post_id": "unknown"}]
+
+        # More IDs than a BatchGetItem accepts are read with multiple requests, and the texts in S3 are read in parallel.
+        batch_requests.clear()
+        offloaded_ids = [f"offloaded-{i}" for i in range(TIMELINE_BATCH_MAX_IDS)]
+        posts.update({i: {**PostItem(uuid=PYTEST_USER_UUID, post_id=i, texts="Preview").to_dynamodb_item(), timeline.TEXTS_S3_KEY: i} for i in offloaded_ids})
+        object_threads = set()
+
+        class S3Client:
+            def get_object(self, Bucket, Key):
+                object_threads.add(threading.get_ident())
+                return {"Body": io.BytesIO(zlib.compress(f"Whole texts of {Key}".encode()))}
+        monkeypatch.setattr(timeline, "s3_client", S3Client())
+        monkeypatch.setattr(timeline, "S3_TERAKOYA_BUCKET_NAME", "terakoya-pytest")
+        response = timeline.fetch_timeline_items(offloaded_ids)
+        assert [item.get("texts") for item in response.get("items", [])] == [f"Whole texts of {i}" for i in offloaded_ids]
+        assert max([len(keys) for keys in batch_requests]) == 100
+        assert threading.get_ident() not in object_threads
+        with pytest.raises(HTTPException) as e:
+            timeline.fetch_timeline_items(offloaded_ids + ["one-more"])
+        assert e.value.status_code == 400
+
+    def test_fetch_timeline_detail_concurrently(self, monkeypatch):
+        """The post and its comments are fetched at the same time"""
+        post = PostItem(uuid=PYTEST_USER_UUID, texts="Detail", comment_count=1).to_dynamodb_item()
+        comment = CommentItem(uuid=PYTEST_USER_UUID, post_id=post["post_id"], texts="Comment").to_dynamodb_item()
+        post_requested = threading.Event()
+
+        class PostTable:
+            def get_item(self, Key):
+                post_requested.set()
+                return {"Item": post} if Key["post_id"] == post["post_id"] else {}
+
+        class CommentTable:
+            def query(self, **kwargs):
+                # The comments are being fetched while the post is fetched.
+                assert post_requested.wait(timeout=5)
+                return {"Items": [comment], "Count": 1}
+        monkeypatch.setattr(timeline, "__post_table", PostTable())
+        monkeypatch.setattr(timeline, "__comment_table", CommentTable())
+        timeline.use_timeline_cache_backend(InMemoryCacheBackend(max_size=16))
+
+        detail = timeline.fetch_timeline_detail(post["post_id"])
+        assert detail.get("post", {}).get("post_id") == post["post_id"]
+        assert [c.get("comment_id") for c in detail.get("comments", {}).get("items", [])] == [comment["comment_id"]]
+
+        with pytest.raises(HTTPException) as e:
+            timeline.fetch_timeline_detail("unknown")
+        assert e.value.status_code == 404
+
+    def test_fetch_timeline_items_with_comment_previews(self, monkeypatch):
+        """The newest comments are embedded per post, and the posts without comments are not queried"""
+        commented_post = PostItem(uuid=PYTEST_USER_UUID, texts="Commented", comment_count=2).to_dynamodb_item()
+        uncommented_post = PostItem(uuid=PYTEST_USER_UUID, texts="Not commented").to_dynamodb_item()
+        # Newest first
+        comments = [
+            CommentItem(uuid=PYTEST_USER_UUID, post_id=commented_post["post_id"], texts="Newest").to_dynamodb_item(),
+            CommentItem(uuid=PYTEST_USER_UUID, post_id=commented_post["post_id"], texts="Deleted", is_deleted=1).to_dynamodb_item(),
+            CommentItem(uuid=PYTEST_USER_UUID, post_id=commented_post["post_id"], texts="Oldest").to_dynamodb_item(),
+        ]
+        comment_queries = []
+
+        class Client:
+            def query(self, **kwargs):
+                if kwargs["IndexName"].endswith("timeline-comment-for-post"):
+                    comment_queries.append(kwargs["ExpressionAttributeValues"][":value"])
+                    # Limit is applied before FilterExpression like DynamoDB.
+                    start = kwargs.get("ExclusiveStartKey", {}).get("index", 0)
+                    evaluated = comments[start:start + kwargs["Limit"]]
+                    response = {"Items": [c for c in evaluated if c.get("is_deleted", 0) == kwargs["ExpressionAttributeValues"][":is_deleted_false"]]}
+                    if start + kwargs["Limit"] < len(comments):
+                        response["LastEvaluatedKey"] = {"index": start + kwargs["Limit"]}
+                    return response
+                shard_key = kwargs["ExpressionAttributeValues"][":value"]
+                return {"Items": [p for p in [uncommented_post, commented_post] if p["pk_for_all_post_gsi"] == shard_key]}
+        monkeypatch.setattr(timeline, "__client", Client())
+        timeline.use_timeline_cache_backend(InMemoryCacheBackend(max_size=16))
+
+        response = timeline.fetch_timeline_list(preview_comments=2)
+        # The deleted comment is skipped by reading the next page, so the preview still has 2 comments.
+        assert comment_queries == [commented_post["post_id"]] * 2
+        previews = response.get("comment_previews", {})
+        assert list(previews.keys()) == [commented_post["post_id"]]
+        assert [c.get("texts") for c in previews[commented_post["post_id"]]] == ["Newest", "Oldest"]
+
+        assert timeline.fetch_timeline_list().get("comment_previews") is None
+        with pytest.raises(HTTPException) as e:
+            timeline.fetch_timeline_list(preview_comments=TIMELINE_PREVIEW_COMMENTS_MAX + 1)
+        assert e.value.status_code == 400
+
     def test_fetch_comment_items(self):
         # Post the test data
         # post_response = timeline.post_timeline_item(
@@ -0,0 +1,68 @@
+import os
+import sys
+import time
+import pytest
+
+ROOT_DIR_PATH = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+sys.path.append(ROOT_DIR_PATH)
+
+from functions.utils.cache import LRUCache, InMemoryCacheBackend, create_cache_backend
+
+
+class TestLRUCache:
+    def test_get_and_set(self):
+        cache = LRUCache(max_size=2)
+        assert cache.get("a") is None
+        cache.set("a", 1, expires_at=time.time() + 60)
+        assert cache.get("a") == 1
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 1
+
+    def test_evict_least_recently_used(self):
+        cache = LRUCache(max_size=2)
+        cache.set("a", 1, expires_at=time.time() + 60)
+        cache.set("b", 2, expires_at=time.time() + 60)
+        cache.get("a")  # "b" becomes the least recently used
+        cache.set("c", 3, expires_at=time.time() + 60)
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        assert cache.get("c") == 3
+        assert cache.stats()["evictions"] == 1
+
+    def test_expire(self):
+        cache = LRUCache(max_size=2)
+        cache.set("a", 1, expires_at=time.time() - 1)  # Already expired entry is not stored
+        assert cache.stats()["size"] == 0
+        cache.set("b", 2, expires_at=time.time() + 0.01)
+        time.sleep(0.02)
+        assert cache.get("b") is None
+        assert cache.stats()["expirations"] == 1
+
+    def test_delete(self):
+        cache = LRUCache(max_size=2)
+        cache.set("a", 1, expires_at=time.time() + 60)
+        assert cache.delete("a")
+        assert not cache.delete("a")
+        assert cache.get("a") is None
+
+
+class TestCacheBackend:
+    def test_in_memory_backend_copies_values(self):
+        backend = create_cache_backend("memory", max_size=2)
+        assert isinstance(backend, InMemoryCacheBackend)
+        value = {"items": [1]}
+        backend.set("a", value, ttl_seconds=60)
+        value["items"].append(2)
+        cached = backend.get("a")
+        assert cached == {"items": [1]}
+        cached["items"].append(3)
+        assert backend.get("a") == {"items": [1]}
+        backend.delete("a")
+        assert backend.get("a") is None
+
+    def test_null_backend(self):
+        backend = create_cache_backend("none", max_size=2)
+        backend.set("a", 1, ttl_seconds=60)
+        assert backend.get("a") is None
+        with pytest.raises(ValueError):
+            create_cache_backend("unknown", max_size=2)
@@ -0,0 +1,49 @@
+import os
+import sys
+import time
+import pytest
+from jose import jwt
+
+ROOT_DIR_PATH = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+sys.path.append(ROOT_DIR_PATH)
+
+from functions.utils.jwt_verifier import IJwtVerifier, InvalidTokenError, JoseJwtVerifier, CryptographyJwtVerifier, create_jwt_verifier
+from tests.samples.authentication import sample_jwks, make_access_token, SAMPLE_KID, SAMPLE_ALG
+from tests.samples.user import PYTEST_USER_UUID
+
+
+@pytest.fixture(params=[JoseJwtVerifier.name, CryptographyJwtVerifier.name])
+def verifier(request) -> IJwtVerifier:
+    return create_jwt_verifier(request.param)
+
+
+class TestJwtVerifier:
+    def verify(self, verifier: IJwtVerifier, token: str):
+        key = verifier.construct_key(sample_jwks[SAMPLE_KID], SAMPLE_ALG)
+        return verifier.verify(token, key, SAMPLE_ALG)
+
+    def test_verify_valid_token(self, verifier: IJwtVerifier):
+        assert self.verify(verifier, make_access_token()).get("sub") == PYTEST_USER_UUID
+
+    def test_reject_expired_token(self, verifier: IJwtVerifier):
+        with pytest.raises(InvalidTokenError):
+            self.verify(verifier, make_access_token(expires_in_seconds=-1))
+
+    def test_reject_token_not_yet_valid(self, verifier: IJwtVerifier):
+        with pytest.raises(InvalidTokenError):
+            self.verify(verifier, make_access_token(nbf=int(time.time()) + 60))
+
+    def test_reject_tampered_payload(self, verifier: IJwtVerifier):
+        header_b64, _, signature_b64 = make_access_token().split(".")
+        _, payload_b64, _ = make_access_token(sub="attacker").split(".")
+        with pytest.raises(InvalidTokenError):
+            self.verify(verifier, f"{header_b64}.{payload_b64}.{signature_b64}")
+
+    def test_reject_token_signed_with_another_alg(self, verifier: IJwtVerifier):
+        token = jwt.encode({"sub": PYTEST_USER_UUID}, "secret", algorithm="HS256", headers={"kid": SAMPLE_KID})
+        with pytest.raises(InvalidTokenError):
+            self.verify(verifier, token)
+
+    def test_unknown_backend(self):
+        with pytest.raises(ValueError):
+            create_jwt_verifier("unknown")
@@ -0,0 +1,45 @@
+import os
+import sys
+import pytest
+
+ROOT_DIR_PATH = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+sys.path.append(ROOT_DIR_PATH)
+
+from functions.utils.rate_limit import TokenBucket
+
+
+class TestTokenBucket:
+    def test_allow_burst_up_to_capacity(self):
+        bucket = TokenBucket(capacity=3, refill_per_second=0.001)
+        assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+        assert bucket.seconds_until_available() > 0
+
+    def test_refill_over_time(self, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr("functions.utils.rate_limit.time.monotonic", lambda: now[0])
+        bucket = TokenBucket(capacity=2, refill_per_second=1)
+        assert bucket.try_acquire(2)
+        assert not bucket.try_acquire()
+        now[0] += 1
+        assert bucket.try_acquire()
+        assert bucket.seconds_until_full() == 2
+
+    def test_acquire_waits_for_refill(self, monkeypatch):
+        now = [1000.0]
+        slept = []
+
+        def sleep(seconds):
+            slept.append(seconds)
+            now[0] += seconds
+        monkeypatch.setattr("functions.utils.rate_limit.time.monotonic", lambda: now[0])
+        monkeypatch.setattr("functions.utils.rate_limit.time.sleep", sleep)
+        bucket = TokenBucket(capacity=1, refill_per_second=2)
+        bucket.acquire()
+        bucket.acquire()
+        assert slept == [0.5]
+        with pytest.raises(ValueError):
+            bucket.acquire(2)
+
+    def test_reject_invalid_rate(self):
+        with pytest.raises(ValueError):
+            TokenBucket(capacity=1, refill_per_second=0)
@@ -0,0 +1,56 @@
+import os
+import sys
+import uuid
+import pytest
+from pydantic import ValidationError
+
+ROOT_DIR_PATH = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+sys.path.append(ROOT_DIR_PATH)
+
+from functions.utils.ulid import MonotonicUlidGenerator, ULID_LENGTH, MAX_TIMESTAMP_MS, decode_timestamp_ms, is_ulid
+from functions.models.timeline import PostItem, CommentItem
+
+
+class TestUlid:
+    def test_sortable_by_creation_time(self):
+        generator = MonotonicUlidGenerator()
+        ids = [generator.generate(1_700_000_000_000 + i // 10) for i in range(100)]
+        assert sorted(ids) == ids
+        assert len(set(ids)) == len(ids)
+        assert all([len(i) == ULID_LENGTH and is_ulid(i) for i in ids])
+        assert decode_timestamp_ms(ids[0]) == 1_700_000_000_000
+
+    def test_monotonic_when_clock_goes_back(self):
+        generator = MonotonicUlidGenerator()
+        first = generator.generate(1_700_000_000_001)
+        second = generator.generate(1_700_000_000_000)
+        assert first < second
+        assert decode_timestamp_ms(second) == 1_700_000_000_001
+
+    def test_legacy_id_is_not_ulid(self):
+        assert not is_ulid(uuid.uuid4().hex)
+        assert decode_timestamp_ms(uuid.uuid4().hex) is None
+
+
+class TestTimelineItemId:
+    def test_id_carries_timestamp_in_milliseconds(self):
+        post = PostItem(uuid="pytest")
+        comment = CommentItem(uuid="pytest", post_id=post.post_id)
+        assert decode_timestamp_ms(post.post_id) == post.timestamp
+        assert decode_timestamp_ms(comment.comment_id) == comment.timestamp
+        assert post.post_id < comment.comment_id
+
+    def test_legacy_item_timestamp_in_seconds(self):
+        legacy_id = uuid.uuid4().hex
+        post = PostItem(uuid="pytest", post_id=legacy_id, timestamp=1_700_000_000)
+        assert post.post_id == legacy_id
+        assert post.timestamp == 1_700_000_000_000
+
+    def test_timestamp_out_of_range_of_id(self):
+        """The request with the timestamp which the ID can't carry is rejected by the validation (422) instead of failing with 500"""
+        for timestamp in [MAX_TIMESTAMP_MS + 1, -2]:
+            with pytest.raises(ValidationError):
+                PostItem(uuid="pytest", timestamp=timestamp)
+            with pytest.raises(ValidationError):
+                CommentItem(uuid="pytest", post_id="post", timestamp=timestamp)
+        assert decode_timestamp_ms(PostItem(uuid="pytest", timestamp=MAX_TIMESTAMP_MS).post_id) == MAX_TIMESTAMP_MS
@@ -0,0 +1,47 @@
+import os
+import sys
+import time
+from typing import Any, Dict
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwk, jwt
+
+ROOT_DIR_PATH = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+sys.path.append(ROOT_DIR_PATH)
+
+from tests.samples.user import PYTEST_USER_UUID
+
+# RSA key pair generated locally to sign access tokens in the same way as Cognito (RS256) without calling Cognito.
+SAMPLE_KID = "pytest-kid"
+SAMPLE_ALG = "RS256"
+
+__private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+SAMPLE_PRIVATE_KEY_PEM = __private_key.private_bytes(
+    encoding=serialization.Encoding.PEM,
+    format=serialization.PrivateFormat.PKCS8,
+    encryption_algorithm=serialization.NoEncryption()
+).decode("utf-8")
+__public_key_pem = __private_key.public_key().public_bytes(
+    encoding=serialization.Encoding.PEM,
+    format=serialization.PublicFormat.SubjectPublicKeyInfo
+).decode("utf-8")
+
+# { kid: jwk } as returned by get_cognito_jwks()
+sample_jwks = {
+    SAMPLE_KID: {
+        **jwk.construct(__public_key_pem, SAMPLE_ALG).to_dict(),
+        "kid": SAMPLE_KID,
+        "use": "sig",
+    }
+}
+
+
+def make_access_token(expires_in_seconds: int = 3600, kid: str = SAMPLE_KID, **claims: Any) -> str:
+    payload: Dict[str, Any] = {
+        "sub": PYTEST_USER_UUID,
+        "token_use": "access",
+        "iat": int(time.time()),
+        "exp": int(time.time()) + expires_in_seconds,
+        **claims,
+    }
+    return jwt.encode(payload, SAMPLE_PRIVATE_KEY_PEM, algorithm=SAMPLE_ALG, headers={"kid": kid})
@@ -0,0 +1,115 @@
+import os
+import sys
+import time
+import timeit
+import contextlib
+from fastapi import Request, Response
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwk, jwt
+
+ROOT_DIR_PATH = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR_PATH)
+
+# functions.domain.authentication requires the settings of Cognito User Pool to be imported,
+# but the benchmark never calls Cognito because the JWKS is replaced with the one generated locally.
+os.environ.setdefault("COGNITO_USER_POOL_ID", "benchmark")
+os.environ.setdefault("COGNITO_USER_POOL_CLIENT_ID", "benchmark")
+os.environ.setdefault("AWS_DEFAULT_REGION", "ap-northeast-1")
+
+from functions.domain import authentication as auth
+from functions.utils.jwt_verifier import create_jwt_verifier, JoseJwtVerifier, CryptographyJwtVerifier
+
+KID = "benchmark-kid"
+ALG = "RS256"
+NUMBER = 1000
+
+
+def generate_jwks_and_token(number_of_tokens: int = 1):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    private_pem = private_key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption()
+    )
+    public_pem = private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    jwks = {KID: {**jwk.construct(public_pem, ALG).to_dict(), "kid": KID, "use": "sig"}}
+    tokens = [
+        jwt.encode(
+            {"sub": "benchmark", "token_use": "access", "jti": str(i), "iat": int(time.time()), "exp": int(time.time()) + 3600},
+            private_pem,
+            algorithm=ALG,
+            headers={"kid": KID}
+        ) for i in range(number_of_tokens)
+    ]
+    return jwks, tokens[0] if number_of_tokens == 1 else tokens
+
+
+def report(label: str, seconds: float, number: int = NUMBER):
+    print(f"{label:<48}: {seconds / number * 1_000_000:10.1f} us/request")
+
+
+def benchmark_public_key_cache():
+    """Per-request cost of verifying the signature with and without the cache of public key objects."""
+    jwks, token = generate_jwks_and_token()
+    target_jwk = jwks[KID]
+
+    def verify_without_cache():
+        pub_key = jwk.construct(target_jwk)
+        return jwt.decode(token, pub_key.to_pem(), algorithms=[ALG])
+
+    cached_key = jwk.construct(target_jwk, ALG)
+
+    def verify_with_cache():
+        return jwt.decode(token, cached_key, algorithms=[ALG])
+
+    without_cache = timeit.timeit(verify_without_cache, number=NUMBER)
+    with_cache = timeit.timeit(verify_with_cache, number=NUMBER)
+    report("jwk.construct + to_pem + jwt.decode(PEM)", without_cache)
+    report("cached key object + jwt.decode(key)", with_cache)
+    report("saving", without_cache - with_cache)
+
+
+def benchmark_authenticate_user():
+    """
+    Per-request cost of authenticate_user() per verifier backend (JWT_VERIFIER_BACKEND).
+    - cold: caches are empty (ex: the first request in a new Lambda container). JWKS is fetched from the fake, not from Cognito.
+    - warm: JWKS and the public key are cached but the token is new, so its signature is verified.
+    - cached claims: the same token is sent again, so the signature is not verified.
+    """
+    jwks, tokens = generate_jwks_and_token(number_of_tokens=NUMBER)
+    auth.get_cognito_jwks = lambda: jwks
+    request = Request({"type": "http", "method": "GET", "path": "/benchmark", "headers": []})
+
+    for backend in [JoseJwtVerifier.name, CryptographyJwtVerifier.name]:
+        auth.use_jwt_verifier(create_jwt_verifier(backend))
+        tokens_iter = iter(tokens)
+
+        def cold():
+            auth.clear_auth_caches()
+            auth.authenticate_user(Response(), request, tokens[0])
+
+        def warm():
+            auth.authenticate_user(Response(), request, next(tokens_iter))
+
+        def cached_claims():
+            auth.authenticate_user(Response(), request, tokens[0])
+
+        # authenticate_user() prints logs on every request, which are not the subject of the benchmark.
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            cold_seconds = timeit.timeit(cold, number=NUMBER)
+            auth.authenticate_user(Response(), request, tokens[0])
+            warm_seconds = timeit.timeit(warm, number=NUMBER)
+            cached_claims_seconds = timeit.timeit(cached_claims, number=NUMBER)
+        report(f"[{backend}] authenticate_user (cold)", cold_seconds)
+        report(f"[{backend}] authenticate_user (warm)", warm_seconds)
+        report(f"[{backend}] authenticate_user (cached claims)", cached_claims_seconds)
+    auth.clear_auth_caches()
+
+
+if __name__ == '__main__':
+    benchmark_public_key_cache()
+    benchmark_authenticate_user()
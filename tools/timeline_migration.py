@@ -0,0 +1,195 @@
+import os
+import sys
+import argparse
+from typing import Dict
+import boto3
+from botocore.exceptions import ClientError
+
+ROOT_DIR_PATH = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR_PATH)
+
+from functions.conf.env import AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_DEFAULT_REGION
+from functions.models.timeline import ACTIVE_UUID, PK_FOR_ALL_POST_GSI, count_reactions, post_gsi_shard_key
+
+dynamodb = boto3.resource('dynamodb', aws_access_key_id=AWS_ACCESS_KEY_ID,
+                          aws_secret_access_key=AWS_SECRET_ACCESS_KEY, region_name=AWS_DEFAULT_REGION)
+
+# One-off migrations of the items of timeline tables.
+# Each step is idempotent, so it can be run again after it's interrupted.
+# python tools/timeline_migration.py <step> --stage <dev|prod>
+#
+# Deploy order of the GSIs of timeline-post table. CloudFormation creates only one GSI per table in an update,
+# so each new GSI is shipped by its own deploy after the previous one has become ACTIVE.
+# 1. Deploy timeline-post-active-by-user GSI (with no other new GSI), then run "active" step.
+# 2. Set custom.timelineCountersUpdatedIndex of the stage to true in serverless.yml and deploy timeline-post-counters-updated GSI.
+#    The incremental run of handlers/timeline/reconcile_counters.py reads it from then on. No migration step is needed,
+#    because the posts are added to it by the next comment or reaction (the older ones are checked by the weekly full run).
+#
+# After "counters" step has finished, set TIMELINE_REACTION_COUNTERS_BACKFILLED to true so that "counts_only" of the listings
+# stops fetching reaction_by_user, which is needed to count the reactions of the items without the counters until then.
+
+
+def scan_all_items(table_name: str, **scan_params):
+    table = dynamodb.Table(table_name)
+    response = table.scan(**scan_params)
+    yield from response['Items']
+    while 'LastEvaluatedKey' in response:
+        response = table.scan(ExclusiveStartKey=response['LastEvaluatedKey'], **scan_params)
+        yield from response['Items']
+
+
+def migrate_reactions_to_map(table_name: str, key_name: str) -> int:
+    """Convert reactions stored as a list into reaction_by_user map which is updated atomically per user, and the counters."""
+    table = dynamodb.Table(table_name)
+    migrated = 0
+    for item in scan_all_items(table_name, FilterExpression="attribute_not_exists(reaction_by_user)"):
+        reaction_by_user = {r['uuid']: int(r['type']) for r in item.get('reactions', [])}
+        counts = count_reactions(reaction_by_user)
+        try:
+            table.update_item(
+                Key={key_name: item[key_name]},
+                UpdateExpression="SET reaction_by_user = :reaction_by_user, like_count = :like_count, bad_count = :bad_count REMOVE reactions",
+                # The item may have been converted by the hub (put_reaction_to_*) since it was scanned.
+                ConditionExpression="attribute_not_exists(reaction_by_user)",
+                ExpressionAttributeValues={
+                    ":reaction_by_user": reaction_by_user,
+                    ":like_count": counts["like_count"],
+                    ":bad_count": counts["bad_count"],
+                }
+            )
+            migrated += 1
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise e
+    print(f"{table_name}: migrated {migrated} items to reaction_by_user")
+    return migrated
+
+
+def backfill_reaction_counters(table_name: str, key_name: str) -> int:
+    """Set like_count and bad_count counted from reaction_by_user to the items which don't have them or have drifted."""
+    table = dynamodb.Table(table_name)
+    backfilled = 0
+    for item in scan_all_items(table_name, FilterExpression="attribute_exists(reaction_by_user)"):
+        counts = count_reactions(item['reaction_by_user'])
+        if all([item.get(count_attribute) == count for count_attribute, count in counts.items()]):
+            continue
+        try:
+            table.update_item(
+                Key={key_name: item[key_name]},
+                UpdateExpression="SET like_count = :like_count, bad_count = :bad_count",
+                # Skip the item whose reactions have been changed since it was scanned, because the hub has updated the counters as well.
+                ConditionExpression="reaction_by_user = :reaction_by_user",
+                ExpressionAttributeValues={
+                    ":reaction_by_user": item['reaction_by_user'],
+                    ":like_count": counts["like_count"],
+                    ":bad_count": counts["bad_count"],
+                }
+            )
+            backfilled += 1
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise e
+    print(f"{table_name}: backfilled counters of {backfilled} items")
+    return backfilled
+
+
+def move_posts_to_gsi_shards(table_name: str) -> int:
+    """
+    Move the posts in the legacy partition key of timeline-post-all GSI to the shard of post_id.
+    The hub reads the legacy partition key as one of the shards, so the posts are listed during and after the migration.
+    Set TIMELINE_POST_GSI_SHARD_COUNT to the same value as the hub.
+    """
+    table = dynamodb.Table(table_name)
+    moved = 0
+    for item in scan_all_items(
+        table_name,
+        FilterExpression="pk_for_all_post_gsi = :legacy",
+        ExpressionAttributeValues={":legacy": PK_FOR_ALL_POST_GSI}
+    ):
+        try:
+            table.update_item(
+                Key={"post_id": item["post_id"]},
+                UpdateExpression="SET pk_for_all_post_gsi = :shard_key",
+                ConditionExpression="pk_for_all_post_gsi = :legacy",
+                ExpressionAttributeValues={
+                    ":shard_key": post_gsi_shard_key(item["post_id"]),
+                    ":legacy": PK_FOR_ALL_POST_GSI,
+                }
+            )
+            moved += 1
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise e
+    print(f"{table_name}: moved {moved} posts to the shards of timeline-post-all GSI")
+    return moved
+
+
+def make_post_indexes_sparse(table_name: str) -> Dict[str, int]:
+    """
+    Add active_uuid to the posts not deleted, which adds them to timeline-post-active-by-user GSI,
+    and remove the keys of the listing GSIs from the posts deleted, which drops them from the GSIs.
+    """
+    table = dynamodb.Table(table_name)
+    counts = {"activated": 0, "dropped": 0}
+    for item in scan_all_items(table_name):
+        if item.get("is_deleted", 0) == 0:
+            if item.get(ACTIVE_UUID) == item["uuid"]:
+                continue
+            params = {
+                "UpdateExpression": "SET #active_uuid = :uuid",
+                # The post may have been deleted since it was scanned.
+                "ConditionExpression": "attribute_not_exists(is_deleted) OR is_deleted = :is_deleted_false",
+                "ExpressionAttributeValues": {":uuid": item["uuid"], ":is_deleted_false": 0},
+            }
+            count_key = "activated"
+        else:
+            if ACTIVE_UUID not in item and "pk_for_all_post_gsi" not in item:
+                continue
+            params = {"UpdateExpression": "REMOVE #active_uuid, pk_for_all_post_gsi"}
+            count_key = "dropped"
+        try:
+            table.update_item(
+                Key={"post_id": item["post_id"]},
+                ExpressionAttributeNames={"#active_uuid": ACTIVE_UUID},
+                **params
+            )
+            counts[count_key] += 1
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise e
+    print(f"{table_name}: added {counts['activated']} posts to and dropped {counts['dropped']} deleted posts from the listing GSIs")
+    return counts
+
+
+def migrate_reactions(stage: str):
+    migrate_reactions_to_map(f"terakoya-{stage}-timeline-post", "post_id")
+    migrate_reactions_to_map(f"terakoya-{stage}-timeline-comment", "comment_id")
+
+
+def backfill_counters(stage: str):
+    # Run after "reactions" step so that every item has reaction_by_user.
+    backfill_reaction_counters(f"terakoya-{stage}-timeline-post", "post_id")
+    backfill_reaction_counters(f"terakoya-{stage}-timeline-comment", "comment_id")
+
+
+def shard_posts(stage: str):
+    move_posts_to_gsi_shards(f"terakoya-{stage}-timeline-post")
+
+
+def sparse_post_indexes(stage: str):
+    make_post_indexes_sparse(f"terakoya-{stage}-timeline-post")
+
+
+STEPS = {
+    "reactions": migrate_reactions,
+    "counters": backfill_counters,
+    "shards": shard_posts,
+    "active": sparse_post_indexes,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="One-off migrations of timeline tables")
+    parser.add_argument("step", choices=list(STEPS.keys()))
+    parser.add_argument("--stage", required=True, choices=["dev", "prod"])
+    args = parser.parse_args()
+    STEPS[args.step](args.stage)